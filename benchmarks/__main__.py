@@ -0,0 +1,71 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import importlib
+
+from benchmarks.harness import REPO_ROOT, compare
+
+BENCHMARKS = ["parse", "builtins", "spawn", "pipeline", "completion", "glob", "startup"]
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks",
+                                     description="Run the shell benchmarks and emit JSON results.")
+    parser.add_argument("--only", help="comma-separated benchmarks to run (%s)" % ", ".join(BENCHMARKS))
+    parser.add_argument("--quick", action="store_true", help="use small sizes and few repetitions")
+    parser.add_argument("--output", "-o", help="write the JSON results to this file instead of stdout")
+    parser.add_argument("--baseline", help="compare against results saved in this file")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="relative slowdown counted as a regression (default: 0.10)")
+    return parser.parse_args(argv)
+
+def main(argv):
+    args = parse_args(argv)
+    names = args.only.split(",") if args.only else BENCHMARKS
+    unknown = set(names) - set(BENCHMARKS)
+    if unknown:
+        sys.stderr.write(f"unknown benchmarks: {', '.join(sorted(unknown))}\n")
+        return 2
+
+    # The shell modules live at the repository root
+    if REPO_ROOT not in sys.path:
+        sys.path.insert(0, REPO_ROOT)
+
+    results = []
+    for name in names:
+        sys.stderr.write(f"running {name}...\n")
+        module = importlib.import_module(f"benchmarks.bench_{name}")
+        results.extend(module.run(args.quick))
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "quick": args.quick,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": results,
+    }
+    text = json.dumps(report, indent=2) + "\n"
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        sys.stdout.write(text)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressed = False
+        for name, old, new, change, worse in compare(report, baseline, args.threshold):
+            flag = "  REGRESSION" if worse else ""
+            sys.stderr.write(f"{name:40s} {old:12.3f} -> {new:12.3f} ({change:+.1%}){flag}\n")
+            regressed = regressed or worse
+        return 1 if regressed else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
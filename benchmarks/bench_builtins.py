@@ -0,0 +1,21 @@
+from benchmarks.harness import measure, metric, silenced
+
+BUILTIN_LINES = {
+    "echo": "echo hello world",
+    "pwd": "pwd",
+    "export": "export BENCH_VARIABLE=1",
+    "type": "type ls",
+    "for_loop": "for i in 1 2 3 4 5 6 7 8 9 10; do export BENCH_VARIABLE=$i; done",
+}
+
+def run(quick):
+    """Measure the latency of running builtins through the shell."""
+    from shell import execute_line
+
+    number = 200 if quick else 2000
+    results = []
+    with silenced():
+        for name, line in BUILTIN_LINES.items():
+            seconds = measure(lambda: execute_line(line), number)
+            results.append(metric(f"builtin.{name}_us", seconds * 1e6, "us"))
+    return results
@@ -0,0 +1,52 @@
+import os
+import random
+import tempfile
+
+from benchmarks.harness import measure, metric
+
+PREFIXES = ["a", "git-", "py", "x", "zz"]
+
+def make_synthetic_path(root, count, dirs=8):
+    """Create dirs directories holding count executables in total."""
+    rng = random.Random(42)
+    letters = "abcdefghijklmnopqrstuvwxyz-"
+    path_dirs = []
+    for d in range(dirs):
+        dir_path = os.path.join(root, f"bin{d}")
+        os.mkdir(dir_path)
+        path_dirs.append(dir_path)
+    for i in range(count):
+        name = "".join(rng.choice(letters) for _ in range(rng.randint(2, 10))) + str(i)
+        path = os.path.join(path_dirs[i % dirs], name)
+        with open(path, "w"):
+            pass
+        os.chmod(path, 0o755)
+    return os.pathsep.join(path_dirs)
+
+def run(quick):
+    """Measure completion against a synthetic PATH of many executables."""
+    import utils
+    import completion
+
+    count = 5000 if quick else 40000
+    number = 20 if quick else 200
+    saved_path = utils.shell_variables.get("PATH")
+    with tempfile.TemporaryDirectory() as tmp:
+        utils.shell_variables["PATH"] = make_synthetic_path(tmp, count)
+        try:
+            cold = measure(lambda: completion.get_matching_executables("a"), 1, repeat=1, warmup=0)
+
+            def complete_all():
+                for prefix in PREFIXES:
+                    completion.find_longest_common_prefix(completion.get_matching_executables(prefix))
+
+            warm = measure(complete_all, number) / len(PREFIXES)
+        finally:
+            if saved_path is None:
+                utils.shell_variables.pop("PATH", None)
+            else:
+                utils.shell_variables["PATH"] = saved_path
+    return [
+        metric("completion.cold_ms", cold * 1e3, "ms"),
+        metric("completion.lookup_us", warm * 1e6, "us"),
+    ]
@@ -0,0 +1,34 @@
+import os
+import tempfile
+
+from benchmarks.harness import measure, metric
+
+def make_directory(root, count):
+    """Create count empty files in root, a tenth of them .log files."""
+    for i in range(count):
+        with open(os.path.join(root, f"file{i}.{'log' if i % 10 == 0 else 'dat'}"), "w"):
+            pass
+
+def run(quick):
+    """Measure pathname expansion over a large directory."""
+    import pathexpand
+
+    count = 10000 if quick else 100000
+    number = 3 if quick else 5
+    with tempfile.TemporaryDirectory() as tmp:
+        make_directory(tmp, count)
+        star = measure(lambda: pathexpand.expand_pattern(os.path.join(tmp, "*")), number)
+        suffix = measure(lambda: pathexpand.expand_pattern(os.path.join(tmp, "file[0-4]*.log")), number)
+
+        def shared_listing():
+            # Two patterns on one line share a directory listing
+            listings = {}
+            pathexpand.expand_pattern(os.path.join(tmp, "*.log"), listings)
+            pathexpand.expand_pattern(os.path.join(tmp, "*.dat"), listings)
+
+        shared = measure(shared_listing, number)
+    return [
+        metric("glob.star_ms", star * 1e3, "ms"),
+        metric("glob.class_ms", suffix * 1e3, "ms"),
+        metric("glob.two_patterns_ms", shared * 1e3, "ms"),
+    ]
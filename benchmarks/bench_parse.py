@@ -0,0 +1,49 @@
+from benchmarks.harness import measure, metric
+
+SAMPLE_LINES = [
+    "ls -la /tmp",
+    "echo \"Hello $USER\" '$HOME' ~/docs ${SHELL}x",
+    "cat /var/log/syslog | grep -v DEBUG | sort | uniq -c > counts.txt 2>> errors.log",
+    "export PATH=\"$HOME/bin:$PATH\"",
+    "find . -name '*.py' | xargs wc -l < /dev/null",
+    "make -j4 && echo ok || echo \"failed: $?\"; cd -",
+]
+
+def simple_commands(command_list):
+    """Return the Commands of the pipelines of a parsed line of simple commands."""
+    return [command for and_or in command_list.items
+            for pipeline in (and_or.first, *(pipeline for _, pipeline in and_or.rest))
+            for command in pipeline.commands]
+
+def run(quick):
+    """Measure tokenizing, parsing and expanding typical input lines."""
+    from parser import parse_line, expand_command
+
+    parse_uncached = parse_line.__wrapped__
+    number = 200 if quick else 2000
+    per_line = 1e6 / len(SAMPLE_LINES)
+
+    def tokenize():
+        for line in SAMPLE_LINES:
+            parse_uncached(line)
+
+    def cached():
+        for line in SAMPLE_LINES:
+            parse_line(line)
+
+    def expand():
+        for line in SAMPLE_LINES:
+            for command in simple_commands(parse_line(line)):
+                expand_command(command)
+
+    def tokenize_and_expand():
+        for line in SAMPLE_LINES:
+            for command in simple_commands(parse_uncached(line)):
+                expand_command(command)
+
+    return [
+        metric("parse.tokenize_us", measure(tokenize, number) * per_line, "us"),
+        metric("parse.cached_us", measure(cached, number) * per_line, "us"),
+        metric("parse.expand_us", measure(expand, number) * per_line, "us"),
+        metric("parse.tokenize_expand_us", measure(tokenize_and_expand, number) * per_line, "us"),
+    ]
@@ -0,0 +1,54 @@
+import os
+import sys
+import time
+import tempfile
+import statistics
+import subprocess
+
+from benchmarks.harness import MAIN_SCRIPT, metric
+
+STAGE_COUNTS = (2, 4, 8)
+LINE = b"the quick brown fox jumps over the lazy dog 0123456789\n"
+
+def write_data(path, size):
+    """Write size bytes of text lines to path."""
+    block = LINE * (1024 * 1024 // len(LINE))
+    with open(path, "wb") as f:
+        written = 0
+        while written < size:
+            f.write(block)
+            written += len(block)
+    return os.path.getsize(path)
+
+def run_shell_command(command):
+    """Run command through main.py -c, returning (seconds, peak RSS in KiB).
+
+    The peak RSS comes from wait4 and covers the shell process, which is
+    what grows if pipeline data is buffered in Python.
+    """
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, MAIN_SCRIPT, "-c", command],
+                               stdout=subprocess.DEVNULL)
+    _, status, rusage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise RuntimeError(f"benchmark command failed ({process.returncode}): {command}")
+    return elapsed, rusage.ru_maxrss
+
+def run(quick):
+    """Measure throughput and shell memory for pipelines of 2 to 8 stages."""
+    size = (16 if quick else 256) * 1024 * 1024
+    repeat = 1 if quick else 3
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        data = os.path.join(tmp, "data.txt")
+        size = write_data(data, size)
+        for stages in STAGE_COUNTS:
+            command = " | ".join([f"cat {data}"] + ["cat"] * (stages - 2) + ["wc -c"])
+            runs = [run_shell_command(command) for _ in range(repeat)]
+            seconds = statistics.median(elapsed for elapsed, _ in runs)
+            peak_rss = max(rss for _, rss in runs)
+            results.append(metric(f"pipeline.stages_{stages}_mb_per_s", size / seconds / 1e6, "MB/s", better="higher"))
+            results.append(metric(f"pipeline.stages_{stages}_peak_rss_kb", peak_rss, "KiB"))
+    return results
@@ -0,0 +1,29 @@
+from benchmarks.harness import measure, metric, silenced
+
+def run(quick):
+    """Measure the latency of spawning an external command with each launcher backend."""
+    import os
+    import utils
+    from shell import execute_line
+
+    number = 50 if quick else 500
+    enabled = "posix-spawn" in utils.shell_options
+    results = []
+    try:
+        for backend in ("posix_spawn", "popen"):
+            if backend == "posix_spawn":
+                if not hasattr(os, "posix_spawn"):
+                    continue
+                utils.shell_options.add("posix-spawn")
+            else:
+                utils.shell_options.discard("posix-spawn")
+            with silenced():
+                seconds = measure(lambda: execute_line("true"), number, repeat=3)
+            results.append(metric(f"spawn.{backend}.true_us", seconds * 1e6, "us"))
+            results.append(metric(f"spawn.{backend}.per_second", 1 / seconds, "spawns/s", better="higher"))
+    finally:
+        if enabled:
+            utils.shell_options.add("posix-spawn")
+        else:
+            utils.shell_options.discard("posix-spawn")
+    return results
@@ -0,0 +1,26 @@
+import sys
+import time
+import statistics
+import subprocess
+
+from benchmarks.harness import MAIN_SCRIPT, metric
+
+def time_process(argv, repeat):
+    """Return the median wall time in seconds of running argv to completion."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(argv, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+def run(quick):
+    """Measure cold startup of main.py against a bare interpreter."""
+    repeat = 5 if quick else 30
+    interpreter = time_process([sys.executable, "-c", "pass"], repeat)
+    shell = time_process([sys.executable, MAIN_SCRIPT, "-c", ""], repeat)
+    return [
+        metric("startup.interpreter_ms", interpreter * 1e3, "ms"),
+        metric("startup.main_ms", shell * 1e3, "ms"),
+        metric("startup.overhead_ms", (shell - interpreter) * 1e3, "ms"),
+    ]
@@ -0,0 +1,67 @@
+import os
+import sys
+import time
+import statistics
+from contextlib import contextmanager
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MAIN_SCRIPT = os.path.join(REPO_ROOT, "main.py")
+
+def metric(name, value, unit, better="lower"):
+    """Describe one benchmark result."""
+    return {"name": name, "value": value, "unit": unit, "better": better}
+
+def time_call(func, number):
+    """Return the mean wall time in seconds of number calls to func."""
+    start = time.perf_counter()
+    for _ in range(number):
+        func()
+    return (time.perf_counter() - start) / number
+
+def measure(func, number, repeat=5, warmup=1):
+    """Return the median of repeat runs of time_call, after warmup calls."""
+    for _ in range(warmup):
+        func()
+    return statistics.median(time_call(func, number) for _ in range(repeat))
+
+@contextmanager
+def silenced():
+    """Send fds 1 and 2 and sys.stdout/sys.stderr to /dev/null.
+
+    Both the file descriptors and the Python streams are replaced, so output
+    written by builtins and by child processes is discarded alike.
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = [os.dup(1), os.dup(2)]
+    saved_streams = sys.stdout, sys.stderr
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    try:
+        os.dup2(devnull, 1)
+        os.dup2(devnull, 2)
+        sys.stdout = sys.stderr = open(os.devnull, "w")
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout, sys.stderr = saved_streams
+        os.dup2(saved[0], 1)
+        os.dup2(saved[1], 2)
+        for fd in saved + [devnull]:
+            os.close(fd)
+
+def compare(results, baseline, threshold):
+    """Compare results against a baseline.
+
+    Returns a list of (name, baseline value, new value, relative change,
+    regressed) tuples for every metric present in both.
+    """
+    old = {m["name"]: m for m in baseline["results"]}
+    rows = []
+    for m in results["results"]:
+        previous = old.get(m["name"])
+        if previous is None or not previous["value"]:
+            continue
+        change = (m["value"] - previous["value"]) / previous["value"]
+        worse = change if m["better"] == "lower" else -change
+        rows.append((m["name"], previous["value"], m["value"], change, worse > threshold))
+    return rows
@@ -1,202 +1,839 @@
 import os
-import sys
-import readline
-import shutil
-from utils import shell_variables, last_exit_code, SHELL_BUILTINS, HELP_TEXT
-
-def execute_builtin(cmd_name, args, stdout_redirection=None, stdout_mode=None,
-                   stderr_redirection=None, stderr_mode=None, stdin_redirection=None):
-    """Execute a built-in command and return its output."""
-    global shell_variables, last_exit_code
-    
-    output = ""
-    
-    if cmd_name == "help":
-        if not args:
-            output = "Shell built-in commands:\n\n"
-            commands = sorted(HELP_TEXT.keys())
-            command_list = "\n".join([f"  {cmd}" for cmd in commands])
-            output += command_list + "\n\n"
-            output += "Type 'help command' to find out more about the function of a specific command.\n"
+import errno
+import signal
+import utils
+import jobs
+import tracing
+from utils import HELP_TEXT
+from variables import ReadonlyError
+from parser import NAME_RE, RESERVED_WORDS
+from control import LoopControl, FunctionReturn
+from command_hash import find_command, hash_command, remove_command, clear_hash, hashed_commands, is_executable
+
+# Each builtin takes (args, stdin, stdout, stderr), where the streams are
+# text files already bound to the stage's redirections or pipes, and returns
+# its exit status. They run in-process, so nothing is forked for them.
+
+def builtin_help(args, stdin, stdout, stderr):
+    """Display information about built-in commands."""
+    if not args:
+        output = "Shell built-in commands:\n\n"
+        commands = sorted(HELP_TEXT.keys())
+        command_list = "\n".join([f"  {cmd}" for cmd in commands])
+        output += command_list + "\n\n"
+        output += "Type 'help command' to find out more about the function of a specific command.\n"
+        stdout.write(output)
+        return 0
+
+    command = args[0]
+    if command not in HELP_TEXT:
+        stderr.write(f"help: no help topics match '{command}'.\n")
+        return 1
+    stdout.write(HELP_TEXT[command] + "\n")
+    return 0
+
+def builtin_history(args, stdin, stdout, stderr):
+    """Display or search the command history with entry numbers."""
+    import time
+    from history import read_entries, search_entries
+
+    show_details = False
+    if args and args[0] == "-t":
+        show_details = True
+        args = args[1:]
+    try:
+        if args and args[0] == "-s":
+            if len(args) != 2:
+                stderr.write("history: usage: history [-t] [n] | history [-t] -s pattern\n")
+                return 2
+            entries = search_entries(args[1])
+        elif len(args) == 1 and args[0].isdigit():
+            entries = read_entries(-int(args[0])) if int(args[0]) else []
+        elif not args:
+            entries = read_entries(-utils.history_size)
         else:
-            command = args[0]
-            if command in HELP_TEXT:
-                output = HELP_TEXT[command] + "\n"
+            stderr.write("history: usage: history [-t] [n] | history [-t] -s pattern\n")
+            return 2
+    except OSError as e:
+        stderr.write(f"history: {e.strerror}\n")
+        return 1
+
+    for number, timestamp, status, command in entries:
+        if show_details:
+            when = "-" if timestamp is None else time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp))
+            stdout.write(f"{number:5d}  {when:19s}  {'-' if status is None else status:>3}  {command}\n")
+        else:
+            stdout.write(f"{number:5d}  {command}\n")
+    return 0
+
+def split_assignment_arg(arg):
+    """Split a NAME[=value] argument into (name, value or None)."""
+    name, equals, value = arg.partition("=")
+    return name, value if equals else None
+
+def builtin_export(args, stdin, stdout, stderr):
+    """Mark variables for export to commands, or list them without arguments."""
+    unexport = bool(args) and args[0] == "-n"
+    if unexport:
+        args = args[1:]
+    if not args:
+        output = "".join(f"{key}={utils.shell_variables[key]}\n"
+                         for key in sorted(utils.shell_variables.exported) if key in utils.shell_variables)
+        stdout.write(output)
+        return 0
+
+    status = 0
+    for arg in args:
+        name, value = split_assignment_arg(arg)
+        if not NAME_RE.fullmatch(name):
+            stderr.write(f"export: `{arg}': not a valid identifier\n")
+            status = 1
+            continue
+        try:
+            if unexport:
+                if value is not None:
+                    utils.shell_variables[name] = value
+                utils.shell_variables.unexport(name)
             else:
-                error_msg = f"help: no help topics match '{command}'.\n"
-                if stderr_redirection:
-                    with open(stderr_redirection, stderr_mode) as f:
-                        f.write(error_msg)
-                else:
-                    sys.stderr.write(error_msg)
-                last_exit_code = 1
-                return ""
-        
-        if stdout_redirection:
-            with open(stdout_redirection, stdout_mode) as f:
-                f.write(output)
+                utils.shell_variables.export(name, value)
+        except ReadonlyError as e:
+            stderr.write(f"export: {e}\n")
+            status = 1
+    return status
+
+def builtin_readonly(args, stdin, stdout, stderr):
+    """Make variables readonly, or list the readonly variables without arguments."""
+    if not args:
+        for name in sorted(utils.shell_variables.readonly):
+            if name in utils.shell_variables:
+                stdout.write(f"readonly {name}={utils.shell_variables[name]}\n")
+            else:
+                stdout.write(f"readonly {name}\n")
+        return 0
+
+    status = 0
+    for arg in args:
+        name, value = split_assignment_arg(arg)
+        if not NAME_RE.fullmatch(name):
+            stderr.write(f"readonly: `{arg}': not a valid identifier\n")
+            status = 1
+            continue
+        try:
+            utils.shell_variables.set_readonly(name, value)
+        except ReadonlyError as e:
+            stderr.write(f"readonly: {e}\n")
+            status = 1
+    return status
+
+def builtin_unset(args, stdin, stdout, stderr):
+    """Remove variables."""
+    if args and args[0] == "-v":
+        args = args[1:]
+    status = 0
+    for name in args:
+        try:
+            utils.shell_variables.unset(name)
+        except ReadonlyError as e:
+            stderr.write(f"unset: {e}\n")
+            status = 1
+    return status
+
+def builtin_local(args, stdin, stdout, stderr):
+    """Create variables that are restored when the current scope ends."""
+    status = 0
+    for arg in args:
+        name, value = split_assignment_arg(arg)
+        if not NAME_RE.fullmatch(name):
+            stderr.write(f"local: `{arg}': not a valid identifier\n")
+            status = 1
+            continue
+        try:
+            if not utils.shell_variables.make_local(name, value):
+                stderr.write("local: can only be used in a function\n")
+                return 1
+        except ReadonlyError as e:
+            stderr.write(f"local: {e}\n")
+            status = 1
+    return status
+
+def builtin_type(args, stdin, stdout, stderr):
+    """Indicate how a command name would be interpreted."""
+    if not args:
+        stderr.write("type: missing operand\n")
+        return 1
+
+    shell_built_in = args[0]
+    if shell_built_in in RESERVED_WORDS:
+        stdout.write(f"{shell_built_in} is a shell keyword\n")
+        return 0
+    if shell_built_in in utils.functions:
+        stdout.write(f"{shell_built_in} is a function\n")
+        return 0
+    if shell_built_in in BUILTINS:
+        stdout.write(f"{shell_built_in} is a shell builtin\n")
+        return 0
+    path_to_cmd = find_command(shell_built_in, count=False)
+    if path_to_cmd:
+        stdout.write(f"{shell_built_in} is {path_to_cmd}\n")
+        return 0
+    stdout.write(f"{shell_built_in}: not found\n")
+    return 1
+
+def builtin_hash(args, stdin, stdout, stderr):
+    """Remember or display the full pathnames of commands."""
+    errors = []
+    if not args:
+        entries = hashed_commands()
+        if entries:
+            output = "hits\tcommand\n"
+            output += "".join(f"{hits:4d}\t{path}\n" for name, path, hits in entries)
         else:
-            sys.stdout.write(output)
-        
-        last_exit_code = 0
-    elif cmd_name == "history":
-        if len(args) == 1 and args[0].isdigit():
-            num_entries = min(int(args[0]), readline.get_current_history_length())
+            output = "hash: hash table empty\n"
+        stdout.write(output)
+    elif args[0] == "-r":
+        clear_hash()
+    elif args[0] == "-p":
+        if len(args) < 3:
+            errors.append("hash: usage: hash -p pathname name\n")
+        elif not is_executable(args[1]):
+            errors.append(f"hash: {args[1]}: not an executable file\n")
         else:
-            num_entries = readline.get_current_history_length()
-        
-        output_lines = []
-        for i in range(1, num_entries + 1):
-            idx = readline.get_current_history_length() - num_entries + i
-            if idx > 0:
-                output_lines.append(f"{idx:5d}  {readline.get_history_item(idx)}")
-        
-        output = "\n".join(output_lines) + "\n" if output_lines else ""
-        
-        if stdout_redirection:
-            with open(stdout_redirection, stdout_mode) as f:
-                f.write(output)
+            for name in args[2:]:
+                hash_command(name, args[1])
+    elif args[0] == "-d":
+        for name in args[1:]:
+            if not remove_command(name):
+                errors.append(f"hash: {name}: not found\n")
+    else:
+        for name in args:
+            if name in BUILTINS:
+                continue
+            if find_command(name) is None:
+                errors.append(f"hash: {name}: not found\n")
+
+    stderr.write("".join(errors))
+    return 1 if errors else 0
+
+def builtin_cd(args, stdin, stdout, stderr):
+    """Change the current directory."""
+    target_dir = args[0] if args else os.path.expanduser("~")
+    try:
+        os.chdir(target_dir)
+    except FileNotFoundError:
+        stderr.write(f"cd: {target_dir}: No such file or directory\n")
+        return 1
+    except NotADirectoryError:
+        stderr.write(f"cd: {target_dir}: Not a directory\n")
+        return 1
+    except PermissionError:
+        stderr.write(f"cd: {target_dir}: Permission denied\n")
+        return 1
+    utils.shell_variables["PWD"] = os.getcwd()
+    os.environ["PWD"] = os.getcwd()
+    return 0
+
+def builtin_exit(args, stdin, stdout, stderr):
+    """Exit the shell."""
+    exit_code = utils.last_exit_code
+    if args:
+        try:
+            exit_code = int(args[0])
+        except ValueError:
+            stderr.write("exit: invalid argument\n")
+            return 1
+    raise SystemExit(exit_code)
+
+def leave_loop(kind, args, stderr):
+    """Raise the LoopControl for break or continue, or report why it cannot be done."""
+    if len(args) > 1:
+        stderr.write(f"{kind}: too many arguments\n")
+        return 1
+    count = args[0] if args else "1"
+    if not count.isdigit():
+        stderr.write(f"{kind}: {count}: numeric argument required\n")
+        return 1
+    if int(count) < 1:
+        stderr.write(f"{kind}: {count}: loop count out of range\n")
+        return 1
+    if not utils.loop_depth:
+        stderr.write(f"{kind}: only meaningful in a `for', `while', or `until' loop\n")
+        return 0
+    raise LoopControl(kind, min(int(count), utils.loop_depth))
+
+def builtin_break(args, stdin, stdout, stderr):
+    """Exit from the innermost loop, or from n enclosing loops."""
+    return leave_loop("break", args, stderr)
+
+def builtin_continue(args, stdin, stdout, stderr):
+    """Resume the next iteration of the innermost loop, or of the nth enclosing loop."""
+    return leave_loop("continue", args, stderr)
+
+def builtin_return(args, stdin, stdout, stderr):
+    """Return from the function being run."""
+    status = utils.last_exit_code
+    if args:
+        try:
+            status = int(args[0])
+        except ValueError:
+            stderr.write("return: invalid argument\n")
+            return 1
+    # Only function calls open a scope for local variables
+    if not utils.shell_variables.scopes:
+        stderr.write("return: can only `return' from a function\n")
+        return 1
+    raise FunctionReturn(status)
+
+def builtin_pwd(args, stdin, stdout, stderr):
+    """Print the current working directory."""
+    stdout.write(os.getcwd() + "\n")
+    return 0
+
+def builtin_echo(args, stdin, stdout, stderr):
+    """Write arguments to standard output."""
+    stdout.write(" ".join(args) + "\n")
+    return 0
+
+def parse_signal(spec):
+    """Return the signal number for a name (TERM, SIGTERM) or number, or None."""
+    if spec.isdigit():
+        return int(spec)
+    name = spec.upper()
+    if not name.startswith("SIG"):
+        name = "SIG" + name
+    try:
+        return signal.Signals[name].value
+    except KeyError:
+        return None
+
+def builtin_jobs(args, stdin, stdout, stderr):
+    """List background and stopped jobs."""
+    show_pids = "-l" in args
+    pids_only = "-p" in args
+    jobs.reap_jobs()
+    for job_id in sorted(jobs.job_table):
+        job = jobs.job_table[job_id]
+        if pids_only:
+            stdout.write(f"{job.pgid}\n" if job.pgid is not None else "")
+        else:
+            stdout.write(jobs.format_job(job, show_pids) + "\n")
+    for job in [job for job in jobs.job_table.values() if job.done()]:
+        jobs.remove_job(job)
+    return 0
+
+def builtin_fg(args, stdin, stdout, stderr):
+    """Resume a job in the foreground."""
+    if not jobs.job_control:
+        stderr.write("fg: no job control\n")
+        return 1
+    spec = args[0] if args else None
+    job = jobs.find_job(spec)
+    if job is None:
+        stderr.write(f"fg: {spec or 'current'}: no such job\n")
+        return 1
+    stdout.write(job.command + "\n")
+    stdout.flush()
+    return jobs.continue_job(job, foreground=True)
+
+def builtin_bg(args, stdin, stdout, stderr):
+    """Resume stopped jobs in the background."""
+    if not jobs.job_control:
+        stderr.write("bg: no job control\n")
+        return 1
+    status = 0
+    for spec in args or [None]:
+        job = jobs.find_job(spec)
+        if job is None:
+            stderr.write(f"bg: {spec or 'current'}: no such job\n")
+            status = 1
+            continue
+        jobs.continue_job(job, foreground=False)
+        stdout.write(f"[{job.job_id}]+ {job.command} &\n")
+    return status
+
+def builtin_kill(args, stdin, stdout, stderr):
+    """Send a signal to jobs or processes."""
+    if args and args[0] == "-l":
+        if len(args) > 1:
+            signum = parse_signal(args[1])
+            if signum is None:
+                stderr.write(f"kill: {args[1]}: invalid signal specification\n")
+                return 1
+            stdout.write(signal.Signals(signum).name[3:] + "\n")
         else:
-            sys.stdout.write(output)
-        
-        if stderr_redirection:
-            with open(stderr_redirection, stderr_mode) as f:
-                pass
-        
-        last_exit_code = 0
-        
-    elif cmd_name == "export":
-        if not args:
-            output = "\n".join([f"{key}={value}" for key, value in sorted(shell_variables.items())])
-            if stdout_redirection:
-                with open(stdout_redirection, stdout_mode) as f:
-                    f.write(output + "\n")
+            stdout.write(" ".join(f"{sig.value}) {sig.name}" for sig in signal.Signals) + "\n")
+        return 0
+
+    signum = signal.SIGTERM
+    if args and args[0] in ("-s", "-n") and len(args) > 1:
+        signum = parse_signal(args[1])
+        args = args[2:]
+    elif args and args[0].startswith("-") and args[0] != "--":
+        signum = parse_signal(args[0][1:])
+        args = args[1:]
+    elif args and args[0] == "--":
+        args = args[1:]
+    if signum is None:
+        stderr.write("kill: invalid signal specification\n")
+        return 1
+    if not args:
+        stderr.write("kill: usage: kill [-s sigspec | -n signum | -sigspec] pid | jobspec ...\n")
+        return 2
+
+    status = 0
+    for target in args:
+        try:
+            if target.startswith("%"):
+                job = jobs.find_job(target)
+                if job is None:
+                    stderr.write(f"kill: {target}: no such job\n")
+                    status = 1
+                    continue
+                if job.pgid is None:
+                    stderr.write(f"kill: {target}: job has no processes\n")
+                    status = 1
+                    continue
+                os.killpg(job.pgid, signum)
+                if job.stopped and signum in (signal.SIGTERM, signal.SIGHUP):
+                    # A stopped job only acts on these once continued
+                    os.killpg(job.pgid, signal.SIGCONT)
+            elif target.lstrip("-").isdigit():
+                os.kill(int(target), signum)
             else:
-                sys.stdout.write(output + "\n")
-            
-            output += "\n"
+                stderr.write(f"kill: {target}: arguments must be process or job IDs\n")
+                status = 1
+        except ProcessLookupError:
+            stderr.write(f"kill: ({target}) - No such process\n")
+            status = 1
+        except PermissionError:
+            stderr.write(f"kill: ({target}) - Operation not permitted\n")
+            status = 1
+    return status
+
+def builtin_wait(args, stdin, stdout, stderr):
+    """Wait for jobs or processes to finish and return the status of the last one."""
+    if not args:
+        for job in list(jobs.job_table.values()):
+            job.wait(block=True)
+            if job.done():
+                jobs.remove_job(job)
+        return 0
+
+    status = 0
+    for target in args:
+        if target.startswith("%"):
+            job = jobs.find_job(target)
+        elif target.isdigit():
+            job = next((job for job in jobs.job_table.values() if int(target) in job.pids()), None)
         else:
-            for arg in args:
-                if "=" in arg:
-                    key, value = arg.split("=", 1)
-                    shell_variables[key] = value
-                    os.environ[key] = value
-        
-        if stderr_redirection:
-            with open(stderr_redirection, stderr_mode) as f:
-                pass
-        
-        last_exit_code = 0
-        
-    elif cmd_name == "type":
-        if not args:
-            error_msg = "type: missing operand\n"
-            if stderr_redirection:
-                with open(stderr_redirection, stderr_mode) as f:
-                    f.write(error_msg)
+            stderr.write(f"wait: `{target}': not a pid or valid job spec\n")
+            status = 2
+            continue
+        if job is None and target.isdigit() and int(target) in jobs.saved_statuses:
+            # Finished and already dropped from the job table
+            status = jobs.saved_statuses.pop(int(target))
+            continue
+        if job is None:
+            stderr.write(f"wait: {target}: no such job\n" if target.startswith("%")
+                         else f"wait: pid {target} is not a child of this shell\n")
+            status = 127
+            continue
+        if job.wait(block=True):
+            jobs.remove_job(job)
+            if target.isdigit():
+                index = next(i for i, process in job.processes if process.pid == int(target))
+                status = job.exit_codes[index]
             else:
-                sys.stderr.write(error_msg)
-            if stdout_redirection:
-                with open(stdout_redirection, stdout_mode) as f:
-                    pass
-            last_exit_code = 1
+                status = job.status()
         else:
-            shell_built_in = args[0]
-            if shell_built_in in SHELL_BUILTINS:
-                output = f"{shell_built_in} is a shell builtin\n"
+            # The job was stopped rather than finished
+            status = 128 + signal.SIGTSTP
+    return status
+
+# Options accepted by `set -o`
+SET_OPTIONS = ("accounting", "noglob", "posix-spawn", "trace-timing")
+
+def builtin_set(args, stdin, stdout, stderr):
+    """Set shell options and positional parameters."""
+    if not args:
+        stdout.write("".join(f"{key}={value}\n" for key, value in sorted(utils.shell_variables.items())))
+        return 0
+
+    while args:
+        arg = args.pop(0)
+        if arg == "--":
+            utils.positional_args[1:] = args
+            return 0
+        if arg in ("-o", "+o"):
+            if not args:
+                for option in SET_OPTIONS:
+                    state = "on" if option in utils.shell_options else "off"
+                    stdout.write(f"{option:15s}\t{state}\n")
+                return 0
+            option = args.pop(0)
+            if option not in SET_OPTIONS:
+                stderr.write(f"set: {option}: invalid option name\n")
+                return 2
+            if arg == "-o":
+                utils.shell_options.add(option)
             else:
-                path_to_cmd = shutil.which(shell_built_in)
-                if path_to_cmd:
-                    output = f"{shell_built_in} is {path_to_cmd}\n"
-                else:
-                    output = f"{shell_built_in}: not found\n"
-                    last_exit_code = 1
-                    
-            if stdout_redirection:
-                with open(stdout_redirection, stdout_mode) as f:
-                    f.write(output)
+                utils.shell_options.discard(option)
+            if option == "trace-timing":
+                tracing.enabled = arg == "-o"
+        else:
+            stderr.write(f"set: {arg}: invalid option\n")
+            stderr.write("set: usage: set [-o option] [+o option] [-- arg ...]\n")
+            return 2
+    return 0
+
+def format_minutes(seconds):
+    """Format seconds the way time and times do, e.g. 1m2.345s."""
+    minutes, milliseconds = divmod(max(round(seconds * 1000), 0), 60000)
+    return f"{minutes}m{milliseconds / 1000:.3f}s"
+
+def builtin_times(args, stdin, stdout, stderr):
+    """Print the accumulated user and system times of the shell and its children."""
+    times = os.times()
+    stdout.write(f"{format_minutes(times.user)} {format_minutes(times.system)}\n")
+    stdout.write(f"{format_minutes(times.children_user)} {format_minutes(times.children_system)}\n")
+    return 0
+
+def builtin_rusage(args, stdin, stdout, stderr):
+    """Show the resource usage of each process of the last accounted pipeline."""
+    if utils.last_resources is None:
+        stderr.write("rusage: no pipeline has been accounted; use `time` or `set -o accounting`\n")
+        return 1
+    stdout.write(f"{'STAGE':>5} {'PID':>7} {'STATUS':>6} {'REAL':>9} {'USER':>9} {'SYS':>9} {'MAXRSS':>9}  COMMAND\n")
+    for record in utils.last_resources:
+        stdout.write(f"{record['stage']:5d} {record['pid']:7d} {record['status']:6d} "
+                     f"{record['real']:8.3f}s {record['user']:8.3f}s {record['sys']:8.3f}s "
+                     f"{record['maxrss']:8d}K  {record['command']}\n")
+    return 0
+
+# option -> (description, unit, RLIMIT_ name, bytes per unit)
+ULIMIT_RESOURCES = {
+    "c": ("core file size", "blocks", "RLIMIT_CORE", 1024),
+    "d": ("data seg size", "kbytes", "RLIMIT_DATA", 1024),
+    "f": ("file size", "blocks", "RLIMIT_FSIZE", 1024),
+    "l": ("max locked memory", "kbytes", "RLIMIT_MEMLOCK", 1024),
+    "m": ("max memory size", "kbytes", "RLIMIT_RSS", 1024),
+    "n": ("open files", "", "RLIMIT_NOFILE", 1),
+    "s": ("stack size", "kbytes", "RLIMIT_STACK", 1024),
+    "t": ("cpu time", "seconds", "RLIMIT_CPU", 1),
+    "u": ("max user processes", "", "RLIMIT_NPROC", 1),
+    "v": ("virtual memory", "kbytes", "RLIMIT_AS", 1024),
+}
+
+def rlimit_above(limit, other):
+    """Whether a resource limit is higher than another, RLIM_INFINITY being the highest."""
+    import resource
+    if limit == resource.RLIM_INFINITY:
+        return other != resource.RLIM_INFINITY
+    return other != resource.RLIM_INFINITY and limit > other
+
+def builtin_ulimit(args, stdin, stdout, stderr):
+    """Show or set the resource limits of the commands the shell starts."""
+    import resource
+
+    usage = "ulimit: usage: ulimit [-SHa] [-cdflmnstuv] [limit]\n"
+    soft = hard = False
+    show_all = False
+    letters = []
+    while args and args[0].startswith("-") and len(args[0]) > 1:
+        for letter in args.pop(0)[1:]:
+            if letter == "S":
+                soft = True
+            elif letter == "H":
+                hard = True
+            elif letter == "a":
+                show_all = True
+            elif letter in ULIMIT_RESOURCES and hasattr(resource, ULIMIT_RESOURCES[letter][2]):
+                letters.append(letter)
             else:
-                sys.stdout.write(output)
-                
-            if stderr_redirection:
-                with open(stderr_redirection, stderr_mode) as f:
-                    pass
-                    
-            if "not found" not in output:
-                last_exit_code = 0
-                
-    elif cmd_name == "cd":
-        try:
-            target_dir = args[0] if args else "~"
-            os.chdir(target_dir)
-            shell_variables["PWD"] = os.getcwd()
-            os.environ["PWD"] = os.getcwd()
-            if stdout_redirection:
-                with open(stdout_redirection, stdout_mode) as f:
-                    pass
-            if stderr_redirection:
-                with open(stderr_redirection, stderr_mode) as f:
-                    pass
-            last_exit_code = 0
-        except FileNotFoundError:
-            error_msg = f"cd: {args[0]}: No such file or directory\n"
-            if stderr_redirection:
-                with open(stderr_redirection, stderr_mode) as f:
-                    f.write(error_msg)
+                stderr.write(f"ulimit: -{letter}: invalid option\n")
+                stderr.write(usage)
+                return 2
+    if len(args) > 1:
+        stderr.write(usage)
+        return 2
+    if show_all:
+        letters = [letter for letter, info in ULIMIT_RESOURCES.items() if hasattr(resource, info[2])]
+    letters = letters or ["f"]
+
+    def current(number):
+        return utils.resource_limits.get(number) or resource.getrlimit(number)
+
+    if not args or show_all:
+        for letter in letters:
+            description, unit, name, scale = ULIMIT_RESOURCES[letter]
+            limit = current(getattr(resource, name))[1 if hard and not soft else 0]
+            value = "unlimited" if limit == resource.RLIM_INFINITY else str(limit // scale)
+            if len(letters) == 1:
+                stdout.write(f"{value}\n")
             else:
-                sys.stderr.write(error_msg)
-            if stdout_redirection:
-                with open(stdout_redirection, stdout_mode) as f:
-                    pass
-            last_exit_code = 1
-            
-    elif cmd_name == "exit":
-        exit_code = 0
-        if args:
-            try:
-                exit_code = int(args[0])
-            except ValueError:
-                error_msg = "exit: invalid argument\n"
-                if stderr_redirection:
-                    with open(stderr_redirection, stderr_mode) as f:
-                        f.write(error_msg)
-                else:
-                    sys.stderr.write(error_msg)
-                if stdout_redirection:
-                    with open(stdout_redirection, stdout_mode) as f:
-                        pass
-                last_exit_code = 1
-                return ""
-        if stdout_redirection:
-            with open(stdout_redirection, stdout_mode) as f:
-                pass
-        if stderr_redirection:
-            with open(stderr_redirection, stderr_mode) as f:
-                pass
-        raise SystemExit(exit_code)
-        
-    elif cmd_name == "pwd":
-        output = os.getcwd() + "\n"
-        if stdout_redirection:
-            with open(stdout_redirection, stdout_mode) as f:
-                f.write(output)
+                label = f"({unit}, -{letter})" if unit else f"(-{letter})"
+                stdout.write(f"{description:24s}{label:>15s} {value}\n")
+        return 0
+
+    # Without -S or -H both limits are set, as in bash
+    if not soft and not hard:
+        soft = hard = True
+    for letter in letters:
+        description, unit, name, scale = ULIMIT_RESOURCES[letter]
+        number = getattr(resource, name)
+        old_soft, old_hard = current(number)
+        value = args[0]
+        if value == "unlimited":
+            limit = resource.RLIM_INFINITY
+        elif value in ("soft", "hard"):
+            limit = old_soft if value == "soft" else old_hard
+        elif value.isdigit():
+            limit = int(value) * scale
+        else:
+            stderr.write(f"ulimit: {value}: invalid number\n")
+            return 1
+        new_soft = limit if soft else old_soft
+        new_hard = limit if hard else old_hard
+        # The limits only take effect in commands, so check now what the
+        # kernel would refuse when the first one starts
+        error = None
+        if rlimit_above(new_soft, new_hard):
+            error = errno.EINVAL
+        elif rlimit_above(new_hard, resource.getrlimit(number)[1]) and os.geteuid() != 0:
+            error = errno.EPERM
+        if error is not None:
+            stderr.write(f"ulimit: {description}: cannot modify limit: {os.strerror(error)}\n")
+            return 1
+        utils.resource_limits[number] = (new_soft, new_hard)
+    return 0
+
+def builtin_trace(args, stdin, stdout, stderr):
+    """Report the phase latencies recorded in the trace file."""
+    if args and args[0] == "-c":
+        try:
+            open(utils.trace_file, "w").close()
+        except OSError as e:
+            stderr.write(f"trace: {utils.trace_file}: {e.strerror}\n")
+            return 1
+        return 0
+    path = args[0] if args else utils.trace_file
+    if not tracing.report(stdout, path):
+        stderr.write(f"trace: {path}: cannot read trace file\n")
+        return 1
+    return 0
+
+def write_bytes(stream, data):
+    """Write bytes to a builtin's text stream, bypassing decoding when possible."""
+    buffer = getattr(stream, "buffer", None)
+    if buffer is None:
+        stream.write(data.decode(errors="surrogateescape"))
+    else:
+        stream.flush()
+        buffer.write(data)
+        buffer.flush()
+
+def write_capture(stream, buffer):
+    """Write a CaptureBuffer to a builtin's text stream chunk by chunk, then close it."""
+    with buffer:
+        for chunk in buffer.chunks():
+            write_bytes(stream, chunk)
+
+def build_parallel_argv(template, item):
+    """Substitute item for {} in the template, or append it if there is no {}."""
+    if any("{}" in word for word in template):
+        return [word.replace("{}", item) for word in template]
+    return template + [item]
+
+def builtin_parallel(args, stdin, stdout, stderr):
+    """Run a command for every input item on a bounded pool of workers."""
+    import time
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+    from shell import run_captured
+
+    workers = os.cpu_count() or 1
+    keep_order = False
+    stats = False
+    pattern = None
+    while args and args[0].startswith("-"):
+        option = args.pop(0)
+        if option in ("-j", "--jobs") and args and args[0].isdigit():
+            workers = int(args.pop(0))
+        elif option.startswith("-j") and option[2:].isdigit():
+            workers = int(option[2:])
+        elif option in ("-k", "--keep-order"):
+            keep_order = True
+        elif option == "--stats":
+            stats = True
+        elif option == "--glob" and args:
+            pattern = args.pop(0)
+        elif option == "--":
+            break
         else:
-            sys.stdout.write(output)
-        if stderr_redirection:
-            with open(stderr_redirection, stderr_mode) as f:
-                pass
-        last_exit_code = 0
-        
-    elif cmd_name == "echo":
-        output = " ".join(args) + "\n"
-        if stdout_redirection:
-            with open(stdout_redirection, stdout_mode) as f:
-                f.write(output)
+            stderr.write(f"parallel: {option}: invalid option\n")
+            stderr.write("parallel: usage: parallel [-j N] [-k] [--stats] [--glob pattern] command [args ...] [::: items ...]\n")
+            return 2
+
+    if ":::" in args:
+        split = args.index(":::")
+        template, items = args[:split], iter(args[split + 1:])
+    elif pattern is not None:
+        # Matches are handed out as the directories are scanned, unsorted
+        import pathexpand
+        template, items = args, pathexpand.iglob(pattern)
+    else:
+        template = args
+        items = (line.rstrip("\n") for line in stdin if line.strip())
+    if not template or workers < 1:
+        stderr.write("parallel: usage: parallel [-j N] [-k] [--stats] [--glob pattern] command [args ...] [::: items ...]\n")
+        return 2
+
+    started = time.perf_counter()
+    total = failed = 0
+    finished = {}
+    next_to_print = 0
+
+    def report(result):
+        nonlocal failed
+        status, stdout_data, stderr_data = result
+        write_capture(stdout, stdout_data)
+        write_capture(stderr, stderr_data)
+        if status != 0:
+            failed += 1
+
+    # Items are read lazily and at most twice the worker count are in
+    # flight, so a long stdin is consumed as a stream.
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {}
+        exhausted = False
+        while pending or not exhausted:
+            while not exhausted and len(pending) < 2 * workers:
+                item = next(items, None)
+                if item is None:
+                    exhausted = True
+                    break
+                future = pool.submit(run_captured, build_parallel_argv(template, item))
+                pending[future] = total
+                total += 1
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                sequence = pending.pop(future)
+                if keep_order:
+                    finished[sequence] = future.result()
+                else:
+                    report(future.result())
+            while next_to_print in finished:
+                report(finished.pop(next_to_print))
+                next_to_print += 1
+
+    if stats:
+        elapsed = time.perf_counter() - started
+        rate = total / elapsed if elapsed > 0 else 0.0
+        stderr.write(f"parallel: {total} jobs, {failed} failed, {elapsed:.2f}s, {rate:.1f} jobs/s, {workers} workers\n")
+    # As with GNU parallel, the status is the number of failed jobs
+    return min(failed, 101)
+
+def builtin_cache(args, stdin, stdout, stderr):
+    """Run a command through the output cache."""
+    import output_cache
+    from shell import run_captured
+
+    usage = "cache: usage: cache [-t seconds] [-d file] [-e name] [-p] [--] command [args ...]\n"
+    if args and args[0] == "-s":
+        stdout.write(f"cache: {output_cache.statistics()}\n")
+        return 0
+    if args and args[0] == "-c":
+        output_cache.invalidate(args[1:] or None)
+        return 0
+
+    ttl = None
+    dependencies = []
+    variables = []
+    persist = False
+    while args and args[0].startswith("-"):
+        option = args.pop(0)
+        if option == "--":
+            break
+        if option == "-p":
+            persist = True
+        elif option in ("-t", "-d", "-e") and args:
+            value = args.pop(0)
+            if option == "-d":
+                dependencies.append(value)
+            elif option == "-e":
+                variables.append(value)
+            else:
+                try:
+                    ttl = float(value)
+                except ValueError:
+                    stderr.write(f"cache: {value}: invalid number of seconds\n")
+                    return 2
         else:
-            sys.stdout.write(output)
-        if stderr_redirection:
-            with open(stderr_redirection, stderr_mode) as f:
-                pass
-        last_exit_code = 0
-        
-    return output
\ No newline at end of file
+            stderr.write(f"cache: {option}: invalid option\n")
+            stderr.write(usage)
+            return 2
+    if not args:
+        stderr.write(usage)
+        return 2
+
+    key = output_cache.make_key(args, dependencies, variables)
+    entry = output_cache.lookup(key, ttl, persist)
+    if entry is None:
+        status, stdout_data, stderr_data = run_captured(args)
+        if stdout_data.spilled or stderr_data.spilled:
+            # Too big to keep; passed through uncached
+            write_capture(stdout, stdout_data)
+            write_capture(stderr, stderr_data)
+            return status
+        with stdout_data, stderr_data:
+            entry = output_cache.store(key, status, stdout_data.getvalue(), stderr_data.getvalue(), persist)
+    _, status, stdout_data, stderr_data = entry
+    write_bytes(stdout, stdout_data)
+    write_bytes(stderr, stderr_data)
+    return status
+
+BUILTINS = {
+    "bg": builtin_bg,
+    "break": builtin_break,
+    "cache": builtin_cache,
+    "cd": builtin_cd,
+    "continue": builtin_continue,
+    "echo": builtin_echo,
+    "exit": builtin_exit,
+    "export": builtin_export,
+    "fg": builtin_fg,
+    "hash": builtin_hash,
+    "help": builtin_help,
+    "history": builtin_history,
+    "jobs": builtin_jobs,
+    "kill": builtin_kill,
+    "local": builtin_local,
+    "parallel": builtin_parallel,
+    "pwd": builtin_pwd,
+    "readonly": builtin_readonly,
+    "return": builtin_return,
+    "rusage": builtin_rusage,
+    "set": builtin_set,
+    "times": builtin_times,
+    "trace": builtin_trace,
+    "type": builtin_type,
+    "ulimit": builtin_ulimit,
+    "unset": builtin_unset,
+    "wait": builtin_wait,
+}
+
+# Builtins that change the state of the shell. Unless they run as a lone
+# command in the foreground, they run in a subshell (see shell.start_subshell),
+# so that `cd / | cat` or `export X=1 &` leave the shell as it was.
+SUBSHELL_BUILTINS = frozenset((
+    "bg", "break", "cd", "continue", "exit", "export", "fg", "hash", "local",
+    "readonly", "return", "set", "ulimit", "unset", "wait",
+))
+
+# Builtins that read their standard input
+INPUT_BUILTINS = frozenset(("parallel",))
+
+def execute_builtin(cmd_name, args, stdin, stdout, stderr):
+    """Execute a built-in command on the given streams and return its exit status."""
+    with tracing.span("builtin"):
+        return BUILTINS[cmd_name](args, stdin, stdout, stderr)
@@ -0,0 +1,98 @@
+import os
+import utils
+
+# Output captured from commands for parallel and cache. It is held in memory
+# up to utils.capture_memory_limit bytes and moved to an unlinked temporary
+# file beyond that, so a command writing gigabytes costs disk space rather
+# than the shell's memory. Readers consume it in chunks.
+
+CHUNK_SIZE = 64 * 1024
+
+class CaptureBuffer:
+    """Bytes written by a command, in memory up to limit and spilled to a file after."""
+
+    def __init__(self, limit=None):
+        self.limit = utils.capture_memory_limit if limit is None else limit
+        self.memory = bytearray()
+        self.file = None
+        self.size = 0
+
+    @property
+    def spilled(self):
+        return self.file is not None
+
+    def write(self, data):
+        if self.file is None and len(self.memory) + len(data) > self.limit:
+            import tempfile
+            self.file = tempfile.TemporaryFile(prefix="python_shell_capture.")
+            self.file.write(self.memory)
+            self.memory = bytearray()
+        if self.file is None:
+            self.memory += data
+        else:
+            self.file.write(data)
+        self.size += len(data)
+
+    def chunks(self):
+        """Yield the captured bytes from the start, at most CHUNK_SIZE at a time."""
+        if self.file is None:
+            view = memoryview(self.memory)
+            for start in range(0, len(view), CHUNK_SIZE):
+                yield bytes(view[start:start + CHUNK_SIZE])
+            return
+        self.file.flush()
+        self.file.seek(0)
+        while True:
+            chunk = self.file.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+    def getvalue(self):
+        """Return everything captured as one bytes object."""
+        if self.file is None:
+            return bytes(self.memory)
+        return b"".join(self.chunks())
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.memory = bytearray()
+
+    def __len__(self):
+        return self.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def capture_bytes(data):
+    """Return a CaptureBuffer holding data."""
+    buffer = CaptureBuffer()
+    buffer.write(data)
+    return buffer
+
+def read_pipes(outputs):
+    """Read pipe fds to EOF into their buffers, given as {fd: CaptureBuffer}.
+
+    The fds are closed once drained. Several pipes are read together, so a
+    command filling one while the other is unread cannot deadlock.
+    """
+    import selectors
+
+    outputs = dict(outputs)
+    with selectors.DefaultSelector() as selector:
+        for fd in outputs:
+            selector.register(fd, selectors.EVENT_READ)
+        while outputs:
+            for key, _ in selector.select():
+                data = os.read(key.fd, CHUNK_SIZE)
+                if data:
+                    outputs[key.fd].write(data)
+                else:
+                    selector.unregister(key.fd)
+                    os.close(key.fd)
+                    del outputs[key.fd]
@@ -0,0 +1,156 @@
+import os
+import utils
+
+# name -> [path, hits, pinned]
+hash_table = {}
+# PATH directory -> mtime observed when it was last searched
+dir_mtimes = {}
+# Directory -> mtime, and names whose entry was checked against dir_mtimes,
+# during the current command line; both are reused until revalidate is called
+line_mtimes = {}
+validated = set()
+hashed_path = None
+
+def get_path_dirs():
+    """Return the directories of the current PATH."""
+    return utils.shell_variables.get("PATH", os.defpath).split(os.pathsep)
+
+def get_mtime(dir_path):
+    """Return a directory's mtime, or None if it cannot be read."""
+    try:
+        return os.stat(dir_path or ".").st_mtime_ns
+    except OSError:
+        return None
+
+def is_executable(path):
+    """Check whether path is an executable regular file."""
+    return os.path.isfile(path) and os.access(path, os.X_OK)
+
+def clear_hash():
+    """Forget every remembered command location, including pinned ones."""
+    global hashed_path
+    hash_table.clear()
+    dir_mtimes.clear()
+    line_mtimes.clear()
+    validated.clear()
+    hashed_path = None
+
+def revalidate():
+    """Check remembered commands against their directories again, once each.
+
+    Called before each command line, so that PATH directories are stat'ed
+    at most once per line however many commands it runs.
+    """
+    line_mtimes.clear()
+    validated.clear()
+
+def current_mtime(dir_path):
+    """Return a directory's mtime as of the current command line."""
+    if dir_path not in line_mtimes:
+        line_mtimes[dir_path] = get_mtime(dir_path)
+    return line_mtimes[dir_path]
+
+def check_path():
+    """Drop the table if PATH changed since it was filled."""
+    global hashed_path
+    path = utils.shell_variables.get("PATH", os.defpath)
+    if path != hashed_path:
+        clear_hash()
+        hashed_path = path
+
+def is_stale(path):
+    """Check whether a directory searched for path has changed since.
+
+    Only the directories up to the one holding path matter: a new entry in an
+    earlier directory would shadow it, and the holding directory tells us
+    whether it was removed or replaced.
+    """
+    target_dir = os.path.dirname(path)
+    for dir_path in get_path_dirs():
+        if dir_path in dir_mtimes and current_mtime(dir_path) != dir_mtimes[dir_path]:
+            return True
+        if os.path.join(dir_path, "") == os.path.join(target_dir, ""):
+            return False
+    return True
+
+def record_mtime(dir_path):
+    """Record a directory's current mtime.
+
+    Commands found in it or after it on PATH were checked against the old
+    one; if it changed, they are forgotten, since a new entry may shadow
+    them.
+    """
+    mtime = current_mtime(dir_path)
+    if dir_path in dir_mtimes and dir_mtimes[dir_path] != mtime:
+        dirs = get_path_dirs()
+        later = {os.path.join(path, "") for path in dirs[dirs.index(dir_path):]}
+        for name, (path, hits, pinned) in list(hash_table.items()):
+            if not pinned and os.path.join(os.path.dirname(path), "") in later:
+                del hash_table[name]
+    dir_mtimes[dir_path] = mtime
+
+def search_path(name):
+    """Search PATH for name, recording the mtime of each directory visited."""
+    for dir_path in get_path_dirs():
+        record_mtime(dir_path)
+        candidate = os.path.join(dir_path, name)
+        if is_executable(candidate):
+            return candidate
+    return None
+
+def find_command(name, count=True):
+    """Return the full path of an external command, using the hash table.
+
+    Names containing a slash are not looked up in PATH. Misses are not
+    remembered, so a command installed later is found on the next lookup.
+    Without count, the lookup is not added to the hits `hash` reports.
+    """
+    if os.sep in name:
+        return name if is_executable(name) else None
+
+    check_path()
+    entry = hash_table.get(name)
+    if entry is not None:
+        path, hits, pinned = entry
+        if pinned or name in validated or not is_stale(path):
+            validated.add(name)
+            entry[1] = hits + count
+            return path
+        del hash_table[name]
+
+    path = search_path(name)
+    if path is not None:
+        hash_table[name] = [path, int(count), False]
+        validated.add(name)
+    return path
+
+def hash_all():
+    """Remember every executable on PATH at once.
+
+    Used by the server before it forks sessions, so that none of them has
+    to search PATH for a command.
+    """
+    check_path()
+    for dir_path in get_path_dirs():
+        dir_mtimes[dir_path] = get_mtime(dir_path)
+        try:
+            with os.scandir(dir_path or ".") as entries:
+                for entry in entries:
+                    if entry.name not in hash_table and is_executable(entry.path):
+                        hash_table[entry.name] = [entry.path, 0, False]
+        except OSError:
+            pass
+
+def hash_command(name, path):
+    """Pin name to path; it is used without searching PATH or revalidating."""
+    check_path()
+    hash_table[name] = [path, 0, True]
+
+def remove_command(name):
+    """Forget a single command. Returns False if it was not remembered."""
+    return hash_table.pop(name, None) is not None
+
+def hashed_commands():
+    """Return (name, path, hits) for every remembered command."""
+    check_path()
+    return [(name, entry[0], entry[1]) for name, entry in hash_table.items()]
@@ -1,70 +1,200 @@
 import os
 import sys
+import bisect
 import readline
-from utils import SHELL_BUILTINS
+import threading
+from collections import OrderedDict
+from builtin import BUILTINS
+from command_hash import get_path_dirs, get_mtime
 
 last_tab_prefix = ""
 tab_pressed_once = False
 
+# PATH directory -> (mtime, executable names in it)
+dir_index = {}
+# Sorted, de-duplicated names of all builtins and PATH executables
+executable_index = []
+index_key = None
+index_lock = threading.Lock()
+
+# Directory -> (mtime, sorted names, names of subdirectories), least
+# recently used first. A listing is reused until the directory's mtime
+# changes, so repeated Tab presses in a large directory skip the scan.
+listing_cache = OrderedDict()
+listing_cache_size = 32
+# Characters that end the word being completed; / and ~ are not among them,
+# so paths are completed whole
+COMPLETER_DELIMS = " \t\n|&<>;"
+# Reserved words after which a command name comes
+COMMAND_KEYWORDS = {"if", "then", "elif", "else", "while", "until", "do", "{", "!"}
+
+def scan_executables(dir_path):
+    """List the executable files in a directory."""
+    names = []
+    try:
+        with os.scandir(dir_path or ".") as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file() and os.access(entry.path, os.X_OK):
+                        names.append(entry.name)
+                except OSError:
+                    pass
+    except (PermissionError, FileNotFoundError, NotADirectoryError):
+        pass
+    return names
+
+def refresh_executable_index():
+    """Bring the executable index up to date and return it.
+
+    Costs one stat per PATH directory; only directories whose mtime changed
+    since the last refresh are listed again.
+    """
+    global executable_index, index_key
+    with index_lock:
+        path_dirs = get_path_dirs()
+        mtimes = []
+        for dir_path in path_dirs:
+            mtime = get_mtime(dir_path)
+            mtimes.append(mtime)
+            cached = dir_index.get(dir_path)
+            if cached is None or cached[0] != mtime:
+                names = scan_executables(dir_path) if mtime is not None else []
+                dir_index[dir_path] = (mtime, names)
+        
+        key = (tuple(path_dirs), tuple(mtimes))
+        if key != index_key:
+            for dir_path in set(dir_index) - set(path_dirs):
+                del dir_index[dir_path]
+            names = set(BUILTINS)
+            for dir_path in path_dirs:
+                names.update(dir_index[dir_path][1])
+            executable_index = sorted(names)
+            index_key = key
+        return executable_index
+
+def build_index_in_background():
+    """Build the executable index on a daemon thread."""
+    threading.Thread(target=refresh_executable_index, daemon=True).start()
+
 def get_matching_executables(text):
-    """Get all executables in PATH that match the given prefix."""
-    matches = []
-    matches.extend([cmd for cmd in SHELL_BUILTINS if cmd.startswith(text)])
-    path_dirs = os.environ.get("PATH", "").split(os.pathsep)
-    for dir_path in path_dirs:
-        if os.path.isdir(dir_path):
-            try:
-                for filename in os.listdir(dir_path):
-                    filepath = os.path.join(dir_path, filename)
-                    if os.path.isfile(filepath) and os.access(filepath, os.X_OK):
-                        if filename.startswith(text):
-                            matches.append(filename)
-            except (PermissionError, FileNotFoundError):
-                pass
-    return sorted(set(matches))
+    """Get all builtins and executables in PATH that match the given prefix, sorted."""
+    index = refresh_executable_index()
+    start = bisect.bisect_left(index, text)
+    end = bisect.bisect_left(index, text + "\U0010ffff", start)
+    return index[start:end]
+
+def list_directory(dir_path):
+    """Return (sorted names, directory names) for a directory, from the cache when current."""
+    mtime = get_mtime(dir_path)
+    if mtime is None:
+        return [], frozenset()
+    cached = listing_cache.get(dir_path)
+    if cached is not None and cached[0] == mtime:
+        listing_cache.move_to_end(dir_path)
+        return cached[1], cached[2]
+    names = []
+    directories = set()
+    try:
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                names.append(entry.name)
+                try:
+                    if entry.is_dir():
+                        directories.add(entry.name)
+                except OSError:
+                    pass
+    except OSError:
+        return [], frozenset()
+    names.sort()
+    listing_cache[dir_path] = (mtime, names, directories)
+    listing_cache.move_to_end(dir_path)
+    while len(listing_cache) > listing_cache_size:
+        listing_cache.popitem(last=False)
+    return names, directories
+
+def expand_directory(text):
+    """Expand a leading ~ and $VARs in the directory part of a word being completed."""
+    from parser import expand_tilde, expand_variables
+
+    if text.startswith("~"):
+        text = expand_tilde(text.rstrip("/")) + "/"
+    return expand_variables(text) if "$" in text else text
+
+def get_matching_paths(text):
+    """Get the paths that complete text, sorted, with a / after directories.
+
+    The directory part is returned as typed, so ~ and $VAR stay unexpanded.
+    Hidden files are only offered when the name being completed starts with
+    a dot.
+    """
+    slash = text.rfind("/")
+    dir_text, base = text[:slash + 1], text[slash + 1:]
+    if text.startswith("~") and slash == -1:
+        # ~user without a slash completes to the home directory itself
+        dir_text, base = text + "/", ""
+    names, directories = list_directory(expand_directory(dir_text) if dir_text else ".")
+    start = bisect.bisect_left(names, base)
+    end = bisect.bisect_left(names, base + "\U0010ffff", start)
+    return [dir_text + name + ("/" if name in directories else "")
+            for name in names[start:end] if base or not name.startswith(".")]
 
 def find_longest_common_prefix(strings):
-    """Find the longest common prefix of a list of strings."""
+    """Find the longest common prefix of a sorted list of strings."""
     if not strings:
         return ""
-    if len(strings) == 1:
-        return strings[0]
-    prefix = strings[0]
-    for i in range(len(prefix)):
-        for string in strings:
-            if i >= len(string) or string[i] != prefix[i]:
-                return prefix[:i]
-    return prefix
+    # In sorted order the first and last strings differ the most, so their
+    # common prefix is shared by everything in between.
+    first, last = strings[0], strings[-1]
+    for i in range(min(len(first), len(last))):
+        if first[i] != last[i]:
+            return first[:i]
+    return first if len(first) <= len(last) else last
 
-def completer(text, state):
+def offer(matches, text, state, display):
+    """Return readline's answer for state given the matches of text.
+
+    A single match is inserted whole, several are narrowed to their common
+    prefix, and a second Tab with nothing left to add lists display(matches).
+    """
     global last_tab_prefix, tab_pressed_once
-    buffer = readline.get_line_buffer()
-    words = buffer.split()
-    if len(words) == 0 or (len(words) == 1 and not buffer.endswith(' ')):
-        matches = get_matching_executables(text)
-        if not matches:
-            return None
-        if len(matches) == 1:
-            return matches[0] + " " if state == 0 else None
-        common_prefix = find_longest_common_prefix(matches)
-        if len(common_prefix) > len(text):
-            return common_prefix if state == 0 else None
-        if common_prefix == text and tab_pressed_once:
-            if state == 0:
-                print()
-                print("  ".join(matches))
-                print(f"$ {text}", end="")
-                tab_pressed_once = False
-            return None
-        if common_prefix == text:
-            tab_pressed_once = True
-            sys.stdout.write('\a')
-            sys.stdout.flush()
-            return None
-    tab_pressed_once = False
+    if text != last_tab_prefix:
+        last_tab_prefix = text
+        tab_pressed_once = False
+    if not matches:
+        return None
+    if len(matches) == 1:
+        # No space after a directory, so that completion can go on into it
+        match = matches[0]
+        return (match if match.endswith("/") else match + " ") if state == 0 else None
+    common_prefix = find_longest_common_prefix(matches)
+    if len(common_prefix) > len(text):
+        # As in bash, the next Tab lists what is still ambiguous
+        last_tab_prefix = common_prefix
+        tab_pressed_once = True
+        return common_prefix if state == 0 else None
+    if tab_pressed_once:
+        if state == 0:
+            print()
+            print("  ".join(display(matches)))
+            print(f"$ {readline.get_line_buffer()}", end="")
+            tab_pressed_once = False
+        return None
+    tab_pressed_once = True
+    sys.stdout.write('\a')
+    sys.stdout.flush()
     return None
 
+def completer(text, state):
+    before = readline.get_line_buffer()[:readline.get_begidx()].rstrip()
+    if not before or before[-1] in "|&;" or before.split()[-1] in COMMAND_KEYWORDS:
+        return offer(get_matching_executables(text), text, state, lambda matches: matches)
+    # Arguments complete as paths, listed by their last component
+    return offer(get_matching_paths(text), text, state,
+                 lambda matches: [match[match.rstrip("/").rfind("/") + 1:] for match in matches])
+
 def setup_completion():
     """Set up tab completion."""
     readline.set_completer(completer)
-    readline.parse_and_bind("tab: complete")
\ No newline at end of file
+    readline.set_completer_delims(COMPLETER_DELIMS)
+    readline.parse_and_bind("tab: complete")
+    build_index_in_background()
\ No newline at end of file
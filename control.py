@@ -0,0 +1,210 @@
+import utils
+import tracing
+import redirection
+from redirection import close_fds, write_error
+from variables import ReadonlyError
+from parser import (Command, Compound, FunctionDef, If, For, While, Group,
+                    expand_command, expand_word, expand_redirection)
+
+# Command lists, conditionals, loops and functions are run by walking the
+# parsed tree, which parse_line caches: a loop body is parsed once however
+# often it runs, and only its words that depend on variables or match paths
+# are expanded on each iteration (see Word.static).
+#
+# The walk is written as generators that yield every pipeline of simple
+# commands, already expanded, to a driver that launches it and sends back
+# its exit status. The shell's synchronous loop and the asyncio sessions of
+# session.Shell are both such drivers, so control flow works the same in
+# each while pipelines are started and waited for in their own way. break,
+# continue and return are builtins raising LoopControl and FunctionReturn,
+# which the driver throws back into the walk to unwind it.
+#
+# Redirections of a compound command are applied to a descriptor table
+# passed down the walk (see redirection.resolve), and are in effect for
+# every pipeline within it. A compound command or function call that is part
+# of a pipeline, runs in the background or under time or timeout is left to
+# the driver, which runs it in a subshell.
+
+# Deepest chain of function calls, so that runaway recursion is an error
+FUNCTION_NEST_LIMIT = 100
+
+class LoopControl(Exception):
+    """Raised by break and continue; applies to count enclosing loops."""
+
+    def __init__(self, kind, count):
+        super().__init__(kind)
+        self.kind = kind
+        self.count = count
+
+class FunctionReturn(Exception):
+    """Raised by return to leave the function being run with status."""
+
+    def __init__(self, status):
+        super().__init__(status)
+        self.status = status
+
+def evaluate(command_list, base):
+    """Run a CommandList, yielding (pipeline, stages, base) for each pipeline to launch.
+
+    stages are the pipeline's expanded Stages, and the Compounds among its
+    commands as they are; base is the descriptor table of the compound
+    commands around it, on top of which the stages' redirections apply.
+    The driver sends back the pipeline's exit status, or throws in the
+    LoopControl or FunctionReturn raised while running it. The generator
+    returns the status of the list and keeps utils.last_exit_code up to date.
+    """
+    return evaluate_list(command_list, base)
+
+def evaluate_list(command_list, base):
+    status = 0
+    for and_or in command_list.items:
+        status = yield from evaluate_pipeline(and_or.first, base)
+        for op, pipeline in and_or.rest:
+            if (status == 0) == (op == "&&"):
+                status = yield from evaluate_pipeline(pipeline, base)
+    return status
+
+def evaluate_pipeline(pipeline, base):
+    command = pipeline.commands[0] if pipeline.commands else None
+    in_shell = len(pipeline.commands) == 1 and not (pipeline.background or pipeline.timed or pipeline.timeout)
+    if isinstance(command, FunctionDef):
+        utils.functions[command.name] = command.body
+        status = 0
+    elif isinstance(command, Compound) and in_shell:
+        status = yield from evaluate_compound(command, base)
+    else:
+        try:
+            with tracing.span("expand"):
+                # One directory-listing cache for the globs of the whole pipeline
+                listings = {}
+                stages = [expand_command(command, listings) if isinstance(command, Command) else command
+                          for command in pipeline.commands]
+        except ValueError as e:
+            write_error(base.get(2), f"Error parsing command: {e}\n")
+            status = 2
+        else:
+            if in_shell and stages[0].args and stages[0].args[0] in utils.functions:
+                status = yield from call_function(stages[0], base)
+            else:
+                status = yield pipeline, stages, base
+    if pipeline.negated:
+        status = int(status == 0)
+    utils.last_exit_code = status
+    return status
+
+def evaluate_compound(compound, base):
+    """Run an If, For, While or Group with its redirections applied on top of base."""
+    opened = []
+    if compound.redirections:
+        try:
+            actions = [action for item in compound.redirections for action in expand_redirection(item, {})]
+            base, opened = redirection.resolve(actions, base)
+        except OSError as e:
+            write_error(base.get(2), f"{redirection.describe_error(e)}\n")
+            return 1
+        except ValueError as e:
+            write_error(base.get(2), f"Error parsing command: {e}\n")
+            return 2
+    try:
+        return (yield from EVALUATORS[type(compound.body)](compound.body, base))
+    finally:
+        close_fds(*opened)
+
+def evaluate_if(node, base):
+    for condition, body in node.clauses:
+        if (yield from evaluate_list(condition, base)) == 0:
+            return (yield from evaluate_list(body, base))
+    if node.orelse is not None:
+        return (yield from evaluate_list(node.orelse, base))
+    return 0
+
+def evaluate_for(node, base):
+    if node.words is None:
+        items = utils.positional_args[1:]
+    else:
+        items = []
+        listings = {}
+        for word in node.words:
+            items.extend(expand_word(word, listings))
+    status = 0
+    utils.loop_depth += 1
+    try:
+        for item in items:
+            try:
+                utils.shell_variables[node.name] = item
+            except ReadonlyError as e:
+                write_error(base.get(2), f"{e}\n")
+                return 1
+            try:
+                status = yield from evaluate_list(node.body, base)
+            except LoopControl as e:
+                if e.count > 1:
+                    e.count -= 1
+                    raise
+                status = 0
+                if e.kind == "break":
+                    break
+    finally:
+        utils.loop_depth -= 1
+    return status
+
+def evaluate_while(node, base):
+    status = 0
+    utils.loop_depth += 1
+    try:
+        while True:
+            try:
+                condition = yield from evaluate_list(node.condition, base)
+                if (condition == 0) == node.until:
+                    break
+                status = yield from evaluate_list(node.body, base)
+            except LoopControl as e:
+                if e.count > 1:
+                    e.count -= 1
+                    raise
+                status = 0
+                if e.kind == "break":
+                    break
+    finally:
+        utils.loop_depth -= 1
+    return status
+
+def evaluate_group(node, base):
+    return (yield from evaluate_list(node.body, base))
+
+EVALUATORS = {If: evaluate_if, For: evaluate_for, While: evaluate_while, Group: evaluate_group}
+
+def call_function(stage, base):
+    """Run a shell function with the stage's arguments as the positional parameters.
+
+    The function has a scope of its own for `local`, in which assignments
+    before its name are exported, and its status is that given to return or
+    of the last command it ran.
+    """
+    name = stage.args[0]
+    variables = utils.shell_variables
+    if len(variables.scopes) >= FUNCTION_NEST_LIMIT:
+        write_error(base.get(2), f"{name}: maximum function nesting level exceeded ({FUNCTION_NEST_LIMIT})\n")
+        return 1
+    try:
+        base, opened = redirection.resolve(stage.redirections, base)
+    except OSError as e:
+        write_error(base.get(2), f"{redirection.describe_error(e)}\n")
+        return 1
+    saved_args = utils.positional_args
+    utils.positional_args = [saved_args[0]] + stage.args[1:]
+    variables.push_scope()
+    try:
+        for variable, value in stage.assignments:
+            variables.make_local(variable, value)
+            variables.export(variable)
+        return (yield from evaluate_compound(utils.functions[name], base))
+    except ReadonlyError as e:
+        write_error(base.get(2), f"{e}\n")
+        return 1
+    except FunctionReturn as e:
+        return e.status
+    finally:
+        variables.pop_scope()
+        utils.positional_args = saved_args
+        close_fds(*opened)
@@ -0,0 +1,239 @@
+import os
+import re
+from array import array
+from utils import history_file, history_size
+
+# The history file is shared by every shell and only ever appended to, one
+# entry per command as ": <start time>:<exit status>;<command>". Newlines in
+# a command are stored as a backslash followed by a newline, and backslashes
+# are doubled, so a line continues the entry only if it ends in an odd number
+# of backslashes. Lines of older files without the prefix are read as plain
+# commands.
+#
+# index_file holds the byte offset of every entry, preceded by the size,
+# inode and entry count of the history file it describes, so the tail of the history and
+# numbered entries are found without reading the whole file. Both files are
+# written under an exclusive flock on the history file.
+index_file = history_file + ".idx"
+INDEX_HEADER = 3
+OFFSET_SIZE = array("Q").itemsize
+ENTRY_RE = re.compile(rb": (\d+):(-?\d+);")
+ESCAPE_RE = re.compile(rb"\\([\\\n])")
+
+loaded_history = []
+history_thread = None
+history_merged = False
+
+def format_entry(command, timestamp, status):
+    command = command.replace("\\", "\\\\").replace("\n", "\\\n")
+    return f": {int(timestamp)}:{status};{command}\n".encode(errors="surrogateescape")
+
+def parse_entry(data):
+    """Return (timestamp, status, command) for an entry; the first two may be None."""
+    data = ESCAPE_RE.sub(rb"\1", data.rstrip(b"\n"))
+    match = ENTRY_RE.match(data)
+    if match is None:
+        return None, None, data.decode(errors="surrogateescape")
+    return int(match.group(1)), int(match.group(2)), data[match.end():].decode(errors="surrogateescape")
+
+def scan_offsets(data, start, offsets):
+    """Append the offset of every entry in data[start:] to offsets."""
+    size = len(data)
+    position = start
+    while position < size:
+        offsets.append(position)
+        while True:
+            end = data.find(b"\n", position)
+            if end == -1:
+                position = size
+                break
+            backslashes = end
+            while backslashes > position and data[backslashes - 1:backslashes] == b"\\":
+                backslashes -= 1
+            continued = (end - backslashes) % 2 == 1
+            position = end + 1
+            if not continued:
+                break
+
+def open_history():
+    """Open the history file for appending and lock it; returns the fd."""
+    import fcntl
+    fd = os.open(history_file, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o600)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    return fd
+
+def read_offsets(index_fd, first, last):
+    """Read the offsets of entries first..last-1 (counting from 0) from the index.
+
+    The header words sit just before entry 0, at -INDEX_HEADER..-1.
+    """
+    offsets = array("Q")
+    if last > first:
+        data = os.pread(index_fd, (last - first) * OFFSET_SIZE, (INDEX_HEADER + first) * OFFSET_SIZE)
+        offsets.frombytes(data[:len(data) - len(data) % OFFSET_SIZE])
+    return offsets
+
+def sync_index(fd, index_fd):
+    """Bring the index up to date with the locked history file.
+
+    Returns (file size, entry count). Entries appended by a shell that does
+    not keep the index are scanned from where the index stopped; a replaced
+    or truncated file is indexed again from the start.
+    """
+    stat = os.fstat(fd)
+    header = read_offsets(index_fd, -INDEX_HEADER, 0)
+    if len(header) == INDEX_HEADER and header[1] == stat.st_ino and header[0] <= stat.st_size:
+        size, _, count = header
+        if size == stat.st_size:
+            return size, count
+    else:
+        size = count = 0
+
+    offsets = array("Q")
+    if stat.st_size > size:
+        import mmap
+        with mmap.mmap(fd, stat.st_size, prot=mmap.PROT_READ) as data:
+            scan_offsets(data, size, offsets)
+    os.pwrite(index_fd, offsets.tobytes(), (INDEX_HEADER + count) * OFFSET_SIZE)
+    count += len(offsets)
+    os.pwrite(index_fd, array("Q", [stat.st_size, stat.st_ino, count]).tobytes(), 0)
+    return stat.st_size, count
+
+def open_index():
+    return os.open(index_file, os.O_RDWR | os.O_CREAT, 0o600)
+
+def append_entry(command, timestamp, status):
+    """Append a command to the shared history file as soon as it has run.
+
+    The write and the index update happen under the lock, so concurrent
+    shells interleave whole entries and a crash loses nothing but the
+    command that was running.
+    """
+    try:
+        fd = open_history()
+    except OSError:
+        return
+    try:
+        index_fd = open_index()
+        try:
+            size, count = sync_index(fd, index_fd)
+            entry = format_entry(command, timestamp, status)
+            os.write(fd, entry)
+            # The header last: until it is written the new offset is ignored
+            os.pwrite(index_fd, array("Q", [size]).tobytes(), (INDEX_HEADER + count) * OFFSET_SIZE)
+            os.pwrite(index_fd, array("Q", [size + len(entry), os.fstat(fd).st_ino, count + 1]).tobytes(), 0)
+        finally:
+            os.close(index_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def read_entries(first=None, last=None):
+    """Return (number, timestamp, status, command) for entries first..last-1.
+
+    Entries are numbered from 1; negative numbers count from the end as in
+    slicing, and only the index and file bytes of the requested entries are
+    read.
+    """
+    fd = open_history()
+    try:
+        index_fd = open_index()
+        try:
+            size, count = sync_index(fd, index_fd)
+            start, stop, _ = slice(first, last).indices(count)
+            if start >= stop:
+                return []
+            offsets = read_offsets(index_fd, start, stop)
+        finally:
+            os.close(index_fd)
+        offsets.append(size)
+        data = os.pread(fd, size - offsets[0], offsets[0])
+    finally:
+        os.close(fd)
+
+    base = offsets[0]
+    return [(start + i + 1,) + parse_entry(data[offsets[i] - base:offsets[i + 1] - base])
+            for i in range(stop - start)]
+
+def search_entries(pattern):
+    """Return the entries whose command contains pattern, oldest first.
+
+    A leading ^ anchors the pattern at the start of the command. The file is
+    searched with mmap.find, which runs over millions of entries without
+    decoding them, and hits are mapped to entries through the index.
+    """
+    import mmap
+    from bisect import bisect_right
+
+    prefix = pattern.startswith("^")
+    if prefix:
+        pattern = pattern[1:]
+    needle = pattern.encode(errors="surrogateescape")
+    if not needle:
+        return read_entries()
+    fd = open_history()
+    try:
+        index_fd = open_index()
+        try:
+            size, count = sync_index(fd, index_fd)
+            offsets = read_offsets(index_fd, 0, count)
+        finally:
+            os.close(index_fd)
+        if not size:
+            return []
+        data = mmap.mmap(fd, size, prot=mmap.PROT_READ)
+    finally:
+        os.close(fd)
+
+    offsets.append(size)
+    entries = []
+    with data:
+        position = data.find(needle)
+        while position != -1:
+            number = bisect_right(offsets, position) - 1
+            timestamp, status, command = parse_entry(data[offsets[number]:offsets[number + 1]])
+            if command.startswith(pattern) if prefix else pattern in command:
+                entries.append((number + 1, timestamp, status, command))
+            position = data.find(needle, offsets[number + 1])
+    return entries
+
+def read_history_lines():
+    """Load the last history_size commands into loaded_history; runs on a background thread."""
+    try:
+        loaded_history.extend(command for _, _, _, command in read_entries(-history_size))
+    except OSError:
+        pass
+
+def merge_history():
+    """Put the loaded history in front of this session's entries in readline.
+
+    Does nothing until the background load has finished.
+    """
+    global history_merged
+    if history_merged or history_thread is None or history_thread.is_alive():
+        return
+
+    import readline
+    session = [readline.get_history_item(i) for i in range(1, readline.get_current_history_length() + 1)]
+    readline.clear_history()
+    for line in loaded_history + session:
+        readline.add_history(line)
+    loaded_history.clear()
+    history_merged = True
+
+def setup_history():
+    """Set up command history with readline, loading the recent tail in the background.
+
+    Nothing is written at exit: each command is appended with append_entry
+    as it runs.
+    """
+    global history_thread
+    import readline
+    import threading
+
+    readline.set_history_length(history_size)
+    # run_shell adds entries itself; readline would otherwise add them twice
+    readline.set_auto_history(False)
+    history_thread = threading.Thread(target=read_history_lines, daemon=True)
+    history_thread.start()
@@ -0,0 +1,380 @@
+import os
+import sys
+import time
+import signal
+import atexit
+
+import utils
+
+# Set by init_job_control when the shell runs interactively on a terminal.
+# Pipelines then run in their own process groups and the foreground one owns
+# the terminal, so Ctrl-C and Ctrl-Z reach the job rather than the shell.
+job_control = False
+terminal_fd = None
+shell_pgid = None
+
+# job id -> Job, and job ids from least to most recently used (%- and %+)
+job_table = {}
+job_order = []
+# pid -> Job for the unreaped processes of the jobs in job_table, so that the
+# SIGCHLD handler goes straight to the job of the child that changed state
+live_processes = {}
+# pid -> exit status of background processes whose job finished and was
+# dropped from the table by a non-interactive shell, for a later `wait pid`
+saved_statuses = {}
+SAVED_STATUS_LIMIT = 1024
+sigchld_installed = False
+reaping = False
+
+def exit_status(returncode):
+    """Convert a Popen returncode to a shell exit status (128 + signal if killed)."""
+    return 128 - returncode if returncode < 0 else returncode
+
+class Job:
+    """A launched pipeline: its processes, builtin threads and exit codes."""
+
+    def __init__(self, command, processes, threads, exit_codes, pgid):
+        self.job_id = None
+        self.command = command
+        # (stage index, Popen) pairs
+        self.processes = processes
+        self.threads = threads
+        self.exit_codes = exit_codes
+        self.pgid = pgid
+        self.stopped = False
+        self.foreground = False
+        self.waiting = False
+        self.started = time.perf_counter()
+        # stage index -> (seconds from start to exit, rusage from wait4)
+        self.usage = {}
+        # The last signal sent because the job ran out of time, see set_timeout
+        self.timeout_signal = None
+        self.timers = []
+
+    def pids(self):
+        return [process.pid for _, process in self.processes]
+
+    def done(self):
+        return (all(process.returncode is not None for _, process in self.processes)
+                and not any(thread.is_alive() for thread in self.threads))
+
+    def status(self):
+        """Exit status of the job: that of its last stage.
+
+        A job stopped by its timeout exits with 124, or 137 if it had to be
+        killed, as with timeout(1).
+        """
+        if self.timeout_signal is not None:
+            return 128 + signal.SIGKILL if self.timeout_signal == signal.SIGKILL else 124
+        return self.exit_codes[-1]
+
+    def set_timeout(self, seconds, signum=signal.SIGTERM, kill_after=None):
+        """Signal the job's process group after seconds, and SIGKILL it kill_after seconds later.
+
+        Timers run on daemon threads and are cancelled by cancel_timeout. The
+        job must have a process group of its own.
+        """
+        import threading
+
+        def expire(signum):
+            if self.pgid is None or self.done():
+                return
+            self.timeout_signal = signum
+            try:
+                os.killpg(self.pgid, signum)
+                # A stopped job would otherwise never see the signal
+                os.killpg(self.pgid, signal.SIGCONT)
+            except ProcessLookupError:
+                pass
+
+        self.timers.append(threading.Timer(seconds, expire, (signum,)))
+        if kill_after is not None and signum != signal.SIGKILL:
+            self.timers.append(threading.Timer(seconds + kill_after, expire, (signal.SIGKILL,)))
+        for timer in self.timers:
+            timer.daemon = True
+            timer.start()
+
+    def cancel_timeout(self):
+        for timer in self.timers:
+            timer.cancel()
+        self.timers = []
+
+    def wait(self, block=True):
+        """Collect status changes of the job's processes.
+
+        With block, waits until every process has exited or the job is
+        stopped; otherwise only reaps what has already changed. Returns True
+        once the whole job has finished.
+        """
+        flags = os.WUNTRACED if block else os.WNOHANG | os.WUNTRACED | os.WCONTINUED
+        self.waiting = block
+        try:
+            for index, process in self.processes:
+                while process.returncode is None:
+                    try:
+                        pid, status, rusage = os.wait4(process.pid, flags)
+                    except ChildProcessError:
+                        # Already reaped through the Popen object
+                        process.poll()
+                        live_processes.pop(process.pid, None)
+                        break
+                    if pid == 0:
+                        break
+                    if os.WIFSTOPPED(status):
+                        if block and self.foreground and os.WSTOPSIG(status) in (signal.SIGTTIN, signal.SIGTTOU):
+                            # It touched the terminal before we handed it over
+                            os.killpg(self.pgid, signal.SIGCONT)
+                            continue
+                        self.stopped = True
+                        if block:
+                            return False
+                        break
+                    if os.WIFCONTINUED(status):
+                        self.stopped = False
+                        continue
+                    process.returncode = os.waitstatus_to_exitcode(status)
+                    live_processes.pop(process.pid, None)
+                    self.usage[index] = (time.perf_counter() - self.started, rusage)
+                if process.returncode is not None:
+                    self.exit_codes[index] = exit_status(process.returncode)
+            if block:
+                for thread in self.threads:
+                    thread.join()
+        finally:
+            self.waiting = False
+        return self.done()
+
+    def resource_usage(self):
+        """Return a record of wall time, CPU time and max RSS for each exited process.
+
+        The wall time runs from the launch of the pipeline until the process
+        was reaped. maxrss is in kilobytes.
+        """
+        records = []
+        for index, process in self.processes:
+            if index not in self.usage:
+                continue
+            real, rusage = self.usage[index]
+            records.append({
+                "stage": index,
+                "pid": process.pid,
+                "command": " ".join(process.args),
+                "status": self.exit_codes[index],
+                "real": real,
+                "user": rusage.ru_utime,
+                "sys": rusage.ru_stime,
+                "maxrss": rusage.ru_maxrss,
+            })
+        return records
+
+def ignore_signal(signum, frame):
+    """Handler for job control signals sent to the shell itself.
+
+    A handler rather than SIG_IGN: handled signals are reset to their
+    defaults on exec, ignored ones would be inherited by every command.
+    """
+
+def init_job_control():
+    """Enable job control if the shell is reading from a terminal."""
+    global job_control, terminal_fd, shell_pgid
+    if not os.isatty(0):
+        return
+    terminal_fd = 0
+    # Do not take the terminal from whoever started us in the background
+    while os.tcgetpgrp(terminal_fd) != os.getpgrp():
+        os.killpg(os.getpgrp(), signal.SIGTTIN)
+    for signum in (signal.SIGTSTP, signal.SIGTTIN, signal.SIGTTOU):
+        signal.signal(signum, ignore_signal)
+    try:
+        os.setpgid(0, 0)
+    except PermissionError:
+        # Already a session leader
+        pass
+    shell_pgid = os.getpgrp()
+    set_foreground(shell_pgid)
+    job_control = True
+    atexit.register(hangup_jobs)
+
+def set_foreground(pgid):
+    """Give the terminal to a process group."""
+    # SIGTTOU must be blocked, not handled, for a background group to do this
+    old_mask = signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGTTOU})
+    try:
+        os.tcsetpgrp(terminal_fd, pgid)
+    except ProcessLookupError:
+        # The group already exited
+        pass
+    finally:
+        signal.pthread_sigmask(signal.SIG_SETMASK, old_mask)
+
+def hangup_jobs():
+    """Send SIGHUP to remaining jobs when the interactive shell exits."""
+    for job in list(job_table.values()):
+        if job.pgid is not None and not job.done():
+            try:
+                os.killpg(job.pgid, signal.SIGHUP)
+                if job.stopped:
+                    os.killpg(job.pgid, signal.SIGCONT)
+            except ProcessLookupError:
+                pass
+
+def reap_jobs(signum=None, frame=None):
+    """Reap finished background processes without blocking (the SIGCHLD handler).
+
+    Each child with a status change is peeked at with WNOWAIT and only its
+    own job is polled, so the cost does not grow with the job table. A child
+    that is not a background one is left to whoever waits for it, and the
+    live background processes are then polled instead. Outside the
+    interactive shell, which reports finished jobs before its prompt, a job
+    is dropped as soon as it has finished (see forget_job).
+    """
+    global reaping
+    if reaping:
+        # A child exited while the handler was running; its loop picks it up
+        return
+    reaping = True
+    try:
+        flags = os.WEXITED | os.WSTOPPED | os.WCONTINUED | os.WNOHANG | os.WNOWAIT
+        while live_processes:
+            try:
+                info = os.waitid(os.P_ALL, 0, flags)
+            except ChildProcessError:
+                break
+            if info is None:
+                break
+            job = live_processes.get(info.si_pid)
+            if job is None or job.waiting:
+                for job in set(live_processes.values()):
+                    if not job.waiting:
+                        poll_job(job)
+                break
+            poll_job(job)
+    finally:
+        reaping = False
+
+def poll_job(job):
+    job.wait(block=False)
+    if job.done() and not utils.interactive:
+        forget_job(job)
+
+def forget_job(job):
+    """Drop a finished job from the table, keeping its exit statuses for wait."""
+    for index, process in job.processes:
+        saved_statuses[process.pid] = job.exit_codes[index]
+    while len(saved_statuses) > SAVED_STATUS_LIMIT:
+        del saved_statuses[next(iter(saved_statuses))]
+    job.cancel_timeout()
+    remove_job(job)
+
+def add_job(job):
+    """Put a job in the job table and return its job id."""
+    global sigchld_installed
+    if not sigchld_installed:
+        signal.signal(signal.SIGCHLD, reap_jobs)
+        sigchld_installed = True
+    job.job_id = max(job_table, default=0) + 1
+    job_table[job.job_id] = job
+    job_order.append(job.job_id)
+    for _, process in job.processes:
+        if process.returncode is None:
+            live_processes[process.pid] = job
+    return job.job_id
+
+def remove_job(job):
+    """Remove a job from the job table."""
+    if job_table.pop(job.job_id, None) is not None:
+        job_order.remove(job.job_id)
+    for pid in job.pids():
+        live_processes.pop(pid, None)
+
+def make_current(job):
+    """Make job the current job (%+)."""
+    job_order.remove(job.job_id)
+    job_order.append(job.job_id)
+
+def find_job(spec=None):
+    """Return the job named by a job spec (%n, %%, %+, %-, %prefix), or None.
+
+    Without a spec, returns the current job.
+    """
+    if spec in (None, "%", "%%", "%+"):
+        return job_table[job_order[-1]] if job_order else None
+    if spec == "%-":
+        return job_table[job_order[-2]] if len(job_order) > 1 else None
+    if not spec.startswith("%"):
+        return None
+    name = spec[1:]
+    if name.isdigit():
+        return job_table.get(int(name))
+    for job_id in reversed(job_order):
+        if job_table[job_id].command.startswith(name):
+            return job_table[job_id]
+    return None
+
+def job_state(job):
+    if job.done():
+        status = job.status()
+        return "Done" if status == 0 else f"Exit {status}"
+    return "Stopped" if job.stopped else "Running"
+
+def format_job(job, show_pids=False):
+    """Format a job the way `jobs` lists it."""
+    if job_order and job.job_id == job_order[-1]:
+        marker = "+"
+    elif len(job_order) > 1 and job.job_id == job_order[-2]:
+        marker = "-"
+    else:
+        marker = " "
+    state = job_state(job)
+    command = job.command + (" &" if state == "Running" else "")
+    pids = " ".join(str(pid) for pid in job.pids()) + " " if show_pids else ""
+    return f"[{job.job_id}]{marker}  {pids}{state:24s}{command}"
+
+def notify_jobs(stream):
+    """Report and forget background jobs that have finished."""
+    reap_jobs()
+    for job in [job for job in job_table.values() if job.done()]:
+        stream.write(format_job(job) + "\n")
+        remove_job(job)
+
+def wait_foreground(job):
+    """Wait for a foreground job and return its exit status.
+
+    The terminal is given back to the shell afterwards. A job stopped with
+    Ctrl-Z is moved to the job table.
+    """
+    job.foreground = True
+    try:
+        finished = job.wait(block=True)
+        if finished:
+            job.cancel_timeout()
+    finally:
+        if job_control and job.pgid is not None:
+            set_foreground(shell_pgid)
+        job.foreground = False
+
+    if not finished:
+        if job.job_id is None:
+            add_job(job)
+        else:
+            make_current(job)
+        sys.stderr.write("\n" + format_job(job) + "\n")
+        return 128 + signal.SIGTSTP
+
+    remove_job(job)
+    return job.status()
+
+def continue_job(job, foreground):
+    """Resume a job in the foreground (returning its status) or the background."""
+    make_current(job)
+    if job.pgid is not None:
+        if foreground and job_control:
+            set_foreground(job.pgid)
+        try:
+            os.killpg(job.pgid, signal.SIGCONT)
+        except ProcessLookupError:
+            pass
+    job.stopped = False
+    if foreground:
+        return wait_foreground(job)
+    return 0
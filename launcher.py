@@ -0,0 +1,122 @@
+import os
+import signal
+import utils
+import redirection
+
+# External commands are started with os.posix_spawn while the posix-spawn
+# option is on, which it is by default where the call exists. The C library
+# then starts the child with vfork or clone and execs it directly, skipping
+# the Python-level work of subprocess.Popen, so the cost of a spawn stays
+# flat as the shell grows. Popen is the fallback.
+if hasattr(os, "posix_spawn"):
+    utils.shell_options.add("posix-spawn")
+
+# Signals Python ignores that a command expects to find at their defaults
+# (Popen resets them with restore_signals)
+DEFAULT_SIGNALS = tuple(getattr(signal, name) for name in ("SIGPIPE", "SIGXFSZ") if hasattr(signal, name))
+
+class SpawnedProcess:
+    """The part of the Popen interface used by the job table, for posix_spawn children."""
+    __slots__ = ("pid", "args", "returncode")
+
+    def __init__(self, pid, args):
+        self.pid = pid
+        self.args = args
+        self.returncode = None
+
+    def poll(self):
+        """Collect the exit status if the process has exited."""
+        if self.returncode is None:
+            try:
+                pid, status = os.waitpid(self.pid, os.WNOHANG)
+            except ChildProcessError:
+                # Reaped elsewhere and the status is lost, as Popen assumes
+                self.returncode = 0
+            else:
+                if pid:
+                    self.returncode = os.waitstatus_to_exitcode(status)
+        return self.returncode
+
+def spawn_posix(argv, path, fd_table, pgid, env):
+    """Start a command with os.posix_spawn, redirecting with dup2 and close file actions."""
+    dups, closes, copies = redirection.child_actions(fd_table) if fd_table else ((), (), ())
+    file_actions = [(os.POSIX_SPAWN_DUP2, source, target) for source, target in dups]
+    file_actions.extend((os.POSIX_SPAWN_CLOSE, fd) for fd in closes)
+    # Other descriptors need no closing: Python opens them close-on-exec
+    try:
+        pid = os.posix_spawn(path, argv, env, file_actions=file_actions,
+                             setsigdef=DEFAULT_SIGNALS, setsigmask=(),
+                             **({} if pgid is None else {"setpgroup": pgid}))
+    finally:
+        redirection.close_fds(*copies)
+    return SpawnedProcess(pid, argv)
+
+def popen_arguments(fd_table):
+    """Return the subprocess.Popen arguments giving a child the descriptors of fd_table.
+
+    Popen itself only sets up 0, 1 and 2; descriptors beyond those, closed
+    ones and the limits set with ulimit are arranged by a preexec_fn in the
+    child. Popen's close_fds is off then, since it would close the targets
+    the preexec_fn has set up: as with posix_spawn, the shell's own
+    descriptors are close-on-exec and the copies made in the child are too.
+    """
+    limits = list(utils.resource_limits.items())
+    if all(fd <= 2 and source != redirection.CLOSED for fd, source in fd_table.items()):
+        arguments = {"stdin": fd_table.get(0), "stdout": fd_table.get(1), "stderr": fd_table.get(2)}
+        table = None
+    else:
+        arguments = {"close_fds": False}
+        table = fd_table
+    if not limits and table is None:
+        return arguments
+    import resource
+
+    def prepare_child():
+        # Runs in the child between fork and exec
+        for number, limit in limits:
+            resource.setrlimit(number, limit)
+        if table is not None:
+            dups, closes, _ = redirection.child_actions(table)
+            for source, target in dups:
+                os.dup2(source, target)
+            for fd in closes:
+                os.close(fd)
+
+    arguments["preexec_fn"] = prepare_child
+    return arguments
+
+def spawn_popen(argv, path, fd_table, pgid, env):
+    """Start a command with subprocess.Popen."""
+    import subprocess
+
+    return subprocess.Popen(
+        argv,
+        executable=path,
+        env=env,
+        process_group=pgid,
+        **popen_arguments(fd_table)
+    )
+
+BACKENDS = {
+    "posix_spawn": spawn_posix,
+    "popen": spawn_popen,
+}
+
+def spawn(argv, path, fd_table, pgid, env=None):
+    """Start an external command and return a Popen-like process object.
+
+    fd_table maps the child's descriptors to the shell's descriptors they
+    copy, or to redirection.CLOSED (see redirection.resolve); others are
+    shared with the shell. pgid is None to stay in the shell's process
+    group, 0 to start a new one, or the group to join. env defaults to the
+    exported shell variables. OSError propagates if the command cannot be
+    executed.
+    """
+    if env is None:
+        env = utils.shell_variables.environ()
+    # posix_spawn cannot set resource limits in the child
+    if "posix-spawn" in utils.shell_options and hasattr(os, "posix_spawn") and not utils.resource_limits:
+        backend = "posix_spawn"
+    else:
+        backend = "popen"
+    return BACKENDS[backend](argv, path, fd_table, pgid, env)
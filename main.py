@@ -1,4 +1,62 @@
-from shell import run_shell
+import sys
+import time
+
+USAGE = ("usage: main.py [--startup-profile] [-c command [name [args ...]] | script [args ...]]\n"
+         "       main.py --server socket\n")
+
+# Modules in dependency order, imported one by one when profiling startup
+SHELL_MODULES = ["utils", "command_hash", "parser", "tracing", "jobs", "builtin", "launcher", "shell"]
+
+def import_shell(profile):
+    """Import the shell, timing each module if profile is a list."""
+    if profile is not None:
+        for name in SHELL_MODULES:
+            start = time.perf_counter()
+            __import__(name)
+            profile.append((f"import {name}", time.perf_counter() - start))
+    import shell
+    return shell
+
+def main(argv):
+    """Run the shell on a -c string, a script file, piped stdin or interactively."""
+    profile = None
+    if argv and argv[0] == "--startup-profile":
+        profile = []
+        argv = argv[1:]
+    
+    shell = import_shell(profile)
+    if argv and argv[0] == "--server":
+        if len(argv) != 2:
+            sys.stderr.write(USAGE)
+            return 2
+        import server
+        return server.serve(argv[1])
+    
+    interactive = not argv and sys.stdin.isatty()
+    if profile is not None and not interactive:
+        shell.report_startup_profile(profile)
+
+    if argv and argv[0] == "-c":
+        if len(argv) < 2:
+            sys.stderr.write("main.py: -c: option requires an argument\n")
+            sys.stderr.write(USAGE)
+            return 2
+        name = argv[2] if len(argv) > 2 else "main.py"
+        return shell.run_script(argv[1].splitlines(), name, argv[3:])
+
+    if argv:
+        try:
+            with open(argv[0]) as script:
+                return shell.run_script(script, argv[0], argv[1:])
+        except (FileNotFoundError, IsADirectoryError, PermissionError) as e:
+            sys.stderr.write(f"main.py: {argv[0]}: {e.strerror}\n")
+            return 127 if isinstance(e, FileNotFoundError) else 126
+
+    if not interactive:
+        # Commands in the script may read the rest of its input
+        return shell.run_script(shell.read_lines(sys.stdin.fileno()))
+
+    return shell.run_shell(profile)
 
 if __name__ == "__main__":
-    run_shell()
\ No newline at end of file
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,145 @@
+import os
+import time
+from collections import OrderedDict
+import utils
+
+# Results of commands run through the `cache` builtin. The key covers
+# everything the output is assumed to depend on: the arguments, the working
+# directory, chosen variables (PATH always) and the mtime and size of chosen
+# dependency files. Entries are kept in memory up to utils.output_cache_size
+# bytes, least recently used first, and optionally in utils.output_cache_dir.
+
+# key -> (created, status, stdout, stderr)
+entries = OrderedDict()
+cached_bytes = 0
+hits = 0
+disk_hits = 0
+misses = 0
+evictions = 0
+
+def make_key(argv, dependencies=(), variables=()):
+    """Return the cache key for running argv now."""
+    files = []
+    for path in dependencies:
+        path = os.path.abspath(path)
+        try:
+            stat = os.stat(path)
+            files.append((path, stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            # A missing file is a state too; creating it changes the key
+            files.append((path, None, None))
+    names = ("PATH",) + tuple(name for name in variables if name != "PATH")
+    return (tuple(argv), os.getcwd(), tuple((name, utils.shell_variables.get(name)) for name in names), tuple(files))
+
+def entry_size(entry):
+    return len(entry[2]) + len(entry[3])
+
+def disk_path(key):
+    import hashlib
+    return os.path.join(utils.output_cache_dir, hashlib.sha256(repr(key).encode(errors="surrogateescape")).hexdigest())
+
+def load_from_disk(key):
+    """Return the entry stored on disk for key, or None."""
+    import pickle
+    try:
+        with open(disk_path(key), "rb") as f:
+            stored_key, entry = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+        return None
+    return entry if stored_key == key else None
+
+def save_to_disk(key, entry):
+    """Write an entry to the disk store; failures only cost the caching."""
+    import pickle
+    path = disk_path(key)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(utils.output_cache_dir, mode=0o700, exist_ok=True)
+        with open(temp_path, "wb") as f:
+            pickle.dump((key, entry), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+    except OSError:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+
+def remember(key, entry):
+    """Put an entry in the memory cache, evicting the least recently used ones."""
+    global cached_bytes, evictions
+    size = entry_size(entry)
+    if size > utils.output_cache_size:
+        return
+    old = entries.pop(key, None)
+    if old is not None:
+        cached_bytes -= entry_size(old)
+    entries[key] = entry
+    cached_bytes += size
+    while cached_bytes > utils.output_cache_size:
+        _, evicted = entries.popitem(last=False)
+        cached_bytes -= entry_size(evicted)
+        evictions += 1
+
+def lookup(key, ttl=None, disk=False):
+    """Return the cached (created, status, stdout, stderr) for key, or None.
+
+    Entries older than ttl seconds are ignored. With disk, the disk store is
+    consulted when the entry is not in memory.
+    """
+    global hits, disk_hits, misses
+    entry = entries.get(key)
+    from_disk = False
+    if entry is None and disk:
+        entry = load_from_disk(key)
+        from_disk = entry is not None
+    if entry is not None and (ttl is None or time.time() - entry[0] <= ttl):
+        hits += 1
+        if from_disk:
+            disk_hits += 1
+            remember(key, entry)
+        else:
+            entries.move_to_end(key)
+        return entry
+    misses += 1
+    return None
+
+def store(key, status, stdout, stderr, disk=False):
+    """Cache the result of a command and return its entry."""
+    entry = (time.time(), status, stdout, stderr)
+    remember(key, entry)
+    if disk:
+        save_to_disk(key, entry)
+    return entry
+
+def invalidate(argv=None):
+    """Forget the cached results of argv, or of every command. Returns how many were dropped."""
+    global cached_bytes
+    dropped = 0
+    for key in list(entries):
+        if argv is None or key[0] == tuple(argv):
+            cached_bytes -= entry_size(entries.pop(key))
+            dropped += 1
+
+    import pickle
+    try:
+        names = os.listdir(utils.output_cache_dir)
+    except OSError:
+        return dropped
+    for name in names:
+        path = os.path.join(utils.output_cache_dir, name)
+        try:
+            if argv is not None:
+                with open(path, "rb") as f:
+                    stored_key, _ = pickle.load(f)
+                if stored_key[0] != tuple(argv):
+                    continue
+            os.unlink(path)
+            dropped += 1
+        except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+            continue
+    return dropped
+
+def statistics():
+    """Return a one-line summary of the cache counters."""
+    return (f"{hits} hits ({disk_hits} from disk), {misses} misses, {len(entries)} entries, "
+            f"{cached_bytes / 1024:.1f} KiB in memory, {evictions} evictions")
@@ -1,6 +1,626 @@
 import os
 import re
-from utils import shell_variables, last_exit_code
+from collections import namedtuple
+from functools import lru_cache
+import utils
+import pathexpand
+from utils import parse_cache_size
+
+class ParseError(ValueError):
+    """Raised when an input line is not valid shell syntax."""
+
+class IncompleteInput(ParseError):
+    """Raised when input ends inside a construct that more lines could complete."""
+
+# AST nodes are namedtuples rather than dataclasses: they are just as
+# immutable and importing dataclasses would double the shell's startup time.
+
+class WordPart(namedtuple("WordPart", "text quote is_variable", defaults=("", False))):
+    """A piece of a word with the quoting it appeared in.
+
+    quote is "" for unquoted text, "'" for single-quoted or backslash-escaped
+    text and '"' for double-quoted text. For variables, text is the name.
+    """
+    __slots__ = ()
+
+# static is the word's text if it expands to exactly that text, as one
+# field, whatever the variables; it is worked out once when the word is
+# parsed, so expanding a command skips such words entirely
+Word = namedtuple("Word", "parts static", defaults=(None,))
+Redirection = namedtuple("Redirection", "fd op target")
+# An expanded command: args and assignments are strings, redirections a list
+# of RedirectActions to apply in order (see redirection.resolve)
+Stage = namedtuple("Stage", "args redirections assignments")
+# action is "open" (target is (path, mode)), "dup" (target is the fd to
+# copy), "close" (target is None) or "string" (target is the text to read)
+RedirectAction = namedtuple("RedirectAction", "action fd target")
+# assignments are the leading NAME=value words, as (name, value Word) pairs
+Command = namedtuple("Command", "words redirections assignments", defaults=((),))
+# commands are Commands and Compounds, or a single FunctionDef. timed is None,
+# or "default" / "posix" for a pipeline prefixed with `time` / `time -p`;
+# timeout is None, or the Words of the options and duration of a `timeout`
+# prefix; negated is set for a pipeline prefixed with `!`
+Pipeline = namedtuple("Pipeline", "commands background timed timeout negated", defaults=(False, None, None, False))
+# Pipelines joined by && and ||: rest holds ("&&" or "||", Pipeline) pairs
+AndOr = namedtuple("AndOr", "first rest")
+# AndOrs run one after the other, as separated by ; or newlines
+CommandList = namedtuple("CommandList", "items")
+# A compound command (If, For, While or Group) and its redirections
+Compound = namedtuple("Compound", "body redirections")
+# clauses are (condition, body) CommandList pairs for the if and each elif;
+# orelse is the else CommandList or None
+If = namedtuple("If", "clauses orelse")
+# words is None to loop over the positional parameters
+For = namedtuple("For", "name words body")
+# until is set for an until loop, which runs while the condition fails
+While = namedtuple("While", "condition body until")
+Group = namedtuple("Group", "body")
+# body is a Compound
+FunctionDef = namedtuple("FunctionDef", "name body")
+
+# Characters that end an unquoted word
+WORD_BREAK = frozenset(" \t\n|&;()<>")
+PLAIN_RE = re.compile(r"[^\s|&;()<>'\"\\$]+")
+DOUBLE_QUOTED_RE = re.compile(r'[^"\\$]+')
+NAME_RE = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+ASSIGNMENT_RE = re.compile(r"([A-Za-z_][A-Za-z0-9_]*)=")
+IO_NUMBER_RE = re.compile(r"(\d+)(?=[<>])")
+SPECIAL_PARAMETERS = frozenset("$?!#@*-0123456789")
+DOUBLE_QUOTE_ESCAPES = frozenset('$"\\')
+# Redirection operators, longest first so that a prefix never shadows one
+REDIRECTION_OPERATORS = ("<<<", "&>>", "<<", "<&", "<>", ">>", ">&", ">|", "&>", "<", ">")
+FILE_MODES = {"<": "r", ">": "w", ">|": "w", ">>": "a", "<>": "rw"}
+GLOB_CHARS = pathexpand.GLOB_CHARS
+# Words that are reserved, when unquoted, where a command may start
+RESERVED_WORDS = frozenset(("!", "{", "}", "if", "then", "elif", "else", "fi",
+                            "for", "in", "do", "done", "while", "until"))
+# Reserved words that start a compound command
+COMPOUND_WORDS = frozenset(("{", "if", "for", "while", "until"))
+# Tokens that end a command
+COMMAND_ENDS = frozenset(("end", "semicolon", "newline"))
+# Resource usage of the last accounted pipeline, see expand_parameter
+RESOURCE_PARAMETERS = {"TIME_REAL": "real", "TIME_USER": "user", "TIME_SYS": "sys", "TIME_MAXRSS": "maxrss"}
+
+def read_parameter(line, i):
+    """Read a parameter reference starting at the '$' at line[i].
+
+    Returns (name, end) or (None, i) if the '$' is a literal dollar sign.
+    """
+    n = len(line)
+    if i + 1 >= n:
+        return None, i
+    char = line[i + 1]
+    if char == "{":
+        end = line.find("}", i + 2)
+        if end == -1:
+            raise ParseError("unterminated ${")
+        name = line[i + 2:end]
+        if not name:
+            raise ParseError("${}: bad substitution")
+        return name, end + 1
+    if char in SPECIAL_PARAMETERS:
+        return char, i + 2
+    match = NAME_RE.match(line, i + 1)
+    if match:
+        return match.group(), match.end()
+    return None, i
+
+def read_double_quoted(line, i, parts):
+    """Read double-quoted text starting after the opening quote at line[i - 1]."""
+    n = len(line)
+    start = len(parts)
+    buf = []
+    while True:
+        if i >= n:
+            raise IncompleteInput("unterminated double quote")
+        char = line[i]
+        if char == '"':
+            break
+        if char == "\\":
+            if line.startswith("\n", i + 1):
+                # A line continuation
+                i += 2
+            elif i + 1 < n and line[i + 1] in DOUBLE_QUOTE_ESCAPES:
+                buf.append(line[i + 1])
+                i += 2
+            else:
+                buf.append(char)
+                i += 1
+        elif char == "$":
+            name, end = read_parameter(line, i)
+            if name is None:
+                buf.append(char)
+                i += 1
+            else:
+                if buf:
+                    parts.append(WordPart("".join(buf), '"'))
+                    buf = []
+                parts.append(WordPart(name, '"', True))
+                i = end
+        else:
+            match = DOUBLE_QUOTED_RE.match(line, i)
+            buf.append(match.group())
+            i = match.end()
+    # Always emit a part so that "" yields an empty argument
+    if buf or len(parts) == start:
+        parts.append(WordPart("".join(buf), '"'))
+    return i + 1
+
+def read_word(line, i):
+    """Read one word starting at line[i] and return (Word, end)."""
+    n = len(line)
+    parts = []
+    buf = []
+    while i < n:
+        char = line[i]
+        if char in WORD_BREAK:
+            break
+        if char == "'":
+            end = line.find("'", i + 1)
+            if end == -1:
+                raise IncompleteInput("unterminated single quote")
+            if buf:
+                parts.append(WordPart("".join(buf)))
+                buf = []
+            parts.append(WordPart(line[i + 1:end], "'"))
+            i = end + 1
+        elif char == '"':
+            if buf:
+                parts.append(WordPart("".join(buf)))
+                buf = []
+            i = read_double_quoted(line, i + 1, parts)
+        elif char == "\\":
+            if i + 1 >= n:
+                raise IncompleteInput("unexpected end of input after \\")
+            if line[i + 1] == "\n":
+                # A line continuation joins the lines
+                i += 2
+                continue
+            if buf:
+                parts.append(WordPart("".join(buf)))
+                buf = []
+            parts.append(WordPart(line[i + 1], "'"))
+            i += 2
+        elif char == "$":
+            name, end = read_parameter(line, i)
+            if name is None:
+                buf.append(char)
+                i += 1
+            else:
+                if buf:
+                    parts.append(WordPart("".join(buf)))
+                    buf = []
+                parts.append(WordPart(name, "", True))
+                i = end
+        else:
+            match = PLAIN_RE.match(line, i)
+            buf.append(match.group())
+            i = match.end()
+    if buf:
+        parts.append(WordPart("".join(buf)))
+    return make_word(tuple(parts)), i
+
+def make_word(parts):
+    """Build a Word from its parts, noting its text if it needs no expansion."""
+    static = None
+    if parts and not any(part.is_variable or (not part.quote and not GLOB_CHARS.isdisjoint(part.text))
+                         for part in parts):
+        if parts[0].quote or not parts[0].text.startswith("~"):
+            static = "".join(part.text for part in parts)
+    return Word(parts, static)
+
+TIME_KEYWORD = make_word((WordPart("time"),))
+TIME_POSIX_OPTION = make_word((WordPart("-p"),))
+TIMEOUT_KEYWORD = make_word((WordPart("timeout"),))
+# Options of GNU timeout that the `timeout` prefix supports, short -> long form
+TIMEOUT_OPTIONS = {"-k": "--kill-after", "-s": "--signal"}
+
+def split_timeout_option(text):
+    """Split an option of the `timeout` prefix into (short option, attached value or None).
+
+    -k 5, -k5, --kill-after 5 and --kill-after=5 are accepted, and likewise
+    for -s and --signal. Returns None for other options.
+    """
+    for short, long in TIMEOUT_OPTIONS.items():
+        if text in (short, long):
+            return short, None
+        if text.startswith(long + "="):
+            return short, text[len(long) + 1:]
+        if text.startswith(short) and not text.startswith("--"):
+            return short, text[len(short):]
+    return None
+
+# Operators that are tokens of their own, longest first
+OPERATORS = (("&&", "and"), ("||", "or"), ("|", "pipe"), (";", "semicolon"),
+             ("\n", "newline"), ("(", "lparen"), (")", "rparen"))
+
+def tokenize(line):
+    """Split input into words and operators in a single pass.
+
+    Returns a list of (kind, value) pairs where kind is "word" (value is a
+    Word), "redirect" (value is an (fd, op) pair), "background", or the
+    kind of an operator in OPERATORS (value is its text).
+    """
+    tokens = []
+    n = len(line)
+    i = 0
+    while i < n:
+        char = line[i]
+        if char in " \t":
+            i += 1
+        elif char == "#":
+            # A comment runs to the end of the line
+            end = line.find("\n", i)
+            i = n if end == -1 else end
+        elif line.startswith("\\\n", i):
+            i += 2
+        elif char in "|;\n()" or line.startswith("&&", i):
+            op, kind = next(operator for operator in OPERATORS if line.startswith(operator[0], i))
+            tokens.append((kind, op))
+            i += len(op)
+        elif char == "&" and not line.startswith("&>", i):
+            tokens.append(("background", "&"))
+            i += 1
+        elif char in "<>&" or (char.isdigit() and IO_NUMBER_RE.match(line, i)):
+            fd = None
+            match = IO_NUMBER_RE.match(line, i)
+            if match:
+                fd = int(match.group(1))
+                i = match.end()
+            op = next(op for op in REDIRECTION_OPERATORS if line.startswith(op, i))
+            i += len(op)
+            if fd is None:
+                fd = 0 if op[0] == "<" else 1
+            tokens.append(("redirect", (fd, op)))
+        else:
+            word, i = read_word(line, i)
+            tokens.append(("word", word))
+    return tokens
+
+def split_assignment(word):
+    """Return (name, value Word) if word is an assignment, else None.
+
+    The name and the '=' must be unquoted.
+    """
+    first = word.parts[0] if word.parts else None
+    if first is None or first.quote or first.is_variable:
+        return None
+    match = ASSIGNMENT_RE.match(first.text)
+    if match is None:
+        return None
+    rest = first.text[match.end():]
+    return match.group(1), make_word(((WordPart(rest),) if rest else ()) + word.parts[1:])
+
+def expand_brace_words(word):
+    """Apply brace expansion to a Word, returning the Words it stands for.
+
+    Braces are expanded within a piece of unquoted text; a brace expression
+    that spans quotes or a variable is left as it is.
+    """
+    for index, part in enumerate(word.parts):
+        if part.quote or part.is_variable or "{" not in part.text:
+            continue
+        texts = pathexpand.expand_braces(part.text)
+        if len(texts) == 1:
+            continue
+        head = word.parts[:index]
+        words = []
+        for tail in expand_brace_words(Word(word.parts[index + 1:])):
+            for text in texts:
+                words.append(make_word(head + ((WordPart(text),) if text else ()) + tail.parts))
+        return words
+    return [word]
+
+def reserved_word(word):
+    """Return the text of a Word if it is an unquoted reserved word, else None."""
+    if word.static in RESERVED_WORDS and len(word.parts) == 1 and not word.parts[0].quote:
+        return word.static
+    return None
+
+def token_text(token):
+    """Return a token as it is shown in syntax errors."""
+    kind, value = token
+    if kind == "word":
+        return "".join("$" + part.text if part.is_variable else part.text for part in value.parts)
+    if kind == "redirect":
+        return value[1]
+    return "newline" if kind == "newline" else value
+
+class Parser:
+    """A recursive-descent parser over the tokens of one input.
+
+    The grammar is a subset of the POSIX shell's:
+
+        list      and_or ((';' | '&' | newline) and_or)*
+        and_or    pipeline (('&&' | '||') newline* pipeline)*
+        pipeline  ['time' ['-p']] ['!'] ['timeout' ...] command ('|' newline* command)*
+        command   simple command | compound redirection* | NAME '(' ')' newline* compound
+        compound  '{' list '}' | if | for | while | until
+
+    Running out of tokens where more are needed raises IncompleteInput.
+    """
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self):
+        """Return the current token, or ("end", None) after the last one."""
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return ("end", None)
+
+    def advance(self):
+        token = self.peek()
+        self.position += 1
+        return token
+
+    def reserved(self):
+        """Return the current token's text if it is a reserved word, else None."""
+        kind, value = self.peek()
+        return reserved_word(value) if kind == "word" else None
+
+    def skip_newlines(self):
+        while self.peek()[0] == "newline":
+            self.position += 1
+
+    def unexpected(self):
+        """Return the error to raise for the current token."""
+        if self.peek()[0] == "end":
+            return IncompleteInput("syntax error: unexpected end of input")
+        return ParseError(f"syntax error near unexpected token `{token_text(self.peek())}'")
+
+    def expect(self, word):
+        """Consume the reserved word, which must come next."""
+        if self.reserved() != word:
+            raise self.unexpected()
+        self.position += 1
+
+    def parse_program(self):
+        items = self.parse_list()
+        if self.peek()[0] != "end":
+            raise self.unexpected()
+        return CommandList(items) if items else None
+
+    def parse_list(self, terminators=frozenset()):
+        """Parse AndOrs up to the end of the input or a reserved word in terminators."""
+        items = []
+        while True:
+            self.skip_newlines()
+            if self.peek()[0] == "end" or self.reserved() in terminators:
+                return tuple(items)
+            and_or = self.parse_and_or()
+            kind = self.peek()[0]
+            if kind == "background":
+                self.position += 1
+                and_or = run_in_background(and_or)
+            elif kind in ("semicolon", "newline"):
+                self.position += 1
+            elif kind != "end" and self.reserved() not in terminators:
+                raise self.unexpected()
+            items.append(and_or)
+
+    def parse_compound_list(self, terminators):
+        """Parse the non-empty list of a compound command."""
+        items = self.parse_list(terminators)
+        if not items:
+            raise self.unexpected()
+        return CommandList(items)
+
+    def parse_and_or(self):
+        first = self.parse_pipeline()
+        rest = []
+        while self.peek()[0] in ("and", "or"):
+            op = self.advance()[1]
+            self.skip_newlines()
+            rest.append((op, self.parse_pipeline()))
+        return AndOr(first, tuple(rest))
+
+    def parse_pipeline(self):
+        # `time` is a reserved word only at the start of a pipeline and unquoted
+        timed = None
+        if self.peek() == ("word", TIME_KEYWORD):
+            self.position += 1
+            timed = "default"
+            if self.peek() == ("word", TIME_POSIX_OPTION):
+                self.position += 1
+                timed = "posix"
+            if self.peek()[0] in COMMAND_ENDS:
+                return Pipeline((), False, timed)
+
+        negated = self.reserved() == "!"
+        if negated:
+            self.position += 1
+        timeout = self.parse_timeout()
+
+        commands = [self.parse_command()]
+        while self.peek()[0] == "pipe":
+            self.position += 1
+            self.skip_newlines()
+            commands.append(self.parse_command())
+        if (len(commands) > 1 or timed or timeout) and any(isinstance(command, FunctionDef) for command in commands):
+            raise ParseError("a function definition cannot be part of a pipeline")
+        return Pipeline(tuple(commands), False, timed, timeout, negated)
+
+    def parse_timeout(self):
+        """Parse a `timeout` prefix, which applies to the whole pipeline; returns its Words or None.
+
+        With options the prefix does not support, such as --foreground, or
+        without a duration and command, `timeout` is left to run as the
+        external command.
+        """
+        if self.peek() != ("word", TIMEOUT_KEYWORD):
+            return None
+        tokens = self.tokens
+        start = self.position + 1
+        end = start
+        while end < len(tokens) and tokens[end][0] == "word":
+            text = tokens[end][1].static
+            if text == "--":
+                end += 1
+                break
+            if text is None or len(text) < 2 or not text.startswith("-"):
+                break
+            option = split_timeout_option(text)
+            if option is None:
+                return None
+            end += 2 if option[1] is None else 1
+        end += 1
+        if end >= len(tokens) or any(kind != "word" for kind, _ in tokens[start:end + 1]):
+            return None
+        self.position = end
+        return tuple(word for _, word in tokens[start:end])
+
+    def parse_command(self):
+        word = self.reserved()
+        if word == "if":
+            body = self.parse_if()
+        elif word == "for":
+            body = self.parse_for()
+        elif word in ("while", "until"):
+            body = self.parse_while()
+        elif word == "{":
+            body = self.parse_group()
+        elif word is not None:
+            raise self.unexpected()
+        elif (self.peek()[0] == "word"
+              and self.tokens[self.position + 1:self.position + 3] == [("lparen", "("), ("rparen", ")")]):
+            return self.parse_function()
+        else:
+            return self.parse_simple_command()
+        redirections = []
+        while self.peek()[0] == "redirect":
+            redirections.append(self.parse_redirection())
+        return Compound(body, tuple(redirections))
+
+    def parse_simple_command(self):
+        words = []
+        redirections = []
+        assignments = []
+        while True:
+            kind, value = self.peek()
+            if kind == "redirect":
+                redirections.append(self.parse_redirection())
+                continue
+            if kind != "word":
+                break
+            assignment = None if words else split_assignment(value)
+            if assignment is None:
+                # Brace expansion is purely textual, so it is done once here
+                words.extend(expand_brace_words(value))
+            else:
+                assignments.append(assignment)
+            self.position += 1
+        if not words and not redirections and not assignments:
+            raise self.unexpected()
+        return Command(tuple(words), tuple(redirections), tuple(assignments))
+
+    def parse_redirection(self):
+        fd, op = self.advance()[1]
+        if op == "<<":
+            raise ParseError("here-documents are not supported")
+        kind, target = self.peek()
+        if kind != "word":
+            raise ParseError(f"missing file for {op}")
+        self.position += 1
+        return Redirection(fd, op, target)
+
+    def parse_if(self):
+        self.expect("if")
+        clauses = []
+        while True:
+            condition = self.parse_compound_list({"then"})
+            self.expect("then")
+            clauses.append((condition, self.parse_compound_list({"elif", "else", "fi"})))
+            if self.reserved() != "elif":
+                break
+            self.position += 1
+        orelse = None
+        if self.reserved() == "else":
+            self.position += 1
+            orelse = self.parse_compound_list({"fi"})
+        self.expect("fi")
+        return If(tuple(clauses), orelse)
+
+    def parse_for(self):
+        self.expect("for")
+        kind, value = self.peek()
+        if kind != "word":
+            raise self.unexpected()
+        if value.static is None or not NAME_RE.fullmatch(value.static):
+            raise ParseError(f"`{token_text(self.peek())}': not a valid identifier")
+        self.position += 1
+        name = value.static
+        self.skip_newlines()
+        words = None
+        if self.reserved() == "in":
+            self.position += 1
+            words = []
+            while self.peek()[0] == "word":
+                words.extend(expand_brace_words(self.advance()[1]))
+            words = tuple(words)
+            if self.peek()[0] not in ("semicolon", "newline"):
+                raise self.unexpected()
+            self.position += 1
+        elif self.peek()[0] == "semicolon":
+            self.position += 1
+        self.skip_newlines()
+        self.expect("do")
+        body = self.parse_compound_list({"done"})
+        self.expect("done")
+        return For(name, words, body)
+
+    def parse_while(self):
+        until = self.advance()[1].static == "until"
+        condition = self.parse_compound_list({"do"})
+        self.expect("do")
+        body = self.parse_compound_list({"done"})
+        self.expect("done")
+        return While(condition, body, until)
+
+    def parse_group(self):
+        self.expect("{")
+        body = self.parse_compound_list({"}"})
+        self.expect("}")
+        return Group(body)
+
+    def parse_function(self):
+        name = self.advance()[1].static
+        if name is None or "=" in name or "/" in name:
+            raise ParseError(f"`{token_text(self.tokens[self.position - 1])}': not a valid function name")
+        self.position += 2
+        self.skip_newlines()
+        if self.reserved() not in COMPOUND_WORDS:
+            raise self.unexpected()
+        return FunctionDef(name, self.parse_command())
+
+def run_in_background(and_or):
+    """Return an AndOr ended by &, with its pipeline marked to run in the background.
+
+    Several pipelines joined by && or || run as one group in the background.
+    """
+    if and_or.rest:
+        group = Compound(Group(CommandList((and_or,))), ())
+        return AndOr(Pipeline((group,), True), ())
+    if any(isinstance(command, FunctionDef) for command in and_or.first.commands):
+        raise ParseError("a function definition cannot run in the background")
+    return AndOr(and_or.first._replace(background=True), ())
+
+def parse_tokens(tokens):
+    """Build a CommandList from tokens, or return None if there is no command."""
+    return Parser(tokens).parse_program()
+
+@lru_cache(maxsize=parse_cache_size)
+def parse_line(line):
+    """Parse input, which may span several lines, into an unexpanded CommandList AST.
+
+    Returns None if there is no command, and raises IncompleteInput if the
+    input ends inside a construct that more lines could complete. Results are
+    cached by input, so repeated lines and the body of a loop are lexed once.
+    The AST is immutable and expanded afresh on every execution, apart from
+    the words that need no expansion.
+    """
+    return parse_tokens(tokenize(line))
 
 def expand_tilde(text):
     """Expand tilde in the given text."""
@@ -14,7 +634,7 @@ def expand_tilde(text):
         rest = parts[1] if len(parts) > 1 else ""
         try:
             home_dir = os.path.expanduser(f"~{username}")
-            if home_dir != f"~{username}": 
+            if home_dir != f"~{username}":
                 if rest:
                     return f"{home_dir}/{rest}"
                 return home_dir
@@ -22,146 +642,188 @@ def expand_tilde(text):
             pass
     return text
 
+def expand_parameter(name):
+    """Return the value of a shell parameter."""
+    if name == "$":
+        return str(os.getpid())
+    if name == "?":
+        return str(utils.last_exit_code)
+    if name == "!":
+        return "" if utils.last_background_pid is None else str(utils.last_background_pid)
+    if name.isdigit():
+        index = int(name)
+        return utils.positional_args[index] if index < len(utils.positional_args) else ""
+    if name == "#":
+        return str(len(utils.positional_args) - 1)
+    if name in ("@", "*"):
+        return " ".join(utils.positional_args[1:])
+    if name in RESOURCE_PARAMETERS and name not in utils.shell_variables:
+        return format_resource(RESOURCE_PARAMETERS[name])
+    return utils.shell_variables.get(name, "")
+
+def format_resource(field):
+    """Return a total over the stages of utils.last_resources as a string."""
+    records = utils.last_resources
+    if not records:
+        return ""
+    if field == "maxrss":
+        return str(max(record["maxrss"] or 0 for record in records))
+    if field == "real":
+        return f"{max(record['real'] for record in records):.3f}"
+    return f"{sum(record[field] or 0 for record in records):.3f}"
+
+VARIABLE_RE = re.compile(r"\$(?:\{([^}]+)\}|([A-Za-z_][A-Za-z0-9_]*)|([$?]))")
+
 def expand_variables(text):
     """Expand environment variables in the given text."""
-    global shell_variables, last_exit_code
-    
-    text = text.replace("$$", str(os.getpid()))
-    text = text.replace("$?", str(last_exit_code))
-    
     def replace_var(match):
-        var_name = match.group(1)
-        return shell_variables.get(var_name, "")
-    
-    text = re.sub(r'\${([^}]+)}', replace_var, text)
-    
-    def replace_simple_var(match):
-        var_name = match.group(1)
-        return shell_variables.get(var_name, "")
-    
-    text = re.sub(r'\$([a-zA-Z_][a-zA-Z0-9_]*)', replace_simple_var, text)
-    
-    return text
+        return expand_parameter(match.group(1) or match.group(2) or match.group(3))
 
-def parse_input(input_text):
-    """Parse input with variable expansion respecting quotes."""
-    global shell_variables, last_exit_code
-    
-    result = []
-    current_token = ""
-    i = 0
-    in_single_quote = False
-    in_double_quote = False
-    
-    while i < len(input_text):
-        char = input_text[i]
-        
-        if char == "'" and not in_double_quote:
-            in_single_quote = not in_single_quote
-            i += 1
+    return VARIABLE_RE.sub(replace_var, text)
+
+def finish_field(fields, current, active, magic, listings):
+    """Append the fields a finished word field expands to.
+
+    current holds its pieces of text and active whether each piece was
+    unquoted, so that its glob characters take effect.
+    """
+    if not magic or "noglob" in utils.shell_options:
+        fields.append("".join(current))
+        return
+    pattern = "".join(text if is_active else pathexpand.escape(text) for text, is_active in zip(current, active))
+    fields.extend(pathexpand.expand_pattern(pattern, listings))
+
+def expand_word(word, listings=None):
+    """Expand a Word into a list of fields.
+
+    Unquoted variable values are split on whitespace and may produce zero or
+    several fields; quoted text stays within one field, except that "$@"
+    gives a field per positional parameter. A leading
+    unquoted '~' is tilde-expanded. Fields with unquoted *, ? or [ are
+    replaced by the paths they match, if any, using listings as the
+    directory-listing cache.
+    """
+    if word.static is not None:
+        return [word.static]
+    fields = []
+    current = []
+    active = []
+    magic = False
+    has_field = False
+
+    for index, part in enumerate(word.parts):
+        if not part.is_variable:
+            text = part.text
+            if part.quote:
+                active.append(False)
+            elif index == 0 and text.startswith("~") and ("/" in text or len(word.parts) == 1):
+                text = expand_tilde(text)
+                active.append(False)
+            else:
+                active.append(True)
+                magic = magic or not GLOB_CHARS.isdisjoint(text)
+            current.append(text)
+            has_field = True
             continue
-        elif char == '"' and not in_single_quote:
-            in_double_quote = not in_double_quote
-            i += 1
+
+        if part.quote and part.text == "@":
+            # "$@" is a field per positional parameter, the first and last
+            # joined to the text around them; with none it adds nothing
+            for param_index, param in enumerate(utils.positional_args[1:]):
+                if param_index > 0:
+                    finish_field(fields, current, active, magic, listings)
+                    current, active, magic = [], [], False
+                current.append(param)
+                active.append(False)
+                has_field = True
             continue
-        
-        if char == '\\' and i + 1 < len(input_text):
-            current_token += input_text[i + 1]
-            i += 2
+
+        value = expand_parameter(part.text)
+        if part.quote:
+            current.append(value)
+            active.append(False)
+            has_field = True
             continue
-        
-        if char == '$' and not in_single_quote and i + 1 < len(input_text):
-            if input_text[i + 1] == '{':
-                end_brace = input_text.find('}', i + 2)
-                if end_brace != -1:
-                    var_name = input_text[i + 2:end_brace]
-                    current_token += shell_variables.get(var_name, "")
-                    i = end_brace + 1
-                    continue
-            elif input_text[i + 1] == '$':
-                current_token += str(os.getpid())
-                i += 2
-                continue
-            elif input_text[i + 1] == '?':
-                current_token += str(last_exit_code)
-                i += 2
-                continue
-            else:
-                var_end = i + 1
-                while var_end < len(input_text) and (input_text[var_end].isalnum() or input_text[var_end] == '_'):
-                    var_end += 1
-                if var_end > i + 1:
-                    var_name = input_text[i + 1:var_end]
-                    current_token += shell_variables.get(var_name, "")
-                    i = var_end
-                    continue
-        
-        if char.isspace() and not in_single_quote and not in_double_quote:
-            if current_token:
-                result.append(current_token)
-                current_token = ""
+
+        pieces = value.split()
+        if value[:1].isspace() and has_field:
+            finish_field(fields, current, active, magic, listings)
+            current, active, magic = [], [], False
+            has_field = False
+        for piece_index, piece in enumerate(pieces):
+            if piece_index > 0:
+                finish_field(fields, current, active, magic, listings)
+                current, active, magic = [], [], False
+            current.append(piece)
+            active.append(True)
+            magic = magic or not GLOB_CHARS.isdisjoint(piece)
+            has_field = True
+        if pieces and value[-1:].isspace():
+            finish_field(fields, current, active, magic, listings)
+            current, active, magic = [], [], False
+            has_field = False
+
+    if has_field:
+        finish_field(fields, current, active, magic, listings)
+    return fields
+
+def expand_assignment(word):
+    """Expand the value of an assignment: no field splitting, tilde only at the start."""
+    if word.static is not None:
+        return word.static
+    values = []
+    for index, part in enumerate(word.parts):
+        if part.is_variable:
+            values.append(expand_parameter(part.text))
+        elif index == 0 and not part.quote and part.text.startswith("~"):
+            values.append(expand_tilde(part.text))
         else:
-            current_token += char
-        
-        i += 1
-    
-    if current_token:
-        result.append(current_token)
-    
-    return result
-
-def parse_command_tokens(tokens):
-    """Parse a list of tokens into a command with redirections."""
-    command = []
-    stdout_redirection = None
-    stdout_mode = None
-    stderr_redirection = None
-    stderr_mode = None
-    stdin_redirection = None
-    
-    i = 0
-    while i < len(tokens):
-        if tokens[i] in (">", "1>"):
-            if i + 1 < len(tokens):
-                stdout_redirection = tokens[i + 1]
-                stdout_mode = "w"
-                i += 1
-            else:
-                print("Syntax error: missing file for > or 1>")
-                return None, None, None, None, None, None
-        elif tokens[i] in (">>", "1>>"):
-            if i + 1 < len(tokens):
-                stdout_redirection = tokens[i + 1]
-                stdout_mode = "a"
-                i += 1
-            else:
-                print("Syntax error: missing file for >> or 1>>")
-                return None, None, None, None, None, None
-        elif tokens[i] == "2>":
-            if i + 1 < len(tokens):
-                stderr_redirection = tokens[i + 1]
-                stderr_mode = "w"
-                i += 1
-            else:
-                print("Syntax error: missing file for 2>")
-                return None, None, None, None, None, None
-        elif tokens[i] == "2>>":
-            if i + 1 < len(tokens):
-                stderr_redirection = tokens[i + 1]
-                stderr_mode = "a"
-                i += 1
-            else:
-                print("Syntax error: missing file for 2>>")
-                return None, None, None, None, None, None
-        elif tokens[i] == "<":
-            if i + 1 < len(tokens):
-                stdin_redirection = tokens[i + 1]
-                i += 1
-            else:
-                print("Syntax error: missing file for <")
-                return None, None, None, None, None, None
+            values.append(part.text)
+    return "".join(values)
+
+def expand_redirection(redirection, listings):
+    """Expand a Redirection into the RedirectActions it stands for."""
+    fd, op, word = redirection
+    if op == "<<<":
+        # A here-string is not split or globbed, and ends with a newline
+        return [RedirectAction("string", fd, expand_assignment(word) + "\n")]
+    targets = expand_word(word, listings)
+    if len(targets) != 1:
+        raise ValueError("ambiguous redirect")
+    target = targets[0]
+    if op in ("<&", ">&"):
+        if target == "-":
+            return [RedirectAction("close", fd, None)]
+        if target.isdigit():
+            return [RedirectAction("dup", fd, int(target))]
+        if op == "<&" or fd != 1:
+            raise ValueError(f"{target}: ambiguous redirect")
+        # >&file is &>file
+        op = "&>"
+    if op in ("&>", "&>>"):
+        return [RedirectAction("open", 1, (target, "a" if op == "&>>" else "w")),
+                RedirectAction("dup", 2, 1)]
+    return [RedirectAction("open", fd, (target, FILE_MODES[op]))]
+
+def expand_command(command, listings=None):
+    """Expand a Command into a Stage of arguments, redirect actions and assignments.
+
+    listings is the directory-listing cache for pathname expansion, shared by
+    the commands of one line; by default the command has its own.
+    Assignments are (name, value) pairs.
+    """
+    if listings is None:
+        listings = {}
+    args = []
+    for word in command.words:
+        if word.static is not None:
+            args.append(word.static)
         else:
-            command.append(tokens[i])
-        i += 1
-    
-    return command, stdout_redirection, stdout_mode, stderr_redirection, stderr_mode, stdin_redirection
\ No newline at end of file
+            args.extend(expand_word(word, listings))
+
+    redirections = []
+    for redirection in command.redirections:
+        redirections.extend(expand_redirection(redirection, listings))
+
+    assignments = [(name, expand_assignment(value)) for name, value in command.assignments]
+    return Stage(args, redirections, assignments)
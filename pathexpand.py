@@ -0,0 +1,241 @@
+import os
+import re
+from functools import lru_cache
+
+# Pathname and brace expansion. Patterns are matched one path component at a
+# time against directory listings from os.scandir, whose entries carry the
+# file type from the directory itself (d_type), so only symlinks cost a stat.
+# A listing is kept in a dict passed in by the caller for the duration of one
+# command line, so several patterns over the same directory scan it once.
+#
+# Patterns reach this module with the characters that were quoted escaped by
+# a backslash (see escape), so "*.log" and \*.log stay literal.
+
+GLOB_CHARS = frozenset("*?[")
+ESCAPE_TABLE = str.maketrans({char: "\\" + char for char in "\\*?["})
+UNESCAPE_RE = re.compile(r"\\(.)", re.DOTALL)
+SEQUENCE_RE = re.compile(r"(-?\d+|[A-Za-z])\.\.(-?\d+|[A-Za-z])(?:\.\.(-?\d+))?\Z")
+# Characters that are special inside a Python character class
+CLASS_SPECIAL = frozenset("\\[]^&~|")
+
+def escape(text):
+    """Make text match only itself when used as a pattern."""
+    return text.translate(ESCAPE_TABLE)
+
+def unescape(pattern):
+    """Remove the escapes from a pattern, giving the text it stands for."""
+    return UNESCAPE_RE.sub(r"\1", pattern) if "\\" in pattern else pattern
+
+def has_magic(pattern):
+    """Whether a pattern has an unescaped *, ? or [."""
+    escaped = False
+    for char in pattern:
+        if escaped:
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif char in GLOB_CHARS:
+            return True
+    return False
+
+@lru_cache(maxsize=256)
+def compile_segment(segment):
+    """Compile one path component of a pattern into a match function."""
+    out = []
+    i = 0
+    n = len(segment)
+    while i < n:
+        char = segment[i]
+        if char == "\\" and i + 1 < n:
+            out.append(re.escape(segment[i + 1]))
+            i += 2
+        elif char == "*":
+            if not out or out[-1] != ".*":
+                out.append(".*")
+            i += 1
+        elif char == "?":
+            out.append(".")
+            i += 1
+        elif char == "[":
+            end = i + 1
+            if end < n and segment[end] in "!^":
+                end += 1
+            # A ] right after the opening bracket is part of the set
+            if end < n and segment[end] == "]":
+                end += 1
+            while end < n and segment[end] != "]":
+                end += 2 if segment[end] == "\\" else 1
+            if end >= n:
+                out.append(re.escape(char))
+                i += 1
+                continue
+            body = segment[i + 1:end]
+            negate = body[:1] in ("!", "^")
+            if negate:
+                body = body[1:]
+            members = []
+            j = 0
+            while j < len(body):
+                member = body[j]
+                if member == "\\" and j + 1 < len(body):
+                    j += 1
+                    member = body[j]
+                members.append("\\" + member if member in CLASS_SPECIAL else member)
+                j += 1
+            out.append("[" + ("^" if negate else "") + "".join(members) + "]")
+            i = end + 1
+        else:
+            out.append(re.escape(char))
+            i += 1
+    return re.compile("(?s:" + "".join(out) + r")\Z").match
+
+def list_directory(path, listings):
+    """Return the (name, is_dir) entries of a directory, or () if it cannot be read."""
+    entries = listings.get(path)
+    if entries is None:
+        try:
+            with os.scandir(path) as it:
+                entries = []
+                for entry in it:
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        is_dir = False
+                    entries.append((entry.name, is_dir))
+        except OSError:
+            entries = ()
+        listings[path] = entries
+    return entries
+
+def walk_directories(prefix, listings):
+    """Yield prefix and every directory below it, skipping hidden ones and symlinks."""
+    yield prefix
+    for name, is_dir in list_directory(prefix or ".", listings):
+        if is_dir and not name.startswith(".") and not os.path.islink(prefix + name):
+            yield from walk_directories(prefix + name + "/", listings)
+
+def match_segments(prefix, segments, listings):
+    """Yield the paths under prefix matching the remaining path components."""
+    segment = segments[0]
+    rest = segments[1:]
+    if segment == "":
+        # A trailing slash: only directories matched so far
+        if not rest:
+            yield prefix
+        else:
+            yield from match_segments(prefix, rest, listings)
+        return
+
+    if segment == "**":
+        for directory in walk_directories(prefix, listings):
+            if rest:
+                yield from match_segments(directory, rest, listings)
+            else:
+                if directory != prefix:
+                    yield directory[:-1]
+                for name, is_dir in list_directory(directory or ".", listings):
+                    if not name.startswith(".") and not is_dir:
+                        yield directory + name
+        return
+
+    if not has_magic(segment):
+        name = unescape(segment)
+        if rest:
+            yield from match_segments(prefix + name + "/", rest, listings)
+        elif os.path.lexists(prefix + name):
+            yield prefix + name
+        return
+
+    match = compile_segment(segment)
+    # Hidden files only match a pattern that starts with a literal dot
+    hidden = segment.startswith(".") or segment.startswith("\\.")
+    for name, is_dir in list_directory(prefix or ".", listings):
+        if name.startswith(".") and not hidden:
+            continue
+        if not match(name):
+            continue
+        if not rest:
+            yield prefix + name
+        elif is_dir:
+            yield from match_segments(prefix + name + "/", rest, listings)
+
+def iglob(pattern, listings=None):
+    """Yield the paths matching pattern, in directory order, as they are found.
+
+    A ** component matches any number of directories. listings is the
+    directory-listing cache to use; by default every call has its own.
+    """
+    if listings is None:
+        listings = {}
+    prefix = ""
+    if pattern.startswith("/"):
+        prefix = "/"
+        pattern = pattern.lstrip("/")
+    segments = [segment for index, segment in enumerate(pattern.split("/"))
+                if segment or index == pattern.count("/")]
+    if segments:
+        yield from match_segments(prefix, segments, listings)
+
+def expand_pattern(pattern, listings=None):
+    """Return the sorted paths matching a pattern, or the pattern's text if none match."""
+    if not has_magic(pattern):
+        return [unescape(pattern)]
+    matches = sorted(iglob(pattern, listings))
+    return matches or [unescape(pattern)]
+
+def expand_sequence(match):
+    """Return the items of a {first..last[..step]} sequence."""
+    first, last, step = match.groups()
+    step = abs(int(step)) if step and int(step) else 1
+    if first.lstrip("-").isdigit() and last.lstrip("-").isdigit():
+        start, end = int(first), int(last)
+        # {01..10} pads every item to the longest width
+        padded = any(len(bound.lstrip("-")) > 1 and bound.lstrip("-").startswith("0") for bound in (first, last))
+        width = max(len(first), len(last)) if padded else 0
+        numbers = range(start, end + 1, step) if start <= end else range(start, end - 1, -step)
+        return [f"{number:0{width}d}" for number in numbers]
+    if first.isalpha() and last.isalpha():
+        start, end = ord(first), ord(last)
+        codes = range(start, end + 1, step) if start <= end else range(start, end - 1, -step)
+        return [chr(code) for code in codes]
+    return None
+
+def expand_braces(text):
+    """Expand the first {a,b} or {x..y} in text, recursively. Returns a list of strings.
+
+    Braces without a top-level comma or a valid sequence are left alone, so
+    {} and ${name} pass through unchanged.
+    """
+    if "{" not in text:
+        return [text]
+    start = text.find("{")
+    while start != -1:
+        depth = 0
+        commas = []
+        end = start
+        while end < len(text):
+            char = text[end]
+            if char == "\\":
+                end += 1
+            elif char == "{":
+                depth += 1
+            elif char == "}":
+                depth -= 1
+                if depth == 0:
+                    break
+            elif char == "," and depth == 1:
+                commas.append(end)
+            end += 1
+        if end >= len(text):
+            return [text]
+        prefix, suffix = text[:start], text[end + 1:]
+        if commas:
+            bounds = [start] + commas + [end]
+            items = [text[bounds[k] + 1:bounds[k + 1]] for k in range(len(bounds) - 1)]
+        else:
+            match = SEQUENCE_RE.match(text, start + 1, end)
+            items = expand_sequence(match) if match else None
+        if items is not None:
+            return [result for item in items for result in expand_braces(prefix + item + suffix)]
+        start = text.find("{", start + 1)
+    return [text]
@@ -0,0 +1,135 @@
+import os
+import io
+import sys
+import errno
+
+# Redirections are applied to a descriptor table rather than to the shell's
+# own descriptors. The table maps each descriptor number the command will
+# see to the shell-side descriptor it is to be a copy of, or CLOSED; numbers
+# not in the table are inherited unchanged (only 0, 1 and 2 are, since the
+# shell opens everything else close-on-exec). The launcher turns the table
+# into dup2 and close actions in the child, and builtins get streams over it,
+# so `2>&1` merges output inside the kernel with nothing copied by Python.
+
+CLOSED = -1
+
+FLAGS = {
+    "r": os.O_RDONLY,
+    "w": os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+    "a": os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+    "rw": os.O_RDWR | os.O_CREAT,
+}
+
+def close_fds(*fds):
+    """Close every descriptor that is not None."""
+    for fd in fds:
+        if fd is not None:
+            os.close(fd)
+
+def write_error(stderr_fd, message):
+    """Write an error message to a redirected stderr fd, or to sys.stderr."""
+    if stderr_fd is None:
+        sys.stderr.write(message)
+    elif stderr_fd != CLOSED:
+        os.write(stderr_fd, message.encode(errors="surrogateescape"))
+
+def here_string(text):
+    """Return a descriptor to read text from, for <<<.
+
+    Text that fits in a pipe buffer goes through a pipe; longer text through
+    an unlinked temporary file, so writing it never blocks.
+    """
+    import select
+
+    data = text.encode(errors="surrogateescape")
+    if len(data) <= select.PIPE_BUF:
+        read_fd, write_fd = os.pipe()
+        try:
+            os.write(write_fd, data)
+        finally:
+            os.close(write_fd)
+        return read_fd
+    import tempfile
+    with tempfile.TemporaryFile(prefix="python_shell_here.") as f:
+        f.write(data)
+        f.flush()
+        fd = os.dup(f.fileno())
+    os.lseek(fd, 0, os.SEEK_SET)
+    return fd
+
+def resolve(actions, base=None):
+    """Apply a command's redirect actions, in order, to a descriptor table.
+
+    base maps descriptors to what the command gets before its redirections,
+    e.g. {0: pipe read end, 1: pipe write end}; None values are skipped.
+    Returns (table, opened), where opened lists the descriptors opened here,
+    which the caller closes once the command has started. Files that cannot
+    be opened and duplicating a descriptor that is not open raise OSError,
+    after closing what was already opened.
+    """
+    table = {fd: source for fd, source in (base or {}).items() if source is not None}
+    opened = []
+    try:
+        for action, fd, target in actions:
+            if action == "open":
+                path, mode = target
+                source = os.open(path, FLAGS[mode], 0o666)
+                opened.append(source)
+            elif action == "dup":
+                source = table.get(target, target)
+                if source == CLOSED or (target not in table and target > 2):
+                    raise OSError(errno.EBADF, os.strerror(errno.EBADF), str(target))
+            elif action == "close":
+                source = CLOSED
+            else:
+                source = here_string(target)
+                opened.append(source)
+            table[fd] = source
+    except OSError:
+        close_fds(*opened)
+        raise
+    return table, opened
+
+def child_actions(table):
+    """Return (dups, closes, copies) bringing a child's descriptors in line with table.
+
+    dups are (source, target) pairs that can be applied in order: a source
+    that is itself a target is first copied above every target. copies are
+    those copies, for the caller to close once the child has started.
+    """
+    import fcntl
+
+    targets = set(table)
+    floor = max(targets | {2}) + 1
+    copies = {}
+    dups = []
+    closes = []
+    for target, source in table.items():
+        if source == CLOSED:
+            if target <= 2:
+                closes.append(target)
+            continue
+        if source == target and target <= 2:
+            continue
+        # dup2 onto itself would leave a shell descriptor close-on-exec
+        if source in targets:
+            if source not in copies:
+                copies[source] = fcntl.fcntl(source, fcntl.F_DUPFD_CLOEXEC, floor)
+            source = copies[source]
+        dups.append((source, target))
+    return dups, closes, list(copies.values())
+
+class ClosedStream(io.TextIOBase):
+    """What a builtin reads from or writes to on a closed descriptor: every call fails with EBADF."""
+
+    def read(self, size=-1):
+        raise OSError(errno.EBADF, os.strerror(errno.EBADF))
+
+    readline = read
+
+    def write(self, text):
+        raise OSError(errno.EBADF, os.strerror(errno.EBADF))
+
+def describe_error(error):
+    """Format an OSError from resolve the way the shell reports it."""
+    return f"{error.filename}: {error.strerror}" if error.filename else error.strerror
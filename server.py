@@ -0,0 +1,158 @@
+import os
+import sys
+import json
+import signal
+import socket
+import utils
+import command_hash
+import shell
+
+# The server keeps a warm shell (modules imported, PATH hashed) and forks a
+# session for every client connection. A session is a copy of the server, so
+# its working directory and variables are its own, and it receives the
+# client's stdin, stdout and stderr over the socket (SCM_RIGHTS): commands
+# write straight to the client's terminal or pipes with nothing relayed.
+#
+# Protocol, one JSON object per line:
+#   client -> session  {"command": str, "name": str, "args": [...], "cwd": str,
+#                       "env": {...}}; the first request carries fds 0, 1, 2
+#   session -> client  {"pid": n} once, then {"status": n} per request
+# A client may send several requests on one connection; they run in the same
+# session, one after the other.
+
+MAX_REQUEST = 1 << 20
+
+def read_line(conn, buffer):
+    """Read one line from conn, keeping what follows it in buffer. Returns None at EOF."""
+    while b"\n" not in buffer:
+        data = conn.recv(65536)
+        if not data:
+            return None
+        buffer.extend(data)
+        if len(buffer) > MAX_REQUEST:
+            return None
+    line, _, rest = bytes(buffer).partition(b"\n")
+    buffer[:] = rest
+    return line
+
+def send_message(conn, message):
+    conn.sendall(json.dumps(message).encode() + b"\n")
+
+def run_request(request):
+    """Run one request's command text in this session and return its status."""
+    if "env" in request:
+        utils.shell_variables.reset(request["env"])
+    if "cwd" in request:
+        try:
+            os.chdir(request["cwd"])
+            utils.shell_variables["PWD"] = os.getcwd()
+        except OSError as e:
+            sys.stderr.write(f"server: {request['cwd']}: {e.strerror}\n")
+            return 1
+    try:
+        return shell.run_script(str(request.get("command", "")).splitlines(),
+                                request.get("name", "main.py"), request.get("args", []))
+    except SystemExit as e:
+        return e.code if isinstance(e.code, int) else 1
+    except KeyboardInterrupt:
+        return 130
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+def run_session(conn):
+    """Serve one client connection; runs in the forked session process."""
+    # Its own process group, so the client can interrupt the session and
+    # everything it runs with one killpg
+    os.setpgid(0, 0)
+    buffer = bytearray()
+    data, fds, _, _ = socket.recv_fds(conn, 65536, 3)
+    if len(fds) != 3:
+        return 2
+    for target, fd in enumerate(fds):
+        os.dup2(fd, target)
+        os.close(fd)
+    buffer.extend(data)
+    send_message(conn, {"pid": os.getpid()})
+
+    status = 0
+    while True:
+        line = read_line(conn, buffer)
+        if line is None:
+            return status
+        try:
+            request = json.loads(line)
+        except ValueError:
+            sys.stderr.write("server: malformed request\n")
+            return 2
+        status = run_request(request)
+        utils.last_exit_code = status
+        send_message(conn, {"status": status})
+
+def stop_server(signum, frame):
+    raise SystemExit(0)
+
+def serve(path):
+    """Listen on a Unix socket at path and fork a session per connection."""
+    # Imported once here rather than by every session
+    import subprocess
+    import threading
+
+    command_hash.hash_all()
+    if os.path.exists(path):
+        # A socket left behind by a server that is gone
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except OSError:
+            os.unlink(path)
+        else:
+            sys.stderr.write(f"server: {path}: a server is already listening\n")
+            return 1
+        finally:
+            probe.close()
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o177)
+    try:
+        listener.bind(path)
+    finally:
+        os.umask(old_umask)
+    listener.listen(64)
+    # Sessions are reaped by the kernel
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    # Remove the socket when killed
+    signal.signal(signal.SIGTERM, stop_server)
+    sys.stderr.write(f"server: listening on {path}\n")
+    sys.stderr.flush()
+
+    try:
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except InterruptedError:
+                continue
+            sys.stdout.flush()
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    listener.close()
+                    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                    signal.signal(signal.SIGINT, signal.default_int_handler)
+                    status = run_session(conn)
+                except BrokenPipeError:
+                    pass
+                finally:
+                    # Skip the server's atexit handlers and buffered streams
+                    os._exit(status)
+            conn.close()
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        listener.close()
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
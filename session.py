@@ -0,0 +1,556 @@
+import os
+import sys
+import errno
+import signal
+import time
+import asyncio
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+from functools import lru_cache
+import utils
+from variables import VariableStore
+from parser import parse_line, expand_assignment, Compound
+from builtin import BUILTINS, INPUT_BUILTINS, execute_builtin
+import command_hash
+from command_hash import find_command
+import jobs
+import launcher
+import redirection
+from redirection import CLOSED
+from control import evaluate, LoopControl, FunctionReturn
+from shell import (close_fds, write_error, assign_variables, start_subshell, runs_in_subshell,
+                   format_times, parse_timeout)
+
+# Shell is the embeddable form of the shell: each instance has its own
+# variables, working directory, positional parameters, exit status and
+# history, and runs command lines with asyncio subprocesses, so one event
+# loop can drive many sessions and pipelines at once without a thread per
+# command.
+#
+# The parser, builtins and command lookup work on the module-level state in
+# utils. Execution is split into synchronous steps (expanding a command,
+# running a builtin, opening redirections) and waits; each step runs with the
+# session's state swapped into utils and the process's working directory set
+# to the session's. Nothing awaits while swapped in, so sessions sharing one
+# loop never see each other's state. Command lists and control flow are
+# walked by control.evaluate as in the shell, one step at a time: the
+# session awaits each pipeline it yields before resuming it.
+
+Result = namedtuple("Result", "status stdout stderr")
+
+class LineExit(Exception):
+    """Raised in place of exit's SystemExit, which asyncio tasks do not pass on."""
+
+    def __init__(self, status):
+        super().__init__(status)
+        self.status = status
+
+class Shell:
+    """An independent shell session.
+
+    run() executes a command line and waits for it; arun() is the coroutine
+    doing the work, for use from an event loop. With capture, the standard
+    output and error of the command are returned as bytes in the Result
+    instead of going to the process's own streams. exit ends the command
+    line being run, with its status, but the session stays usable.
+
+    Child processes are waited for through pidfds where Linux has them, see
+    install_child_watcher, rather than with a thread each.
+    """
+
+    def __init__(self, environ=None, cwd=None, args=(), name="shell"):
+        self.variables = VariableStore(os.environ if environ is None else environ)
+        self.cwd = os.path.abspath(cwd or os.getcwd())
+        self.variables["PWD"] = self.cwd
+        self.positional_args = [name] + list(args)
+        self.last_exit_code = 0
+        self.last_background_pid = None
+        self.functions = {}
+        self.loop_depth = 0
+        # Options start out as the process's, such as posix-spawn
+        self.shell_options = set(utils.shell_options)
+        # Limits set with ulimit, applied to the commands this session starts
+        self.resource_limits = dict(utils.resource_limits)
+        # (start time, command line, exit status) of every command run
+        self.history = []
+        self.background_tasks = set()
+        # pid of the last process of a pipeline started with & -> its task,
+        # for wait
+        self.background_pids = {}
+
+    @contextmanager
+    def activated(self):
+        """Swap this session's state into utils and its directory into the process."""
+        saved = (utils.shell_variables, utils.last_exit_code, utils.positional_args,
+                 utils.last_background_pid, utils.functions, utils.loop_depth, utils.shell_options,
+                 utils.resource_limits, os.getcwd())
+        utils.shell_variables = self.variables
+        utils.last_exit_code = self.last_exit_code
+        utils.positional_args = self.positional_args
+        utils.last_background_pid = self.last_background_pid
+        utils.functions = self.functions
+        utils.loop_depth = self.loop_depth
+        utils.shell_options = self.shell_options
+        utils.resource_limits = self.resource_limits
+        os.chdir(self.cwd)
+        try:
+            yield
+        finally:
+            self.cwd = os.getcwd()
+            self.last_exit_code = utils.last_exit_code
+            self.last_background_pid = utils.last_background_pid
+            # Function calls replace the positional parameters while they run
+            self.positional_args = utils.positional_args
+            self.loop_depth = utils.loop_depth
+            (utils.shell_variables, utils.last_exit_code, utils.positional_args,
+             utils.last_background_pid, utils.functions, utils.loop_depth, utils.shell_options,
+             utils.resource_limits, cwd) = saved
+            os.chdir(cwd)
+
+    def run(self, line, capture=False, input=None):
+        """Run a command line and return its Result.
+
+        Must not be called while an event loop is running in this thread;
+        use arun there.
+        """
+        return asyncio.run(self.arun(line, capture, input))
+
+    async def arun(self, line, capture=False, input=None):
+        """Run a command line and return a Result once it has finished.
+
+        input, if given, is written to the standard input of the commands as
+        bytes. A pipeline ending in & is started as a task and not waited for.
+        """
+        install_child_watcher()
+        started = time.time()
+        stdout_read, stdout_write = os.pipe() if capture else (None, None)
+        stderr_read, stderr_write = os.pipe() if capture else (None, None)
+        input_read, input_write = os.pipe() if input is not None else (None, None)
+        readers = [read_all(fd) for fd in (stdout_read, stderr_read) if fd is not None]
+        reading = asyncio.gather(*readers)
+        feeding = asyncio.ensure_future(write_all(input_write, input)) if input is not None else None
+        base = {fd: source for fd, source in ((0, input_read), (1, stdout_write), (2, stderr_write))
+                if source is not None}
+        try:
+            status = await self.run_line(line, base)
+        finally:
+            close_fds(input_read, stdout_write, stderr_write)
+            if feeding is not None:
+                await feeding
+            outputs = await reading
+        self.last_exit_code = status
+        self.history.append((started, line, status))
+        return Result(status, *(outputs if capture else (None, None)))
+
+    async def run_line(self, line, base):
+        """Parse and run a line with the descriptor table base; returns the status."""
+        try:
+            with self.activated():
+                command_list = parse_line(line)
+        except ValueError as e:
+            write_error(base.get(2), f"Error parsing command: {e}\n")
+            return 2
+        if command_list is None:
+            return self.last_exit_code
+
+        command_hash.revalidate()
+        steps = evaluate(command_list, base)
+        status = error = None
+        try:
+            while True:
+                try:
+                    with self.activated():
+                        if error is None:
+                            pipeline, stages, step_base = steps.send(status)
+                        else:
+                            pipeline, stages, step_base = steps.throw(error)
+                except StopIteration as e:
+                    return e.value
+                error = None
+                try:
+                    status = await self.execute_pipeline(pipeline, stages, step_base)
+                except (LoopControl, FunctionReturn) as e:
+                    # break, continue or return: unwinds the evaluation
+                    error = e
+                    status = None
+                except LineExit as e:
+                    # exit ends the line, though not the session
+                    return e.status
+        finally:
+            with self.activated():
+                steps.close()
+
+    async def execute_pipeline(self, pipeline, stages, base):
+        """Run a Pipeline's expanded stages, timing them if it is prefixed with `time`."""
+        if pipeline.timed is None:
+            return await self.run_pipeline(pipeline, stages, base)
+        started, start = os.times(), time.perf_counter()
+        try:
+            return await self.run_pipeline(pipeline, stages, base)
+        finally:
+            write_error(base.get(2), format_times(time.perf_counter() - start, started, os.times(), pipeline.timed))
+
+    async def run_pipeline(self, pipeline, stages, base):
+        """Run the expanded stages of a Pipeline on top of the descriptor table base."""
+        if not stages:
+            return 0
+
+        lone = stages[0] if len(stages) == 1 and not isinstance(stages[0], Compound) else None
+        if lone and not pipeline.background and not lone.args and lone.assignments:
+            with self.activated():
+                return assign_variables(lone.assignments)
+
+        timeout = None
+        if pipeline.timeout is not None:
+            try:
+                with self.activated():
+                    timeout = parse_timeout([expand_assignment(word) for word in pipeline.timeout])
+            except ValueError as e:
+                write_error(base.get(2), f"timeout: {e}\n")
+                return 125
+
+        if pipeline.background:
+            # The task gets copies of the descriptors, which arun closes
+            base = {fd: source if source == CLOSED else os.dup(source) for fd, source in base.items()}
+            started = asyncio.get_running_loop().create_future()
+            task = asyncio.create_task(self.run_stages(stages, base, own_fds=True, timeout=timeout,
+                                                       started=started))
+            self.background_tasks.add(task)
+            task.add_done_callback(self.background_tasks.discard)
+            pid = await started
+            if pid is not None:
+                self.last_background_pid = pid
+                self.background_pids[pid] = task
+                while len(self.background_pids) > jobs.SAVED_STATUS_LIMIT:
+                    del self.background_pids[next(iter(self.background_pids))]
+            return 0
+        return await self.run_stages(stages, base, in_pipeline=len(stages) > 1, timeout=timeout)
+
+    async def run_stages(self, stages, base, own_fds=False, in_pipeline=True, timeout=None, started=None):
+        """Start every stage of a pipeline, connected by pipes, and wait for all of them.
+
+        With in_pipeline false, the only stage is a lone builtin whose break,
+        continue and return apply to the command list. timeout is None, or
+        the (seconds, signal, kill_after) of a `timeout` prefix: the stages
+        then get a process group of their own, which is signalled as
+        Job.set_timeout does. started, if given, is a future set to the pid
+        of the last stage's process, or None, once every stage has started.
+        """
+        waits = []
+        # The process group of the pipeline, once its first process has started
+        group = [] if timeout is not None else None
+        last_pid = []
+        prev_read = None
+        try:
+            for i, stage in enumerate(stages):
+                is_last = i == len(stages) - 1
+                next_read, write_end = (None, None) if is_last else os.pipe()
+                stage_base = dict(base)
+                if prev_read is not None:
+                    stage_base[0] = prev_read
+                if write_end is not None:
+                    stage_base[1] = write_end
+                waits.append(await self.start_stage(stage, stage_base, in_pipeline, group,
+                                                    last_pid if is_last else None))
+                close_fds(prev_read, write_end)
+                prev_read = next_read
+        finally:
+            close_fds(prev_read)
+            if own_fds:
+                close_fds(*[fd for fd in base.values() if fd != CLOSED])
+            if started is not None:
+                started.set_result(last_pid[0] if last_pid else None)
+        expired = []
+        timers = set_timeout(group[0], expired, *timeout) if group else []
+        try:
+            statuses = await asyncio.gather(*waits)
+        finally:
+            for timer in timers:
+                timer.cancel()
+        if expired:
+            return 128 + signal.SIGKILL if expired[-1] == signal.SIGKILL else 124
+        return statuses[-1]
+
+    async def start_stage(self, stage, base, in_pipeline, group=None, pids=None):
+        """Start one stage and return an awaitable of its exit status.
+
+        The descriptors in base remain the caller's to close. A compound
+        command or function call runs in a subshell, as does a builtin that
+        changes the shell's state when it is part of a pipeline. With group,
+        a list, the process joins the group it holds, or starts one and adds
+        it there. With pids, a list, the pid of the process started, if any,
+        is appended to it.
+        """
+        with self.activated():
+            # A lone builtin changes the session's own state
+            subshell = runs_in_subshell(stage) and (in_pipeline or isinstance(stage, Compound)
+                                                    or stage.args[0] in self.functions)
+        try:
+            with self.activated():
+                fd_table, opened = redirection.resolve(() if subshell else stage.redirections, base)
+        except OSError as e:
+            write_error(base.get(2), f"{redirection.describe_error(e)}\n")
+            return completed(1)
+        try:
+            pgid = None if group is None else (group[0] if group else 0)
+            if subshell:
+                with self.activated():
+                    process = start_subshell(stage, fd_table, pgid)
+                if group == []:
+                    group.append(process.pid)
+                if pids is not None:
+                    pids.append(process.pid)
+                return wait_pid(process.pid)
+            cmd_tokens = stage.args
+            if not cmd_tokens:
+                return completed(0)
+            if cmd_tokens[0] == "wait" and not in_pipeline:
+                # The session's background pipelines are not the shell's jobs
+                stderr_fd = fd_table.get(2)
+                return self.wait_builtin(cmd_tokens[1:], stderr_fd if stderr_fd in (None, CLOSED)
+                                         else os.dup(stderr_fd))
+            if cmd_tokens[0] in BUILTINS:
+                return self.run_builtin(cmd_tokens, *[fd_table.get(fd) if fd_table.get(fd) in (None, CLOSED)
+                                                      else os.dup(fd_table[fd]) for fd in (0, 1, 2)],
+                                        in_pipeline=in_pipeline)
+
+            with self.activated():
+                path_to_cmd = find_command(cmd_tokens[0])
+                env = self.variables.environ()
+                arguments = launcher.popen_arguments(fd_table)
+            if pgid is not None:
+                arguments["process_group"] = pgid
+            stderr_fd = fd_table.get(2)
+            if path_to_cmd is None:
+                write_error(stderr_fd, f"{cmd_tokens[0]}: command not found\n")
+                return completed(127)
+            if stage.assignments:
+                env = dict(env, **dict(stage.assignments))
+            try:
+                process = await asyncio.create_subprocess_exec(
+                    *cmd_tokens, executable=path_to_cmd, env=env, cwd=self.cwd, **arguments)
+            except FileNotFoundError:
+                write_error(stderr_fd, f"{cmd_tokens[0]}: not found\n")
+                return completed(127)
+            except PermissionError:
+                write_error(stderr_fd, f"{cmd_tokens[0]}: permission denied\n")
+                return completed(126)
+            if group == []:
+                group.append(process.pid)
+            if pids is not None:
+                pids.append(process.pid)
+            return wait_process(process)
+        finally:
+            close_fds(*opened)
+
+    async def run_builtin(self, cmd_tokens, stdin_fd, stdout_fd, stderr_fd, in_pipeline=True):
+        """Run a builtin stage without blocking the loop, owning the given descriptors.
+
+        The input of builtins that read it is read in full first, and the
+        output written once the builtin has returned, since the builtin itself
+        runs synchronously. Other builtins have their input closed at once,
+        so that a producer feeding them stops with SIGPIPE. A descriptor
+        that is None is the process's own; one that is CLOSED reads nothing,
+        and output to it is an error. Unless in_pipeline is false, break,
+        continue, return and exit only end this stage, as in the shell.
+        """
+        import io
+
+        try:
+            data = b""
+            if stdin_fd not in (None, CLOSED):
+                if cmd_tokens[0] in INPUT_BUILTINS:
+                    data = await read_all(stdin_fd)
+                else:
+                    close_fds(stdin_fd)
+            stdin_fd = None
+            stdout, stderr = io.StringIO(), io.StringIO()
+            with self.activated():
+                try:
+                    status = execute_builtin(cmd_tokens[0], cmd_tokens[1:],
+                                             io.StringIO(data.decode(errors="surrogateescape")), stdout, stderr)
+                except SystemExit as e:
+                    status = e.code if isinstance(e.code, int) else 1
+                    if not in_pipeline:
+                        raise LineExit(status)
+                except (LoopControl, FunctionReturn) as e:
+                    if not in_pipeline:
+                        raise
+                    status = e.status if isinstance(e, FunctionReturn) else 0
+            if stdout_fd == CLOSED and stdout.getvalue():
+                stderr.write(f"{cmd_tokens[0]}: write error: {os.strerror(errno.EBADF)}\n")
+                status = 1
+            for fd, stream, fallback in ((stdout_fd, stdout, sys.stdout), (stderr_fd, stderr, sys.stderr)):
+                if fd is None:
+                    fallback.write(stream.getvalue())
+                    fallback.flush()
+                elif fd != CLOSED:
+                    await write_all(fd, stream.getvalue().encode(errors="surrogateescape"))
+            stdout_fd = stderr_fd = None
+            return status
+        finally:
+            close_fds(*[fd for fd in (stdin_fd, stdout_fd, stderr_fd) if fd != CLOSED])
+
+    async def wait_builtin(self, args, stderr_fd):
+        """Run wait on the session's background pipelines, owning stderr_fd.
+
+        A pipeline is named by the pid $! gave for it. Without arguments,
+        waits for every pipeline and returns 0.
+        """
+        try:
+            if not args:
+                await self.wait_background()
+                return 0
+            status = 0
+            for target in args:
+                task = self.background_pids.pop(int(target), None) if target.isdigit() else None
+                if task is not None:
+                    status = await task
+                elif target.isdigit():
+                    write_error(stderr_fd, f"wait: pid {target} is not a child of this shell\n")
+                    status = 127
+                elif target.startswith("%"):
+                    write_error(stderr_fd, f"wait: {target}: no such job\n")
+                    status = 127
+                else:
+                    write_error(stderr_fd, f"wait: `{target}': not a pid or valid job spec\n")
+                    status = 2
+            return status
+        finally:
+            if stderr_fd not in (None, CLOSED):
+                close_fds(stderr_fd)
+
+    async def wait_background(self):
+        """Wait for the pipelines started with & to finish."""
+        while self.background_tasks:
+            await asyncio.gather(*list(self.background_tasks))
+
+def set_timeout(pgid, expired, seconds, signum, kill_after):
+    """Signal a process group after seconds, and SIGKILL it kill_after seconds later.
+
+    The signals sent are appended to expired. Returns the timer handles,
+    for the caller to cancel once the group's processes have finished.
+    """
+    loop = asyncio.get_running_loop()
+
+    def expire(signum):
+        expired.append(signum)
+        try:
+            os.killpg(pgid, signum)
+            # A stopped process would otherwise never see the signal
+            os.killpg(pgid, signal.SIGCONT)
+        except ProcessLookupError:
+            pass
+
+    timers = [loop.call_later(seconds, expire, signum)]
+    if kill_after is not None and signum != signal.SIGKILL:
+        timers.append(loop.call_later(seconds + kill_after, expire, signal.SIGKILL))
+    return timers
+
+async def completed(status):
+    return status
+
+async def wait_process(process):
+    return jobs.exit_status(await process.wait())
+
+async def wait_pid(pid):
+    """Wait for a forked subshell and return its exit status.
+
+    The loop watches a pidfd of the process; without pidfds, a worker
+    thread waits for it instead.
+    """
+    loop = asyncio.get_running_loop()
+    if not pidfds_supported():
+        _, status = await loop.run_in_executor(None, os.waitpid, pid, 0)
+        return jobs.exit_status(os.waitstatus_to_exitcode(status))
+    pidfd = os.pidfd_open(pid)
+    exited = loop.create_future()
+
+    def readable():
+        # The pidfd stays readable until the process is reaped below
+        loop.remove_reader(pidfd)
+        exited.set_result(None)
+
+    try:
+        loop.add_reader(pidfd, readable)
+        await exited
+    finally:
+        loop.remove_reader(pidfd)
+        os.close(pidfd)
+    _, status = os.waitpid(pid, 0)
+    return jobs.exit_status(os.waitstatus_to_exitcode(status))
+
+@lru_cache(maxsize=None)
+def pidfds_supported():
+    """Whether os.pidfd_open works here: Linux 5.3 or later."""
+    try:
+        os.close(os.pidfd_open(os.getpid()))
+    except (AttributeError, OSError):
+        return False
+    return True
+
+def install_child_watcher():
+    """Make asyncio wait for child processes through pidfds on Python 3.11.
+
+    Its default watcher there starts a thread per child process; 3.12 uses
+    pidfds by itself. A watcher the application installed is kept. The
+    3.11 watcher belongs to one loop, so this only applies to loops running
+    in the main thread.
+    """
+    if (sys.version_info >= (3, 12) or not pidfds_supported()
+            or threading.current_thread() is not threading.main_thread()):
+        return
+    watcher = asyncio.get_child_watcher()
+    if isinstance(watcher, asyncio.ThreadedChildWatcher):
+        watcher = asyncio.PidfdChildWatcher()
+        asyncio.set_child_watcher(watcher)
+    if isinstance(watcher, asyncio.PidfdChildWatcher) and not watcher.is_active():
+        watcher.attach_loop(asyncio.get_running_loop())
+
+def is_file(fd):
+    """Whether fd is a regular file, which never blocks and cannot be watched by the loop."""
+    import stat
+    return stat.S_ISREG(os.fstat(fd).st_mode)
+
+async def read_all(fd):
+    """Read a descriptor to EOF without blocking the loop, then close it."""
+    if is_file(fd):
+        with open(fd, "rb") as f:
+            return f.read()
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    transport, _ = await loop.connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader), open(fd, "rb", buffering=0))
+    try:
+        return await reader.read()
+    finally:
+        transport.close()
+
+class PipeWriter(asyncio.Protocol):
+    """Protocol for write_all: notes when the transport has flushed and closed."""
+
+    def __init__(self):
+        self.closed = asyncio.get_running_loop().create_future()
+
+    def connection_lost(self, exc):
+        if not self.closed.done():
+            self.closed.set_result(exc)
+
+async def write_all(fd, data):
+    """Write data to a descriptor without blocking the loop, then close it.
+
+    A reader that goes away early is not an error. Returns 0 so it can be
+    gathered with exit statuses.
+    """
+    if is_file(fd):
+        with open(fd, "wb") as f:
+            f.write(data)
+        return 0
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.connect_write_pipe(PipeWriter, open(fd, "wb", buffering=0))
+    transport.write(data)
+    # The transport closes once everything is written
+    transport.close()
+    await protocol.closed
+    return 0
@@ -1,196 +1,696 @@
 import sys
 import os
-import shutil
-import subprocess
-import shlex
-import readline
-import atexit
-
-from utils import shell_variables, last_exit_code, history_file, history_size, SHELL_BUILTINS
-from parser import expand_variables, expand_tilde, parse_command_tokens
-from builtin import execute_builtin
-from completion import setup_completion
-
-def setup_history():
-    """Set up command history with readline"""
+import signal
+
+import utils
+from parser import (parse_line, expand_assignment, split_timeout_option, IncompleteInput,
+                    Stage, CommandList, AndOr, Pipeline, Compound, If, For, While, Group)
+from builtin import BUILTINS, SUBSHELL_BUILTINS, execute_builtin, format_minutes, parse_signal
+from command_hash import find_command
+import command_hash
+from variables import ReadonlyError
+import jobs
+import tracing
+import control
+from control import LoopControl, FunctionReturn
+import launcher
+import redirection
+from redirection import CLOSED, close_fds, write_error
+
+# subprocess, threading, readline and the completion and history modules are
+# imported where they are first needed: together they cost more than the rest
+# of startup, and scripts and -c commands never need some of them.
+
+def text_stream(fd, mode):
+    """Wrap a descriptor for a builtin, which works on text; the descriptor stays open.
+
+    Undecodable bytes round-trip through surrogate escapes, so binary data
+    passing through a builtin is not corrupted.
+    """
+    return open(fd, mode, errors="surrogateescape", closefd=False)
+
+def builtin_streams(table):
+    """Return the (stdin, stdout, stderr) text streams of a builtin for a descriptor table.
+
+    The shell's own descriptors map to sys.stdin, sys.stdout and sys.stderr,
+    so output stays in order with the shell's; a descriptor used twice, as
+    after 2>&1, gets one stream. Returns the streams and those created here.
+    """
+    streams = {0: sys.stdin, 1: sys.stdout, 2: sys.stderr, CLOSED: redirection.ClosedStream()}
+    created = []
+    result = []
+    for fd, mode in ((0, "r"), (1, "w"), (2, "w")):
+        source = table.get(fd, fd)
+        if source not in streams:
+            streams[source] = text_stream(source, mode)
+            created.append(streams[source])
+        result.append(streams[source])
+    return result, created
+
+def execute_builtin_stage(stage, base):
+    """Run a builtin in-process with its redirections applied and return its status.
+
+    base is the descriptor table of the stage before its redirections: the
+    pipes of a pipeline stage and the redirections of the compound commands
+    around it. Descriptors not in it are the shell's own. The stage's
+    redirections apply on top of it, as they do for external commands. The
+    descriptors remain the caller's.
+    """
+    try:
+        with tracing.span("redirect"):
+            table, opened = redirection.resolve(stage.redirections, base)
+    except OSError as e:
+        write_error(base.get(2), f"{redirection.describe_error(e)}\n")
+        return 1
+    
+    (stdin, stdout, stderr), created = builtin_streams(table)
+    try:
+        return execute_builtin(stage.args[0], stage.args[1:], stdin, stdout, stderr)
+    except BrokenPipeError:
+        raise
+    except OSError as e:
+        # e.g. writing to a descriptor closed with >&-
+        try:
+            stderr.write(f"{stage.args[0]}: write error: {e.strerror}\n")
+        except OSError:
+            pass
+        return 1
+    finally:
+        try:
+            for stream in created:
+                stream.close()
+        finally:
+            close_fds(*opened)
+            sys.stdout.flush()
+
+def run_builtin_in_pipeline(stage, base, exit_codes, index):
+    """Run a builtin pipeline stage on a thread, owning the descriptors in base.
+
+    Only builtins that leave the shell's state alone run this way; the
+    others run in a subshell (see SUBSHELL_BUILTINS).
+    """
+    try:
+        exit_codes[index] = execute_builtin_stage(stage, base)
+    except BrokenPipeError:
+        exit_codes[index] = 141
+    finally:
+        close_fds(*[fd for fd in base.values() if fd != CLOSED])
+
+def start_external(cmd_tokens, fd_table, pgid, assignments=()):
+    """Spawn an external command and return (process, exit code).
+
+    fd_table gives the command's descriptors (see redirection.resolve).
+    process is None if the command could not be started, in which case the
+    error has been reported on the command's stderr. pgid is 0 to start a new
+    process group, None to keep the shell's, or the group to join.
+    assignments are (name, value) pairs added to the command's environment
+    only.
+    """
+    stderr_fd = fd_table.get(2)
+    with tracing.span("lookup"):
+        path_to_cmd = find_command(cmd_tokens[0])
+    if path_to_cmd is None:
+        write_error(stderr_fd, f"{cmd_tokens[0]}: command not found\n")
+        return None, 127
     try:
-        readline.read_history_file(history_file)
-        readline.set_history_length(history_size)
+        with tracing.span("spawn"):
+            env = utils.shell_variables.environ()
+            if assignments:
+                env = dict(env, **dict(assignments))
+            process = launcher.spawn(cmd_tokens, path_to_cmd, fd_table, pgid, env)
     except FileNotFoundError:
-        open(history_file, 'a').close()
+        write_error(stderr_fd, f"{cmd_tokens[0]}: not found\n")
+        return None, 127
+    except PermissionError:
+        write_error(stderr_fd, f"{cmd_tokens[0]}: permission denied\n")
+        return None, 126
+    except OSError as e:
+        write_error(stderr_fd, f"{cmd_tokens[0]}: {e.strerror}\n")
+        return None, 126
+    return process, 0
+
+# Text standing for a compound command in the job table
+COMPOUND_TEXT = {If: "if ... fi", For: "for ... done", While: "while ... done", Group: "{ ... }"}
+
+def stage_text(stage):
+    """Return the text of a pipeline stage for the job table."""
+    if not isinstance(stage, Compound):
+        return " ".join(stage.args)
+    if isinstance(stage.body, While) and stage.body.until:
+        return "until ... done"
+    return COMPOUND_TEXT[type(stage.body)]
+
+def runs_in_subshell(stage):
+    """Whether a pipeline stage, other than a lone foreground command, needs a subshell.
+
+    Such are compound commands, functions and the builtins that change the
+    shell's state.
+    """
+    if isinstance(stage, Compound):
+        return True
+    return bool(stage.args) and (stage.args[0] in utils.functions or stage.args[0] in SUBSHELL_BUILTINS)
+
+def start_subshell(stage, fd_table, pgid):
+    """Fork a subshell running a Compound, or the function or builtin of a Stage, and return its process.
+
+    Compound commands, functions and builtins such as cd that are part of a
+    pipeline or run in the background, and compound commands and functions
+    run under time or timeout, run in a copy of the shell, whose variable
+    assignments, cd and the like do not affect the shell itself. fd_table
+    and pgid are as for start_external; the stage's own redirections are
+    applied by the subshell.
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid:
+        if pgid is not None:
+            # Also done by the child; whichever runs first sets the group
+            try:
+                os.setpgid(pid, pgid or pid)
+            except OSError:
+                pass
+        return launcher.SpawnedProcess(pid, [stage_text(stage)])
     
-    atexit.register(readline.write_history_file, history_file)
+    status = 1
+    try:
+        if pgid is not None:
+            os.setpgid(0, pgid)
+        dups, closes, _ = redirection.child_actions(fd_table)
+        for source, target in dups:
+            os.dup2(source, target)
+        for fd in closes:
+            os.close(fd)
+        # Leaves the subshell only the descriptors of its table: a pipe end
+        # kept open here would hold back EOF and SIGPIPE from its neighbours
+        low = 3
+        for fd in sorted(fd for fd in fd_table if fd > 2) + [os.sysconf("SC_OPEN_MAX")]:
+            os.closerange(low, fd)
+            low = fd + 1
+        if fd_table.get(0) != CLOSED:
+            # sys.stdin may hold input the shell had read ahead
+            sys.stdin = text_stream(0, "r")
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        for signum in (signal.SIGTSTP, signal.SIGTTIN, signal.SIGTTOU):
+            signal.signal(signum, signal.SIG_DFL)
+        # Jobs are the parent's; the subshell's pipelines stay in its group
+        jobs.job_control = False
+        jobs.job_table.clear()
+        jobs.job_order.clear()
+        jobs.live_processes.clear()
+        jobs.saved_statuses.clear()
+        utils.interactive = False
+        if isinstance(stage, Compound):
+            status = run_commands(CommandList((AndOr(Pipeline((stage,)), ()),)))
+        elif stage.args[0] in utils.functions:
+            status = drive(control.call_function(stage, {}))
+        else:
+            status = execute_builtin_stage(stage, {})
+    except SystemExit as e:
+        status = e.code if isinstance(e.code, int) else 1
+    except LoopControl:
+        status = 0
+    except FunctionReturn as e:
+        status = e.status
+    except KeyboardInterrupt:
+        status = 128 + signal.SIGINT
+    except BrokenPipeError:
+        status = 128 + signal.SIGPIPE
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        except OSError:
+            pass
+        os._exit(status)
 
-def execute_command(tokens, input_data=None):
-    """Execute a command with possible redirections and return its output."""
-    global shell_variables, last_exit_code
+def run_captured(argv):
+    """Run a command with stdin from /dev/null and return (status, stdout, stderr).
+
+    The output is returned in CaptureBuffers, which the caller must close;
+    past utils.capture_memory_limit it is kept in a temporary file. Builtins
+    run in-process on string buffers, except those changing the shell's
+    state, which run in a subshell. Safe to call from several threads at
+    once.
+    """
+    import io
+    from capture import CaptureBuffer, capture_bytes, read_pipes
     
-    cmd_tokens, stdout_redirection, stdout_mode, stderr_redirection, stderr_mode, stdin_redirection = parse_command_tokens(tokens)
+    if argv[0] in BUILTINS and argv[0] not in SUBSHELL_BUILTINS:
+        stdout, stderr = io.StringIO(), io.StringIO()
+        try:
+            status = execute_builtin(argv[0], argv[1:], io.StringIO(), stdout, stderr)
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else 1
+        return (status, capture_bytes(stdout.getvalue().encode(errors="surrogateescape")),
+                capture_bytes(stderr.getvalue().encode(errors="surrogateescape")))
     
-    if not cmd_tokens:
-        return None
+    stdout_read, stdout_write = os.pipe()
+    stderr_read, stderr_write = os.pipe()
+    if argv[0] in BUILTINS:
+        stdin_fd = os.open(os.devnull, os.O_RDONLY)
+        try:
+            process = start_subshell(Stage(list(argv), (), ()), {0: stdin_fd, 1: stdout_write, 2: stderr_write}, None)
+        finally:
+            close_fds(stdin_fd, stdout_write, stderr_write)
+        stdout_data, stderr_data = CaptureBuffer(), CaptureBuffer()
+        read_pipes({stdout_read: stdout_data, stderr_read: stderr_data})
+        _, status = os.waitpid(process.pid, 0)
+        return jobs.exit_status(os.waitstatus_to_exitcode(status)), stdout_data, stderr_data
     
-    cmd_name = cmd_tokens[0]
-    args = cmd_tokens[1:]
+    import subprocess
+    path_to_cmd = find_command(argv[0])
+    if path_to_cmd is None:
+        close_fds(stdout_read, stdout_write, stderr_read, stderr_write)
+        return 127, CaptureBuffer(), capture_bytes(f"{argv[0]}: command not found\n".encode())
+    try:
+        arguments = launcher.popen_arguments({1: stdout_write, 2: stderr_write})
+        arguments["stdin"] = subprocess.DEVNULL
+        process = subprocess.Popen(argv, executable=path_to_cmd, env=utils.shell_variables.environ(),
+                                   **arguments)
+    except FileNotFoundError:
+        close_fds(stdout_read, stderr_read)
+        return 127, CaptureBuffer(), capture_bytes(f"{argv[0]}: not found\n".encode())
+    except PermissionError:
+        close_fds(stdout_read, stderr_read)
+        return 126, CaptureBuffer(), capture_bytes(f"{argv[0]}: permission denied\n".encode())
+    finally:
+        close_fds(stdout_write, stderr_write)
+    stdout_data, stderr_data = CaptureBuffer(), CaptureBuffer()
+    read_pipes({stdout_read: stdout_data, stderr_read: stderr_data})
+    process.wait()
+    return jobs.exit_status(process.returncode), stdout_data, stderr_data
+
+def launch_pipeline(stages, background=False, own_group=False, base=None):
+    """Start every stage at once, connecting neighbours with OS pipes, and return the Job.
+
+    Each stage's stdout is the write end of a pipe whose read end is the next
+    stage's stdin, so data never passes through the shell and a consumer that
+    exits early (e.g. `head`) stops its producers with SIGPIPE. The last stage
+    writes straight to the terminal, or where base sends it (see
+    execute_builtin_stage). Builtin stages run on threads, and compound
+    commands, functions and builtins that change the shell's state in
+    subshells.
+
+    Background jobs, jobs with own_group and every job under job control
+    get a process group of their own; a foreground job's group is given the
+    terminal.
+    """
+    import threading
     
-    if cmd_name in SHELL_BUILTINS:
-        if input_data is not None:
-            # TODO: Handle input data for builtins if needed
-            pass
-        
-        return execute_builtin(cmd_name, args, stdout_redirection, stdout_mode, 
-                               stderr_redirection, stderr_mode, stdin_redirection)
+    processes = []
+    threads = []
+    exit_codes = [0] * len(stages)
+    new_group = background or own_group or jobs.job_control
+    pgid = None
+    prev_read = None
+    base = base or {}
+    if background and not jobs.job_control and 0 not in base:
+        # Without job control a background job must not compete for the terminal
+        prev_read = os.open(os.devnull, os.O_RDONLY)
     
-    path_to_cmd = shutil.which(cmd_name)
-    if path_to_cmd:
-        try:
-            if stdout_redirection:
-                stdout_target = open(stdout_redirection, stdout_mode)
-            else:
-                stdout_target = subprocess.PIPE
-            
-            if stderr_redirection:
-                stderr_target = open(stderr_redirection, stderr_mode)
-            else:
-                stderr_target = subprocess.PIPE
-            
-            if input_data is not None:
-                stdin_target = subprocess.PIPE
-            elif stdin_redirection:
-                stdin_target = open(stdin_redirection, 'r')
-            else:
-                stdin_target = None
-            
-            process = subprocess.Popen(
-                [cmd_name] + args,
-                stdout=stdout_target,
-                stderr=stderr_target,
-                stdin=stdin_target,
-                text=True,
-                env=shell_variables
-            )
-            
-            stdout_data, stderr_data = process.communicate(input=input_data)
-            
-            if stdout_redirection and stdout_target != subprocess.PIPE:
-                stdout_target.close()
-            if stderr_redirection and stderr_target != subprocess.PIPE:
-                stderr_target.close()
-            if stdin_redirection and stdin_target != subprocess.PIPE:
-                stdin_target.close()
-            
-            last_exit_code = process.returncode
-            return stdout_data
-            
-        except FileNotFoundError:
-            error_msg = f"{cmd_name}: not found\n"
-            if stderr_redirection:
-                with open(stderr_redirection, stderr_mode) as f:
-                    f.write(error_msg)
-            else:
-                sys.stderr.write(error_msg)
-            if stdout_redirection:
-                with open(stdout_redirection, stdout_mode) as f:
-                    pass
-            last_exit_code = 127
-            
-        except PermissionError:
-            error_msg = f"{cmd_name}: permission denied\n"
-            if stderr_redirection:
-                with open(stderr_redirection, stderr_mode) as f:
-                    f.write(error_msg)
+    for i, stage in enumerate(stages):
+        is_last = i == len(stages) - 1
+        next_read, write_end = (None, None) if is_last else os.pipe()
+        
+        subshell = runs_in_subshell(stage)
+        cmd_tokens = None if subshell else stage.args
+        stage_base = dict(base)
+        if prev_read is not None:
+            stage_base[0] = prev_read
+        if write_end is not None:
+            stage_base[1] = write_end
+        
+        if cmd_tokens and cmd_tokens[0] in BUILTINS:
+            # The thread takes over both pipe ends, and copies of the other
+            # descriptors, which may be closed before it is done
+            thread_base = {fd: source if source in (CLOSED, prev_read, write_end) else os.dup(source)
+                           for fd, source in stage_base.items()}
+            thread = threading.Thread(target=run_builtin_in_pipeline,
+                                      args=(stage, thread_base, exit_codes, i), daemon=True)
+            thread.start()
+            threads.append(thread)
+            prev_read = write_end = None
+        else:
+            try:
+                with tracing.span("redirect"):
+                    fd_table, opened = redirection.resolve(() if subshell else stage.redirections, stage_base)
+            except OSError as e:
+                write_error(stage_base.get(2), f"{redirection.describe_error(e)}\n")
+                exit_codes[i] = 1
             else:
-                sys.stderr.write(error_msg)
-            if stdout_redirection:
-                with open(stdout_redirection, stdout_mode) as f:
-                    pass
-            last_exit_code = 126
-    else:
-        error_msg = f"{cmd_name}: command not found\n"
-        if stderr_redirection:
-            with open(stderr_redirection, stderr_mode) as f:
-                f.write(error_msg)
+                process = None
+                if subshell:
+                    process = start_subshell(stage, fd_table, (pgid or 0) if new_group else None)
+                elif cmd_tokens:
+                    process, exit_codes[i] = start_external(
+                        cmd_tokens, fd_table, (pgid or 0) if new_group else None, stage.assignments)
+                if process is not None:
+                    processes.append((i, process))
+                    if new_group and pgid is None:
+                        pgid = process.pid
+                        if jobs.job_control and not background:
+                            jobs.set_foreground(pgid)
+                # The child has its own copies of the redirected descriptors
+                close_fds(*opened)
+        
+        # Closing our pipe ends lets EOF and SIGPIPE propagate along the pipeline
+        close_fds(prev_read, write_end)
+        prev_read = next_read
+    
+    command = " | ".join(stage_text(stage) for stage in stages)
+    return jobs.Job(command, processes, threads, exit_codes, pgid)
+
+def format_times(real, started, finished, time_format):
+    """Return the report of a `time` pipeline.
+
+    real is the elapsed wall time in seconds; the CPU times come from two
+    os.times() results, whose elapsed field only counts clock ticks.
+    """
+    user = finished.user + finished.children_user - started.user - started.children_user
+    system = finished.system + finished.children_system - started.system - started.children_system
+    if time_format == "posix":
+        return f"real {max(real, 0):.2f}\nuser {max(user, 0):.2f}\nsys {max(system, 0):.2f}\n"
+    return f"\nreal\t{format_minutes(real)}\nuser\t{format_minutes(user)}\nsys\t{format_minutes(system)}\n"
+
+# Suffixes of timeout durations, as in timeout(1)
+DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+def parse_duration(text):
+    """Return the seconds of a duration such as 10, 1.5 or 2m, or None if it is invalid."""
+    scale = DURATION_UNITS.get(text[-1:], None)
+    number = text[:-1] if scale else text
+    try:
+        seconds = float(number) * (scale or 1)
+    except ValueError:
+        return None
+    return seconds if seconds >= 0 and seconds == seconds else None
+
+def parse_timeout(args):
+    """Parse the arguments of a `timeout` prefix into (seconds, signal, kill_after).
+
+    Raises ValueError with a message for invalid arguments.
+    """
+    signum = parse_signal("TERM")
+    kill_after = None
+    args = list(args)
+    while len(args) > 1 and len(args[0]) > 1 and args[0].startswith("-"):
+        text = args.pop(0)
+        if text == "--":
+            break
+        option = split_timeout_option(text)
+        if option is None:
+            raise ValueError(f"{text}: invalid option")
+        option, value = option
+        if value is None:
+            value = args.pop(0)
+        if option == "-s":
+            signum = parse_signal(value)
+            if signum is None:
+                raise ValueError(f"{value}: invalid signal")
         else:
-            sys.stderr.write(error_msg)
-        if stdout_redirection:
-            with open(stdout_redirection, stdout_mode) as f:
-                pass
-        last_exit_code = 127
+            kill_after = parse_duration(value)
+            if kill_after is None:
+                raise ValueError(f"{value}: invalid time interval")
+    seconds = parse_duration(args[0]) if len(args) == 1 else None
+    if seconds is None:
+        raise ValueError(f"{' '.join(args)}: invalid time interval")
+    return seconds, signum, kill_after
+
+def execute_pipeline(pipeline, stages, base):
+    """Execute a Pipeline's expanded stages, timing them if it is prefixed with `time`."""
+    if pipeline.timed is None:
+        run_pipeline(pipeline, stages, base)
+        return
     
-    return None
+    import time
+    
+    started, start = os.times(), time.perf_counter()
+    try:
+        run_pipeline(pipeline, stages, base)
+    finally:
+        sys.stdout.flush()
+        sys.stderr.write(format_times(time.perf_counter() - start, started, os.times(), pipeline.timed))
 
-def execute_pipeline(commands):
-    """Execute a pipeline of commands."""
-    if not commands:
+def assign_variables(assignments):
+    """Set shell variables from (name, value) pairs and return the exit status."""
+    for name, value in assignments:
+        try:
+            utils.shell_variables[name] = value
+        except ReadonlyError as e:
+            sys.stderr.write(f"{e}\n")
+            return 1
+    return 0
+
+def run_pipeline(pipeline, stages, base):
+    """Launch a Pipeline's stages and wait for them unless it runs in the background.
+
+    base is the descriptor table of the compound commands around it (see
+    execute_builtin_stage).
+    """
+    if not pipeline.commands:
+        utils.last_exit_code = 0
         return
     
-    if len(commands) == 1:
-        output = execute_command(commands[0])
-        # Only print output if it's from an external command, not a builtin
-        if output and commands[0][0] not in SHELL_BUILTINS:
-            sys.stdout.write(output)
+    lone = stages[0] if len(stages) == 1 and not pipeline.background and not isinstance(stages[0], Compound) else None
+    # Assignments without a command set shell variables
+    if lone and not lone.args and lone.assignments:
+        utils.last_exit_code = assign_variables(lone.assignments)
         return
     
-    first_output = execute_command(commands[0])
+    # A lone builtin runs on the main thread so that cd, export and exit
+    # affect the shell itself
+    if lone and lone.args and lone.args[0] in BUILTINS and lone.args[0] not in utils.functions:
+        utils.last_exit_code = execute_builtin_stage(lone, base)
+        return
     
-    current_input = first_output
-    for i in range(1, len(commands) - 1):
-        current_input = execute_command(commands[i], current_input)
+    timeout = None
+    if pipeline.timeout is not None:
+        try:
+            timeout = parse_timeout([expand_assignment(word) for word in pipeline.timeout])
+        except ValueError as e:
+            write_error(base.get(2), f"timeout: {e}\n")
+            utils.last_exit_code = 125
+            return
     
-    execute_command(commands[-1], current_input)
+    sys.stdout.flush()
+    # A timeout signals the pipeline's process group
+    job = launch_pipeline(stages, pipeline.background, timeout is not None, base)
+    if timeout is not None:
+        job.set_timeout(*timeout)
+    if pipeline.background:
+        job_id = jobs.add_job(job)
+        if job.processes:
+            utils.last_background_pid = job.processes[-1][1].pid
+        if utils.interactive:
+            sys.stderr.write(f"[{job_id}] {job.pgid or ''}\n")
+        utils.last_exit_code = 0
+    else:
+        with tracing.span("wait"):
+            utils.last_exit_code = jobs.wait_foreground(job)
+        # wait4 always collects the usage; it is only kept when asked for
+        if pipeline.timed is not None or "accounting" in utils.shell_options:
+            utils.last_resources = job.resource_usage()
+
+def report_startup_profile(profile):
+    """Write the time spent in each startup phase to stderr."""
+    lines = ["startup profile:"]
+    lines.extend(f"  {phase:40s} {seconds * 1000:8.2f} ms" for phase, seconds in profile)
+    lines.append(f"  {'total':40s} {sum(seconds for _, seconds in profile) * 1000:8.2f} ms")
+    sys.stderr.write("\n".join(lines) + "\n")
+
+def run_commands(command_list):
+    """Run a parsed CommandList and return its exit status."""
+    return drive(control.evaluate(command_list, {}))
+
+def drive(steps):
+    """Launch each pipeline an evaluation generator yields, and return its result (see control.evaluate)."""
+    status = error = None
+    try:
+        while True:
+            try:
+                if error is None:
+                    pipeline, stages, base = steps.send(status)
+                else:
+                    pipeline, stages, base = steps.throw(error)
+            except StopIteration as e:
+                return e.value
+            error = None
+            try:
+                execute_pipeline(pipeline, stages, base)
+            except (LoopControl, FunctionReturn) as e:
+                # break, continue or return: unwinds the evaluation
+                error = e
+            status = utils.last_exit_code
+            if jobs.job_control and status == 128 + signal.SIGINT and not pipeline.background:
+                # The job was stopped with Ctrl-C, which only reached its
+                # process group: stop the rest of the commands too
+                raise KeyboardInterrupt
+    finally:
+        steps.close()
+
+def is_complete(text):
+    """Whether text can be run: it does not end inside a quote or compound command, or after && or |.
+
+    Other syntax errors count as complete, to be reported when run.
+    """
+    try:
+        parse_line(text)
+    except IncompleteInput:
+        return False
+    except ValueError:
+        pass
+    return True
 
-def run_shell():
-    """Run the main shell loop."""
-    global shell_variables, last_exit_code
+def execute_line(line):
+    """Parse and execute input: a line, or lines that together make complete commands."""
+    tracing.begin_command(line)
+    command_hash.revalidate()
+    try:
+        with tracing.span("parse"):
+            command_list = parse_line(line)
+        if command_list is not None:
+            run_commands(command_list)
+    except ValueError as e:
+        sys.stderr.write(f"Error parsing command: {e}\n")
+        utils.last_exit_code = 2
+    finally:
+        tracing.end_command(utils.last_exit_code)
+
+def run_script(stream, name="main.py", args=()):
+    """Execute commands read from a stream without prompting.
+
+    Readline, history and completion are never set up. Lines are gathered
+    until they make complete commands, so loops and conditionals may span
+    several. Returns the exit status of the last command, or 141 (as for
+    SIGPIPE) once the reader of the shell's output has gone away.
+    """
+    utils.positional_args = [name] + list(args)
+    pending = []
+    try:
+        for line in stream:
+            if not pending and not line.strip():
+                continue
+            pending.append(line.rstrip("\n"))
+            text = "\n".join(pending).strip()
+            if is_complete(text):
+                pending = []
+                execute_line(text)
+        if pending:
+            # Reports where the input ended
+            execute_line("\n".join(pending).strip())
+        sys.stdout.flush()
+    except BrokenPipeError:
+        # Output still buffered would fail again when the interpreter
+        # flushes sys.stdout at exit
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+        os.close(devnull)
+        return 128 + signal.SIGPIPE
+    return utils.last_exit_code
+
+def read_lines(fd):
+    """Yield the lines of a script read from fd, without reading past them.
+
+    Commands the script runs may read the same descriptor, and must find
+    the script's following lines there. A seekable file is read a block at
+    a time and repositioned after each line; anything else is read one
+    byte at a time, as sh does.
+    """
+    try:
+        os.lseek(fd, 0, os.SEEK_CUR)
+        size = 4096
+    except OSError:
+        size = 1
+    line = bytearray()
+    while chunk := os.read(fd, size):
+        end = chunk.find(b"\n")
+        if end == -1:
+            line += chunk
+            continue
+        if size > 1:
+            os.lseek(fd, end + 1 - len(chunk), os.SEEK_CUR)
+        line += chunk[:end + 1]
+        yield line.decode(errors="surrogateescape")
+        line = bytearray()
+    if line:
+        yield line.decode(errors="surrogateescape")
+
+def read_continuation(text):
+    """Read more lines, prompting with "> ", while text is not complete.
+
+    At the end of input text is returned as it is, for its error to be
+    reported when it is run.
+    """
+    while not is_complete(text):
+        sys.stdout.write("> ")
+        sys.stdout.flush()
+        try:
+            text += "\n" + input()
+        except EOFError:
+            break
+    return text
+
+def run_shell(profile=None):
+    """Run the main shell loop.
+
+    If profile is a list, (phase, seconds) pairs for each setup step are
+    appended to it.
+    """
+    import time
+    
+    start = time.perf_counter()
+    import readline
+    from history import setup_history, merge_history, append_entry
+    from completion import setup_completion
+    if profile is not None:
+        profile.append(("import readline, history, completion", time.perf_counter() - start))
+    
+    utils.interactive = True
+    jobs.init_job_control()
     
+    start = time.perf_counter()
     setup_history()
+    if profile is not None:
+        profile.append(("setup history", time.perf_counter() - start))
+    
+    start = time.perf_counter()
     setup_completion()
+    if profile is not None:
+        profile.append(("setup completion", time.perf_counter() - start))
+        report_startup_profile(profile)
     
     while True:
+        merge_history()
+        jobs.notify_jobs(sys.stderr)
         sys.stdout.write("$ ")
         sys.stdout.flush()
         try:
             inputT = input().strip()
         except EOFError:
             break
+        except KeyboardInterrupt:
+            sys.stdout.write("\n")
+            utils.last_exit_code = 130
+            continue
         if not inputT:
             continue
+        try:
+            inputT = read_continuation(inputT)
+        except KeyboardInterrupt:
+            sys.stdout.write("\n")
+            utils.last_exit_code = 130
+            continue
             
         if inputT.strip():
             readline.add_history(inputT)
 
+        started = time.time()
         try:
-            commands = []
-            current_command = []
-            in_single_quote = False
-            in_double_quote = False
-            
-            parts = shlex.split(inputT)
-            
-            # Expand variables and tildes
-            expanded_parts = []
-            for part in parts:
-                expanded_part = expand_variables(part)
-                expanded_part = expand_tilde(expanded_part)
-                expanded_parts.append(expanded_part)
-            parts = expanded_parts
-            
-            # Group commands by pipes
-            current_command = []
-            for part in parts:
-                if part == "|" and not in_single_quote and not in_double_quote:
-                    if current_command:
-                        commands.append(current_command)
-                        current_command = []
-                else:
-                    current_command.append(part)
-            
-            if current_command:
-                commands.append(current_command)
-                
-            if commands:
-                execute_pipeline(commands)
-                
-        except ValueError as e:
-            print(f"Error parsing command: {e}")
-            continue
\ No newline at end of file
+            execute_line(inputT)
+        except KeyboardInterrupt:
+            sys.stdout.write("\n")
+            utils.last_exit_code = 130
+        append_entry(inputT, started, utils.last_exit_code)
+    
+    return utils.last_exit_code
@@ -0,0 +1,63 @@
+import os
+import sys
+import json
+import signal
+import socket
+
+# A small client for the shell server (main.py --server). It imports nothing
+# of the shell: it hands its stdin, stdout and stderr to a session, forwards
+# signals to it and exits with the status of the command.
+
+USAGE = "usage: shell_client.py socket (-c command [name [args ...]] | script [args ...])\n"
+
+def main(argv):
+    if len(argv) < 2 or (argv[1] == "-c" and len(argv) < 3):
+        sys.stderr.write(USAGE)
+        return 2
+    path = argv[0]
+    if argv[1] == "-c":
+        command = argv[2]
+        name = argv[3] if len(argv) > 3 else "main.py"
+        args = argv[4:]
+    else:
+        try:
+            with open(argv[1]) as script:
+                command = script.read()
+        except OSError as e:
+            sys.stderr.write(f"shell_client.py: {argv[1]}: {e.strerror}\n")
+            return 127 if isinstance(e, FileNotFoundError) else 126
+        name = argv[1]
+        args = argv[2:]
+
+    request = {"command": command, "name": name, "args": args,
+               "cwd": os.getcwd(), "env": dict(os.environ)}
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(path)
+        socket.send_fds(conn, [json.dumps(request).encode() + b"\n"], [0, 1, 2])
+    except OSError as e:
+        sys.stderr.write(f"shell_client.py: {path}: {e.strerror}\n")
+        return 2
+
+    replies = conn.makefile("rb")
+    line = replies.readline()
+    if not line:
+        return 1
+    session_pid = json.loads(line)["pid"]
+
+    def forward_signal(signum, frame):
+        try:
+            os.killpg(session_pid, signum)
+        except ProcessLookupError:
+            pass
+
+    for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP, signal.SIGQUIT):
+        signal.signal(signum, forward_signal)
+
+    line = replies.readline()
+    if not line:
+        return 1
+    return json.loads(line)["status"]
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,38 @@
+import os
+import sys
+import subprocess
+import tempfile
+import unittest
+
+MAIN_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "main.py")
+
+def run_shell(command, home):
+    """Run a -c command in a fresh shell and return the CompletedProcess."""
+    return subprocess.run([sys.executable, MAIN_SCRIPT, "-c", command], cwd=home,
+                          env=dict(os.environ, HOME=home), capture_output=True, text=True, timeout=30)
+
+class HighDescriptorRedirectionTest(unittest.TestCase):
+    """Redirections of descriptors above 2 with the Popen backend."""
+
+    def setUp(self):
+        self.home = tempfile.TemporaryDirectory()
+        self.addCleanup(self.home.cleanup)
+
+    def check_redirection(self, prefix):
+        result = run_shell(f"{prefix}; sh -c 'echo x >&7' 7>out; cat out", self.home.name)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout, "x\n")
+
+    def test_popen_backend(self):
+        self.check_redirection("set +o posix-spawn")
+
+    def test_with_resource_limit(self):
+        # Limits are applied by the Popen backend's preexec_fn
+        self.check_redirection("ulimit -n 100")
+
+    def test_limit_applies_to_command(self):
+        result = run_shell("ulimit -n 100; sh -c 'ulimit -n; echo y >&9' 9>out; cat out", self.home.name)
+        self.assertEqual(result.stdout, "100\ny\n", result.stderr)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,127 @@
+import time
+import utils
+
+# Tracing times the internal phases of each command (parsing, expansion,
+# command lookup, redirections, spawning, waiting, builtins) and appends one
+# JSON record per command to utils.trace_file. It is turned on with
+# SHELL_TRACE_TIMING=1 in the environment or `set -o trace-timing`.
+enabled = bool(utils.shell_variables.get("SHELL_TRACE_TIMING"))
+if enabled:
+    utils.shell_options.add("trace-timing")
+
+# [line, wall clock start, perf_counter start, spans] of the command being traced
+current = None
+
+class Span:
+    """Times one phase and records it in the current command."""
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        command = current
+        if command is not None:
+            command[3].append((self.name, self.start - command[2], time.perf_counter() - self.start))
+        return False
+
+class NullSpan:
+    """A span that records nothing, used while tracing is off."""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NULL_SPAN = NullSpan()
+
+def span(name):
+    """Return a context manager timing a phase of the current command.
+
+    While tracing is off this is a shared no-op object, so an instrumented
+    phase costs a function call and nothing is allocated.
+    """
+    return Span(name) if enabled else NULL_SPAN
+
+def begin_command(line):
+    """Start collecting the spans of a command line."""
+    global current
+    if enabled:
+        current = [line, time.time(), time.perf_counter(), []]
+
+def end_command(status):
+    """Append the record of the current command to the trace file."""
+    global current
+    command = current
+    if command is None:
+        return
+    current = None
+    finished = time.perf_counter()
+
+    import json
+    line, wall_start, perf_start, spans = command
+    record = {
+        "command": line,
+        "start": wall_start,
+        "duration": finished - perf_start,
+        "status": status,
+        "spans": [{"name": name, "start": start, "duration": duration} for name, start, duration in spans],
+    }
+    try:
+        with open(utils.trace_file, "a") as f:
+            f.write(json.dumps(record) + "\n")
+    except OSError:
+        pass
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)]
+
+def report(stream, path=None):
+    """Write per-phase latency statistics and histograms of a trace file.
+
+    Returns False if the file cannot be read.
+    """
+    import json
+
+    durations = {}
+    try:
+        with open(path or utils.trace_file) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                durations.setdefault("command", []).append(record["duration"])
+                for span_record in record["spans"]:
+                    durations.setdefault(span_record["name"], []).append(span_record["duration"])
+    except OSError:
+        return False
+
+    for name, values in sorted(durations.items(), key=lambda item: -sum(item[1])):
+        values.sort()
+        stream.write(f"{name}: n={len(values)} total={sum(values) * 1000:.2f}ms "
+                     f"p50={percentile(values, 0.5) * 1000:.3f}ms p90={percentile(values, 0.9) * 1000:.3f}ms "
+                     f"p99={percentile(values, 0.99) * 1000:.3f}ms max={values[-1] * 1000:.3f}ms\n")
+        # Power-of-two buckets starting at 1 microsecond
+        buckets = {}
+        for value in values:
+            bucket = max(int(value * 1e6), 1).bit_length() - 1
+            buckets[bucket] = buckets.get(bucket, 0) + 1
+        widest = max(buckets.values())
+        for bucket in range(min(buckets), max(buckets) + 1):
+            count = buckets.get(bucket, 0)
+            stream.write(f"  < {format_micros(2 ** (bucket + 1)):>8} {'#' * round(40 * count / widest):40s} {count}\n")
+    return True
+
+def format_micros(micros):
+    if micros >= 1000000:
+        return f"{micros // 1000000}s"
+    if micros >= 1000:
+        return f"{micros // 1000}ms"
+    return f"{micros}us"
@@ -1,34 +1,97 @@
 import os
-
-SHELL_BUILTINS = [
-    "alias", "bg", "bind", "break", "cd", "command", "continue", "declare",
-    "dirs", "echo", "enable", "eval", "exec", "exit", "export", "fg",
-    "getopts", "hash", "help", "history", "jobs", "kill", "let", "local",
-    "logout", "popd", "pushd", "pwd", "read", "readonly", "return", "set",
-    "shift", "shopt", "source", "test", "times", "trap", "type", "ulimit",
-    "umask", "unalias", "unset", "wait"
-]
+from variables import VariableStore
 
 HELP_TEXT = {
+    "bg": "bg [job_spec ...]\n\nResume each stopped job in the background, as if it had been started with '&'.\nWithout a job spec, the current job is used.",
+    
+    "break": "break [n]\n\nExit from the innermost for, while or until loop, or from n enclosing loops.",
+    
+    "cache": "cache [-t seconds] [-d file] [-e name] [-p] [--] command [args ...]\ncache -c [command [args ...]]\ncache -s\n\nRun command with its output captured and remember its standard output, standard\nerror and exit status. Running the same command again replays them instead.\nThe result is reused only for the same arguments, working directory and PATH.\n  -t  reuse a result only if it is at most this many seconds old\n  -d  also require this file to have the same mtime and size (repeatable)\n  -e  also require this variable to have the same value (repeatable)\n  -p  keep the result on disk too, so that other sessions can reuse it\n  -c  forget the results of command, or of every command\n  -s  show the hit and miss counters\n\nCached commands read no input. Results are kept in memory up to a size limit,\nleast recently used first.",
+    
     "cd": "cd [directory]\n\nChange the current directory to the specified directory.\nIf no directory is specified, change to the home directory.",
     
+    "continue": "continue [n]\n\nResume the next iteration of the innermost for, while or until loop, or of the\nnth enclosing loop.",
+    
     "echo": "echo [arguments...]\n\nWrite arguments to standard output.\nDisplays the arguments separated by a single space and followed by a newline.",
     
     "exit": "exit [n]\n\nExit the shell with status n. If n is omitted, the exit status is that of the last command executed.",
     
-    "export": "export [name[=value] ...]\n\nSet environment variables and mark them for export to child processes.\n\nWithout arguments, lists all exported variables in the format 'name=value'.",
+    "export": "export [-n] [name[=value] ...]\n\nMark variables for export to the environment of commands, assigning value\nfirst if it is given. Variables set with name=value alone are local to the\nshell until exported.\n  -n  stop exporting each name\n\nWithout arguments, lists all exported variables in the format 'name=value'.",
+    
+    "for": "for name [in words ...]; do commands; done\n\nRun commands once for each word after expansion, with name set to it.\nWithout `in words`, loop over the positional parameters.",
+    
+    "fg": "fg [job_spec]\n\nMove a job to the foreground and make it the current job.\nWithout a job spec, the current job is used.",
+    
+    "hash": "hash [-r] [-p pathname] [-d] [name ...]\n\nRemember or display the full pathnames of commands.\n\nWithout arguments, lists the remembered commands with their hit counts.\n  -r  forget all remembered locations\n  -p  use pathname as the full pathname of name\n  -d  forget the remembered location of each name\n\nThe table is reset when PATH changes, and an entry is looked up again\nwhen a PATH directory it depends on has been modified.",
     
     "help": "help [command]\n\nDisplay information about built-in commands.\n\nIf command is specified, gives detailed help on that command.\nOtherwise, lists available help topics.",
     
-    "history": "history [n]\n\nDisplay the command history list with line numbers.\n\nAn argument of n lists only the last n lines.",
+    "if": "if commands; then commands; [elif commands; then commands;]... [else commands;] fi\n\nRun the commands after the first then whose condition exits with status 0,\nor else those after else. The status is that of the last command run.",
+    
+    "history": "history [-t] [n]\nhistory [-t] -s pattern\n\nDisplay the command history list with entry numbers. The history is shared by\nall sessions and each command is saved as soon as it has run.\n\nAn argument of n lists only the last n entries.\n  -s  list every entry containing pattern; a leading ^ matches the start\n  -t  also show when each command was started and its exit status",
+    
+    "jobs": "jobs [-l | -p]\n\nList the background and stopped jobs with their status.\n  -l  also list process IDs\n  -p  list only the process group ID of each job\n\nJob specs are %n (job n), %% or %+ (current job), %- (previous job) and\n%string (job whose command starts with string).",
+    
+    "kill": "kill [-s sigspec | -n signum | -sigspec] pid | jobspec ...\nkill -l [sigspec]\n\nSend a signal (TERM by default) to processes or jobs.\n-l lists the signal names.",
+    
+    "local": "local name[=value] ...\n\nCreate variables that are restored to their previous values when the current\nfunction returns. Without a value the variable starts out unset.",
+    
+    "parallel": "parallel [-j N] [-k] [--stats] [--glob pattern] command [args ...] [::: items ...]\n\nRun command once for every item, using up to N jobs at a time (default: the\nnumber of CPUs). Items are the arguments after ':::', the paths matching\nthe --glob pattern as they are found, or else the lines read from standard\ninput. Each {} in the command is replaced by the item; without\n{}, the item is appended as the last argument.\n\nThe output of each job is written as a whole when it finishes.\n  -k, --keep-order  write the outputs in input order instead\n  --stats           report the job count, failures and throughput on stderr\n  --glob pattern    run for every path matching pattern (quote it so the\n                    shell does not expand it first); ** matches any\n                    number of directories\n\nThe exit status is the number of failed jobs (at most 101).",
     
     "pwd": "pwd\n\nPrint the absolute pathname of the current working directory.",
     
-    "type": "type [command]\n\nDisplay information about command type.\n\nIndicate how the command would be interpreted if used as a command name."
+    "readonly": "readonly [name[=value] ...]\n\nMark variables as readonly, assigning value first if it is given. Readonly\nvariables cannot be assigned or unset.\n\nWithout arguments, lists the readonly variables.",
+    
+    "return": "return [n]\n\nReturn from a shell function with status n, or that of the last command run.",
+    
+    "rusage": "rusage\n\nShow the wall time, user and system CPU time, maximum resident set size and\nexit status of each process of the last accounted pipeline. Pipelines are\naccounted when run with `time` or while `set -o accounting` is on; builtins\nare not listed.\n\nThe totals are also available as $TIME_REAL, $TIME_USER and $TIME_SYS\n(seconds) and $TIME_MAXRSS (kilobytes, the largest process).",
+    
+    "set": "set [-o option] [+o option] [-- arg ...]\n\nSet shell options and positional parameters.\n  -o option  enable option\n  +o option  disable option\n  -o         list the options and whether they are on\n  --         assign the remaining arguments to $1, $2, ...\n\nWithout arguments, lists the shell variables.\n\nOptions:\n  accounting    keep the resource usage of every pipeline for rusage\n  noglob        do not expand *, ? and [...] into matching paths\n  posix-spawn   start commands with posix_spawn rather than subprocess\n                (on by default where available)\n  trace-timing  record the time spent in each phase of every command\n                in the trace file (see trace)",
+    
+    "timeout": "timeout [-k duration] [-s signal] duration pipeline\n\nRun pipeline and send signal (default TERM) to all of its processes if it is\nstill running after duration, then KILL after the -k duration if one is given.\nDurations are seconds, or have an s, m, h or d suffix. The exit status is 124\nif the pipeline timed out, 137 if it had to be killed and 125 for invalid\narguments. Builtins run without a time limit.\n\nThe options may also be written as -k5, --kill-after=5, -sKILL or --signal=KILL.\nWith other options, such as --foreground, the external timeout command runs.",
+    
+    "time": "time [-p] pipeline\n\nRun pipeline and report the elapsed real time and the user and system CPU\ntime it used on standard error. -p prints the times in the POSIX format.",
+    
+    "times": "times\n\nPrint the accumulated user and system times of the shell (first line) and\nof its children (second line).",
+    
+    "trace": "trace [-c] [file]\n\nPrint the latency percentiles and a histogram of each phase recorded in the\ntrace file (parse, expand, lookup, redirect, spawn, wait, builtin and the\nwhole command).\n  -c  empty the trace file\n\nPhases are recorded while `set -o trace-timing` is on or SHELL_TRACE_TIMING\nis set in the environment, one JSON line per command, in SHELL_TRACE_FILE\n(default ~/.python_shell_trace.jsonl).",
+    
+    "ulimit": "ulimit [-SHa] [-cdflmnstuv] [limit]\n\nShow or set the resource limits of the commands started by the shell; the\nshell's own limits are unchanged. limit is a number, unlimited, soft or hard.\n  -S  the soft limit (shown by default)\n  -H  the hard limit (both are set by default)\n  -a  show every limit\n  -c  core file size (KiB)      -n  open files\n  -d  data segment size (KiB)   -s  stack size (KiB)\n  -f  file size (KiB, default)  -t  CPU time (seconds)\n  -l  locked memory (KiB)       -u  user processes\n  -m  resident set size (KiB)   -v  virtual memory (KiB)",
+    
+    "type": "type [command]\n\nDisplay information about command type.\n\nIndicate how the command would be interpreted if used as a command name.",
+    
+    "unset": "unset [-v] name ...\n\nRemove each variable, including from the environment of commands.\nReadonly variables cannot be unset.",
+    
+    "until": "until commands; do commands; done\n\nRun the body as long as the last command of the condition fails.",
+    
+    "wait": "wait [id ...]\n\nWait for each job or process ID and return the exit status of the last one.\nWithout arguments, wait for all background jobs and return 0.",
+    
+    "while": "while commands; do commands; done\n\nRun the body as long as the last command of the condition exits with status 0.\nbreak leaves the loop and continue starts its next iteration."
 }
 
 # Global state variables 
-shell_variables = dict(os.environ)
+shell_variables = VariableStore(os.environ)
 last_exit_code = 0
+last_background_pid = None
+interactive = False
+# Options enabled with `set -o name`
+shell_options = set()
+# Per-process records of the last pipeline run under `time` or `set -o accounting`
+last_resources = None
+# $0 followed by the positional parameters $1, $2, ...
+positional_args = ["main.py"]
+# Shell functions, name -> the Compound command that is their body
+functions = {}
+# Number of for, while and until loops being run, for break and continue
+loop_depth = 0
 history_file = os.path.expanduser("~/.python_shell_history")
-history_size = 1024
\ No newline at end of file
+history_size = 1024
+trace_file = os.environ.get("SHELL_TRACE_FILE") or os.path.expanduser("~/.python_shell_trace.jsonl")
+parse_cache_size = 256
+output_cache_size = 16 * 1024 * 1024
+output_cache_dir = os.path.expanduser("~/.cache/python_shell/output")
+# Limits set with ulimit, as resource number -> (soft, hard). They are applied
+# to each command as it starts, not to the shell itself.
+resource_limits = {}
+# Bytes of captured command output kept in memory before spilling to a file
+capture_memory_limit = 4 * 1024 * 1024
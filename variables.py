@@ -0,0 +1,136 @@
+class ReadonlyError(ValueError):
+    """Raised when a readonly variable is assigned or unset."""
+
+    def __init__(self, name):
+        super().__init__(f"{name}: readonly variable")
+        self.name = name
+
+class VariableStore(dict):
+    """The shell's variables: a dict of name -> value with attributes.
+
+    Names in exported are passed to commands in their environment, names in
+    readonly cannot be changed. Reading is plain dict access, so expansion
+    costs a dict lookup; writes go through __setitem__ and __delitem__, which
+    check readonly and bump version. A change to an exported variable also
+    bumps env_version, and environ() only rebuilds the environment it hands
+    to spawned commands when env_version has moved.
+    """
+
+    def __init__(self, environ=()):
+        super().__init__(environ)
+        self.exported = set(self)
+        self.readonly = set()
+        self.version = 0
+        self.env_version = 0
+        self.env_block = None
+        self.env_block_version = -1
+        # One list per `local` scope of (name, old value or None, was exported)
+        self.scopes = []
+
+    def reset(self, environ):
+        """Replace every variable with those of environ, all exported and none readonly."""
+        dict.clear(self)
+        dict.update(self, environ)
+        self.exported = set(self)
+        self.readonly = set()
+        self.scopes = []
+        self.version += 1
+        self.env_version += 1
+
+    def changed(self, name):
+        self.version += 1
+        if name in self.exported:
+            self.env_version += 1
+
+    def __setitem__(self, name, value):
+        if name in self.readonly:
+            raise ReadonlyError(name)
+        dict.__setitem__(self, name, value)
+        self.changed(name)
+
+    def __delitem__(self, name):
+        if name in self.readonly:
+            raise ReadonlyError(name)
+        dict.__delitem__(self, name)
+        self.changed(name)
+        self.exported.discard(name)
+
+    def pop(self, name, *default):
+        if name in self:
+            value = self[name]
+            del self[name]
+            return value
+        if default:
+            return default[0]
+        raise KeyError(name)
+
+    def unset(self, name):
+        """Remove a variable; unsetting one that does not exist is not an error."""
+        if name in self:
+            del self[name]
+        else:
+            if name in self.readonly:
+                raise ReadonlyError(name)
+            self.exported.discard(name)
+
+    def export(self, name, value=None):
+        """Mark a variable for export, assigning value if it is given."""
+        if value is not None:
+            self[name] = value
+        if name not in self.exported:
+            self.exported.add(name)
+            self.changed(name)
+
+    def unexport(self, name):
+        """Keep a variable but stop passing it to commands."""
+        if name in self.exported:
+            self.changed(name)
+            self.exported.discard(name)
+
+    def set_readonly(self, name, value=None):
+        """Make a variable readonly, assigning value first if it is given."""
+        if value is not None:
+            self[name] = value
+        self.readonly.add(name)
+
+    def environ(self):
+        """Return the environment for spawned commands.
+
+        The same dict is returned until an exported variable changes, so
+        commands run in a row share one environment instead of each copying
+        every variable. Callers must not modify it.
+        """
+        if self.env_block_version != self.env_version:
+            self.env_block = {name: self[name] for name in self.exported if name in self}
+            self.env_block_version = self.env_version
+        return self.env_block
+
+    def push_scope(self):
+        """Start a scope for `local` variables."""
+        self.scopes.append([])
+
+    def pop_scope(self):
+        """Restore the variables made local since the matching push_scope."""
+        for name, value, was_exported in reversed(self.scopes.pop()):
+            self.readonly.discard(name)
+            if value is None:
+                self.unset(name)
+            else:
+                self[name] = value
+            if was_exported:
+                self.export(name)
+            else:
+                self.unexport(name)
+
+    def make_local(self, name, value=None):
+        """Make a variable local to the innermost scope. Returns False outside any scope."""
+        if not self.scopes:
+            return False
+        if name in self.readonly:
+            raise ReadonlyError(name)
+        self.scopes[-1].append((name, self.get(name), name in self.exported))
+        if value is None:
+            self.unset(name)
+        else:
+            self[name] = value
+        return True